@@ -0,0 +1,80 @@
+import os
+import math
+import time
+import asyncio
+from fastapi import HTTPException
+
+from utils import JOB_LANES, lane_queue
+from metrics import ADMISSION_REJECTED
+
+# =========================
+# ENV CONFIG
+# =========================
+# Per-lane backlog above which new jobs get a 429 ("lane:depth,...")
+LANE_MAX_DEPTH = {
+    lane: int(depth) for lane, depth in (
+        item.split(":") for item in os.getenv("LANE_MAX_DEPTH", "interactive:2000,batch:500").split(",")
+    )
+}
+# Lower lanes are shed first: once the lanes above them hold this many jobs, they get a 429 too
+ADMISSION_SHED_DEPTH = int(os.getenv("ADMISSION_SHED_DEPTH", 200))
+# Rough worker throughput, used to turn a backlog into a Retry-After
+ADMISSION_DRAIN_RATE = float(os.getenv("ADMISSION_DRAIN_RATE", 50))
+ADMISSION_MAX_RETRY_AFTER = int(os.getenv("ADMISSION_MAX_RETRY_AFTER", 60))
+# Depths are read from the broker at most this often per API process
+ADMISSION_DEPTH_CACHE_MS = int(os.getenv("ADMISSION_DEPTH_CACHE_MS", 250))
+
+# =========================
+# QUEUE DEPTHS
+# =========================
+class QueueDepths:
+    """Lane backlogs from passive queue declares, cached briefly and refreshed by one caller at a time."""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.depths = {}
+        self.read_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def get(self) -> dict:
+        if time.monotonic() - self.read_at < ADMISSION_DEPTH_CACHE_MS / 1000:
+            return self.depths
+        async with self.lock:
+            if time.monotonic() - self.read_at >= ADMISSION_DEPTH_CACHE_MS / 1000:
+                depths = {}
+                for lane in JOB_LANES:
+                    queue = await self.channel.declare_queue(lane_queue(lane), durable=True, passive=True)
+                    depths[lane] = queue.declaration_result.message_count
+                self.depths = depths
+                self.read_at = time.monotonic()
+        return self.depths
+
+def retry_after(backlog: int) -> int:
+    return max(1, min(ADMISSION_MAX_RETRY_AFTER, math.ceil(backlog / ADMISSION_DRAIN_RATE)))
+
+async def admit(queue_depths: QueueDepths, lane: str):
+    # Raises 429 with Retry-After when the lane, or the lanes it yields to, are backed up
+    try:
+        depths = await queue_depths.get()
+    except Exception as e:
+        # Admission control must never be why a healthy broker rejects work
+        print(f"Queue depth check failed: {e}")
+        return
+
+    depth = depths.get(lane, 0)
+    if depth >= LANE_MAX_DEPTH.get(lane, math.inf):
+        ADMISSION_REJECTED.labels(lane, "lane_full").inc()
+        raise HTTPException(
+            status_code=429,
+            detail=f"Lane '{lane}' is full ({depth} jobs queued).",
+            headers={"Retry-After": str(retry_after(depth))}
+        )
+
+    ahead = sum(depths.get(other, 0) for other in JOB_LANES[:JOB_LANES.index(lane)])
+    if ahead >= ADMISSION_SHED_DEPTH:
+        ADMISSION_REJECTED.labels(lane, "shed").inc()
+        raise HTTPException(
+            status_code=429,
+            detail=f"Higher-priority work is backed up ({ahead} jobs); '{lane}' jobs are deferred.",
+            headers={"Retry-After": str(retry_after(ahead + depth))}
+        )
@@ -0,0 +1,147 @@
+import os
+import json
+import asyncio
+import hashlib
+from typing import Optional
+import numpy as np
+from PIL import Image
+
+from results import RESULT_KEY_PREFIX, RESULT_CHANNEL, get_result
+from metrics import DEDUP_HITS
+
+# =========================
+# ENV CONFIG
+# =========================
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_KEY_PREFIX = os.getenv("DEDUP_KEY_PREFIX", "upload_hash:")
+DEDUP_TTL_SECONDS = int(os.getenv("DEDUP_TTL_SECONDS", 300))
+DEDUP_LOCK_SECONDS = int(os.getenv("DEDUP_LOCK_SECONDS", 30))
+# Also match re-encoded copies of the same picture (sync path, after decoding)
+DEDUP_PERCEPTUAL = os.getenv("DEDUP_PERCEPTUAL", "false").lower() == "true"
+# Bumped on every enrollment and delete; part of every dedup key (outside DEDUP_KEY_PREFIX, which reset purges)
+GALLERY_GENERATION_KEY = os.getenv("GALLERY_GENERATION_KEY", "gallery_generation")
+
+# =========================
+# HASHING
+# =========================
+def content_hash(image_bytes: bytes, *params) -> str:
+    # Parameters that change the answer are part of the key
+    digest = hashlib.sha256(image_bytes)
+    digest.update(json.dumps(params).encode())
+    return digest.hexdigest()
+
+def perceptual_hash(image_array: np.ndarray, *params) -> str:
+    # 64-bit difference hash: survives re-compression and resizing, not crops
+    small = np.asarray(Image.fromarray(image_array).convert("L").resize((9, 8), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits((small[:, 1:] > small[:, :-1]).flatten())
+    return "p" + content_hash(bits.tobytes(), *params)
+
+# =========================
+# GALLERY GENERATION
+# =========================
+async def gallery_generation(redis) -> int:
+    return int(await redis.get(GALLERY_GENERATION_KEY) or 0)
+
+async def bump_gallery_generation(redis):
+    # Answers and job claims from before the change become unreachable at once; their TTL removes them
+    try:
+        await redis.incr(GALLERY_GENERATION_KEY)
+    except Exception as e:
+        print(f"Gallery generation bump failed: {e}")
+
+# =========================
+# SYNC RESPONSES
+# =========================
+# Stored and published like job results, so ResultBroker can wake waiters in any API process
+def response_id(key: str) -> str:
+    return f"dedup-{key}"
+
+async def cached_response(redis, key: str) -> Optional[dict]:
+    result = await get_result(redis, response_id(key))
+    return result["response"] if result and result.get("status") == "done" else None
+
+async def store_response(redis, key: str, response: dict):
+    result = json.dumps({"job_id": response_id(key), "status": "done", "response": response})
+    await redis.set(f"{RESULT_KEY_PREFIX}{response_id(key)}", result, ex=DEDUP_TTL_SECONDS)
+    await redis.publish(RESULT_CHANNEL, result)
+
+class SingleFlight:
+    """Runs one computation per content hash; identical requests share its response."""
+
+    def __init__(self, redis, broker):
+        self.redis = redis
+        self.broker = broker
+        self.flights = {}
+
+    async def run(self, endpoint: str, key: str, compute) -> dict:
+        # Same process: join the computation already running
+        flight = self.flights.get(key)
+        if flight is not None:
+            DEDUP_HITS.labels(endpoint, "in_flight").inc()
+            return await asyncio.shield(flight)
+
+        flight = asyncio.get_running_loop().create_future()
+        self.flights[key] = flight
+        try:
+            response = await self._run(endpoint, key, compute)
+            flight.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except Exception as e:
+            flight.set_exception(e)
+            # Mark retrieved so a flight nobody joined does not log "exception never retrieved"
+            flight.exception()
+            raise
+        finally:
+            self.flights.pop(key, None)
+
+    async def _run(self, endpoint: str, key: str, compute) -> dict:
+        response = await cached_response(self.redis, key)
+        if response is not None:
+            DEDUP_HITS.labels(endpoint, "stored").inc()
+            return response
+
+        lock_key = f"{DEDUP_KEY_PREFIX}lock:{key}"
+        if not await self.redis.set(lock_key, "1", nx=True, ex=DEDUP_LOCK_SECONDS):
+            # Another API process owns it: wait for its result, compute ourselves if it fails
+            result = await self.broker.wait(response_id(key), DEDUP_LOCK_SECONDS)
+            if result and result.get("status") == "done":
+                DEDUP_HITS.labels(endpoint, "in_flight").inc()
+                return result["response"]
+            return await compute()
+
+        try:
+            response = await compute()
+            await store_response(self.redis, key, response)
+            return response
+        except Exception:
+            # Wake remote waiters now instead of at their timeout
+            await self.redis.publish(RESULT_CHANNEL, json.dumps({"job_id": response_id(key), "status": "failed"}))
+            raise
+        finally:
+            await self.redis.delete(lock_key)
+
+# =========================
+# ASYNC JOBS
+# =========================
+async def claim_job(redis, key: str, job_id: str) -> Optional[str]:
+    # Returns the job already handling this content, or None if job_id now owns it
+    hash_key = f"{DEDUP_KEY_PREFIX}job:{key}"
+    if await redis.set(hash_key, job_id, nx=True, ex=DEDUP_TTL_SECONDS):
+        return None
+
+    existing = await redis.get(hash_key)
+    # No result yet means the owner has not stored "pending" yet; only a failed job is replaced
+    result = await get_result(redis, existing) if existing else None
+    if existing is None or (result and result.get("status") == "failed"):
+        await redis.set(hash_key, job_id, ex=DEDUP_TTL_SECONDS)
+        return None
+    DEDUP_HITS.labels("async", "job").inc()
+    return existing
+
+async def release_job(redis, key: str, job_id: str):
+    hash_key = f"{DEDUP_KEY_PREFIX}job:{key}"
+    if await redis.get(hash_key) == job_id:
+        await redis.delete(hash_key)
@@ -1,12 +1,22 @@
 from fastapi import Request
-from redis import Redis
-from qdrant_client import QdrantClient
 
 def get_redis_async(request: Request):
     return request.app.state.redis_async
 
+def get_result_broker(request: Request):
+    return request.app.state.result_broker
+
+def get_single_flight(request: Request):
+    return request.app.state.single_flight
+
+def get_face_cache(request: Request):
+    return request.app.state.face_cache
+
 def get_rabbitmq_channel(request: Request):
     return request.app.state.rabbitmq_channel
 
-def get_redis() -> Redis:
-    return Redis(host="redis", port=6379, decode_responses=True)
\ No newline at end of file
+def get_publisher(request: Request):
+    return request.app.state.publisher
+
+def get_queue_depths(request: Request):
+    return request.app.state.queue_depths
\ No newline at end of file
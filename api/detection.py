@@ -0,0 +1,81 @@
+import os
+import threading
+import numpy as np
+from PIL import Image
+
+# =========================
+# ENV CONFIG
+# =========================
+DETECTION_MODELS = ("hog", "cnn")
+DETECTION_MODEL = os.getenv("DETECTION_MODEL", "hog")
+DETECTION_UPSAMPLE = int(os.getenv("DETECTION_UPSAMPLE", 1))
+# Longest side of the copy detection runs on; 0 detects at the working resolution
+DETECTION_MAX_SIZE = int(os.getenv("DETECTION_MAX_SIZE", 480))
+# Side of the blank image the warmup inference runs on
+WARMUP_IMAGE_SIZE = int(os.getenv("WARMUP_IMAGE_SIZE", 160))
+
+# =========================
+# MODELS
+# =========================
+_face_recognition = None
+_models_lock = threading.Lock()
+
+def face_models():
+    # face_recognition loads every dlib model when imported: done once per process, on first
+    # use (or warmup) instead of at import, so the process can bind and report liveness first
+    global _face_recognition
+    if _face_recognition is None:
+        with _models_lock:
+            if _face_recognition is None:
+                import face_recognition
+                _face_recognition = face_recognition
+    return _face_recognition
+
+def warmup():
+    # One dummy inference per model in use, so the first real request skips the first-call costs
+    image = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+    models = face_models()
+    for model in {DETECTION_MODEL, *(
+        os.getenv(f"DETECTION_MODEL_{endpoint}") for endpoint in ("SYNC", "ASYNC", "UPLOAD")
+    )} - {None}:
+        models.face_locations(image, number_of_times_to_upsample=0, model=model)
+    margin = WARMUP_IMAGE_SIZE // 4
+    models.face_encodings(image, [(margin, WARMUP_IMAGE_SIZE - margin, WARMUP_IMAGE_SIZE - margin, margin)])
+
+def detection_settings(endpoint: str, model: str = None, upsample: int = None):
+    # Explicit values win, then per-endpoint env (DETECTION_MODEL_SYNC, DETECTION_UPSAMPLE_UPLOAD, ...),
+    # then the global defaults
+    suffix = endpoint.upper()
+    model = model or os.getenv(f"DETECTION_MODEL_{suffix}", DETECTION_MODEL)
+    if upsample is None:
+        upsample = int(os.getenv(f"DETECTION_UPSAMPLE_{suffix}", DETECTION_UPSAMPLE))
+    if model not in DETECTION_MODELS:
+        raise ValueError(f"Invalid detection model. Use one of {DETECTION_MODELS}.")
+    return model, upsample
+
+def detect_faces(image: np.ndarray, model: str = None, upsample: int = None, max_size: int = None) -> list:
+    # Detects on a downscaled copy and maps the boxes back, so landmarks and
+    # encodings are still computed on the full-resolution image
+    model = model or DETECTION_MODEL
+    upsample = DETECTION_UPSAMPLE if upsample is None else upsample
+    max_size = DETECTION_MAX_SIZE if max_size is None else max_size
+
+    height, width = image.shape[:2]
+    if not max_size or max(height, width) <= max_size:
+        return face_models().face_locations(image, number_of_times_to_upsample=upsample, model=model)
+
+    scale = max_size / max(height, width)
+    small = np.asarray(Image.fromarray(image).resize(
+        (max(1, int(width * scale)), max(1, int(height * scale))),
+        Image.BILINEAR
+    ))
+    locations = face_models().face_locations(small, number_of_times_to_upsample=upsample, model=model)
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale))
+        )
+        for top, right, bottom, left in locations
+    ]
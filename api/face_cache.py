@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import asyncio
+import numpy as np
+
+# ==========================
+# ENV CONFIG
+# ==========================
+CACHE_STREAM_KEY = os.getenv("CACHE_STREAM_KEY", "face_cache_stream")
+CACHE_STREAM_MAXLEN = int(os.getenv("CACHE_STREAM_MAXLEN", 100000))
+CACHE_STREAM_BLOCK_MS = int(os.getenv("CACHE_STREAM_BLOCK_MS", 5000))
+
+
+# ==========================
+# LOCAL CACHE
+# ==========================
+class FaceCache:
+    """Process-local encoding cache kept in one contiguous matrix.
+
+    Rows [0, size) are live; removals swap the last row into the hole so a
+    lookup is always a single matrix-vector product over a dense block.
+    """
+
+    def __init__(self, dim: int = 128, capacity: int = 10000, ttl_seconds: int = 3600):
+        self.dim = dim
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+        self.size = 0
+        self.matrix = np.zeros((capacity, dim), dtype=np.float64)
+        self.sq_norms = np.zeros(capacity, dtype=np.float64)
+        self.expires_at = np.zeros(capacity, dtype=np.float64)
+        self.last_used = np.zeros(capacity, dtype=np.float64)
+        self.identifiers = [None] * capacity
+        self.photos = [None] * capacity
+        self.rows = {}
+
+    def __len__(self):
+        return self.size
+
+    def lookup(self, encoding, threshold: float):
+        self.expire()
+        if not self.size:
+            return None
+
+        query = np.asarray(encoding, dtype=np.float64)
+        # ||a - b||^2 = ||a||^2 - 2 a.b + ||b||^2, one BLAS call for all rows
+        sq_distances = self.sq_norms[:self.size] - 2.0 * (self.matrix[:self.size] @ query) + query @ query
+        row = int(np.argmin(sq_distances))
+        distance = float(np.sqrt(max(sq_distances[row], 0.0)))
+        if distance > threshold:
+            return None
+
+        self.last_used[row] = time.time()
+        return self.identifiers[row], self.photos[row], distance
+
+    def put(self, identifier: str, photo: str, encoding, created_at: float = None):
+        now = time.time()
+        created_at = created_at or now
+        expires_at = created_at + self.ttl_seconds
+        if expires_at <= now:
+            return
+
+        row = self.rows.get(identifier)
+        if row is None:
+            if self.size >= self.capacity:
+                self.expire()
+            if self.size >= self.capacity:
+                self._remove_row(int(np.argmin(self.last_used[:self.size])))
+            row = self.size
+            self.size += 1
+            self.rows[identifier] = row
+
+        vector = np.asarray(encoding, dtype=np.float64)
+        self.matrix[row] = vector
+        self.sq_norms[row] = vector @ vector
+        self.expires_at[row] = expires_at
+        self.last_used[row] = now
+        self.identifiers[row] = identifier
+        self.photos[row] = photo
+
+    def delete(self, identifier: str):
+        row = self.rows.get(identifier)
+        if row is not None:
+            self._remove_row(row)
+
+    def clear(self):
+        self.size = 0
+        self.rows.clear()
+
+    def expire(self, now: float = None):
+        now = now or time.time()
+        expired = np.flatnonzero(self.expires_at[:self.size] <= now)
+        # Remove from the highest row down so swapped-in rows are already checked
+        for row in expired[::-1]:
+            self._remove_row(int(row))
+
+    def _remove_row(self, row: int):
+        last = self.size - 1
+        del self.rows[self.identifiers[row]]
+        if row != last:
+            self.matrix[row] = self.matrix[last]
+            self.sq_norms[row] = self.sq_norms[last]
+            self.expires_at[row] = self.expires_at[last]
+            self.last_used[row] = self.last_used[last]
+            self.identifiers[row] = self.identifiers[last]
+            self.photos[row] = self.photos[last]
+            self.rows[self.identifiers[row]] = row
+        self.identifiers[last] = None
+        self.photos[last] = None
+        self.size = last
+
+
+# ==========================
+# REDIS STREAM SYNC
+# ==========================
+async def publish_cache_entry(redis, identifier: str, photo: str, encoding):
+    await redis.xadd(
+        CACHE_STREAM_KEY,
+        {
+            "op": "set",
+            "identifier": identifier,
+            "photo": photo or "",
+            "encoding": json.dumps([float(x) for x in encoding]),
+        },
+        maxlen=CACHE_STREAM_MAXLEN,
+        approximate=True,
+    )
+
+
+async def publish_cache_invalidation(redis, identifier: str = None):
+    # Re-enrolled identities drop their row everywhere; no identifier clears every cache
+    fields = {"op": "delete", "identifier": identifier} if identifier else {"op": "clear"}
+    await redis.xadd(CACHE_STREAM_KEY, fields, maxlen=CACHE_STREAM_MAXLEN, approximate=True)
+
+
+def apply_cache_entry(cache: FaceCache, entry_id: str, fields: dict):
+    # Stream ids are "<ms>-<seq>", so every worker derives the same expiry
+    created_at = int(entry_id.split("-")[0]) / 1000.0
+    op = fields.get("op", "set")
+    if op == "set":
+        cache.put(fields["identifier"], fields.get("photo"), json.loads(fields["encoding"]), created_at)
+    elif op == "delete":
+        cache.delete(fields["identifier"])
+    elif op == "clear":
+        cache.clear()
+
+
+async def follow_cache_stream(redis, cache: FaceCache):
+    # Replay only the window that can still be alive, then tail new entries
+    last_id = f"{int((time.time() - cache.ttl_seconds) * 1000)}-0"
+    while True:
+        try:
+            response = await redis.xread(
+                {CACHE_STREAM_KEY: last_id},
+                count=1000,
+                block=CACHE_STREAM_BLOCK_MS,
+            )
+            for _, entries in response or []:
+                for entry_id, fields in entries:
+                    apply_cache_entry(cache, entry_id, fields)
+                    last_id = entry_id
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Cache stream sync failed: {e}")
+            await asyncio.sleep(1)
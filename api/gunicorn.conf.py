@@ -0,0 +1,20 @@
+import os
+import shutil
+from prometheus_client import multiprocess
+
+# =========================
+# PROMETHEUS MULTIPROCESS
+# =========================
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+def on_starting(server):
+    # Master, before any worker: values left by the previous container run would
+    # otherwise stay in the aggregate
+    if PROMETHEUS_MULTIPROC_DIR:
+        shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+        os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+def child_exit(server, worker):
+    # Drops the live gauges (face_api_in_flight_requests) of a dead or restarted worker
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(worker.pid)
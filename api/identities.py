@@ -0,0 +1,207 @@
+import os
+import time
+import uuid
+from collections import defaultdict
+from typing import Iterable, List, Set
+import numpy as np
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import (
+    Filter, FieldCondition, MatchAny, MatchValue, PointStruct, PointIdsList, QueryRequest
+)
+
+from qdrant import (
+    COLLECTION_NAME, search_params, alias_target, create_versioned_collection, swap_alias, ensure_payload_indexes
+)
+
+# =========================
+# ENV CONFIG
+# =========================
+# One centroid per person, always searched first; kept in RAM whatever the samples profile is
+CENTROID_COLLECTION = os.getenv("CENTROID_COLLECTION", f"{COLLECTION_NAME}_centroids")
+CENTROID_PROFILE = os.getenv("CENTROID_PROFILE", "default")
+# two_stage: centroids, then that shortlist's samples | flat: every sample (pre-centroid behaviour)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "two_stage")
+CENTROID_SEARCH_LIMIT = int(os.getenv("CENTROID_SEARCH_LIMIT", 5))
+# A person's samples spread around the centroid, so its shortlist threshold is looser
+CENTROID_THRESHOLD_MARGIN = float(os.getenv("CENTROID_THRESHOLD_MARGIN", 0.1))
+MAX_SAMPLES_PER_IDENTITY = int(os.getenv("MAX_SAMPLES_PER_IDENTITY", 10))
+
+IDENTITY_NAMESPACE = uuid.UUID("5f0c3a8e-2d4b-4c61-9a57-8e1f4b2c7d90")
+
+def identity_id(identifier: str) -> str:
+    # Stable id shared by the centroid point and every sample of the person
+    return str(uuid.uuid5(IDENTITY_NAMESPACE, identifier))
+
+def sample_payload(identifier: str, **fields) -> dict:
+    return {"identifier": identifier, "identity_id": identity_id(identifier), "enrolled_at": time.time(), **fields}
+
+def init_centroid_collection(client: QdrantClient):
+    existing = [c.name for c in client.get_collections().collections]
+    if CENTROID_COLLECTION in existing or alias_target(client, CENTROID_COLLECTION):
+        ensure_payload_indexes(client, CENTROID_COLLECTION)
+        return
+    name = create_versioned_collection(client, alias=CENTROID_COLLECTION, profile=CENTROID_PROFILE)
+    swap_alias(client, alias=CENTROID_COLLECTION, collection_name=name)
+
+def reset_centroid_collection(client: QdrantClient):
+    previous = alias_target(client, CENTROID_COLLECTION)
+    name = create_versioned_collection(client, alias=CENTROID_COLLECTION, profile=CENTROID_PROFILE)
+    if previous is None and CENTROID_COLLECTION in [c.name for c in client.get_collections().collections]:
+        client.delete_collection(CENTROID_COLLECTION)
+    swap_alias(client, alias=CENTROID_COLLECTION, collection_name=name)
+    if previous:
+        client.delete_collection(previous)
+
+# =========================
+# CENTROIDS
+# =========================
+def fetch_samples(client: QdrantClient, identity_ids: List[str]) -> dict:
+    samples = defaultdict(list)
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            scroll_filter=Filter(must=[FieldCondition(key="identity_id", match=MatchAny(any=identity_ids))]),
+            limit=1000,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        for point in points:
+            samples[point.payload["identity_id"]].append(point)
+        if offset is None:
+            return samples
+
+def refresh_centroids(client: QdrantClient, identifiers: Iterable[str]) -> Set[str]:
+    # Recomputed from the stored samples, so concurrent enrollments converge. Samples beyond
+    # MAX_SAMPLES_PER_IDENTITY are deleted; returns their photo_ids no other sample uses,
+    # for the caller to remove from the photo store
+    identity_ids = {identity_id(identifier): identifier for identifier in identifiers}
+    if not identity_ids:
+        return set()
+
+    samples = fetch_samples(client, list(identity_ids))
+    centroids = []
+    stale = []
+    stale_photos = set()
+    for key, identifier in identity_ids.items():
+        points = sorted(samples.get(key, []), key=lambda point: point.payload.get("enrolled_at", 0), reverse=True)
+        # Keep the newest samples only
+        for point in points[MAX_SAMPLES_PER_IDENTITY:]:
+            stale.append(point.id)
+            if point.payload.get("photo_id"):
+                stale_photos.add(point.payload["photo_id"])
+        points = points[:MAX_SAMPLES_PER_IDENTITY]
+        if not points:
+            client.delete(collection_name=CENTROID_COLLECTION, points_selector=PointIdsList(points=[key]))
+            continue
+
+        vectors = np.asarray([point.vector for point in points], dtype=np.float64)
+        newest = points[0].payload
+        centroids.append(PointStruct(
+            id=key,
+            vector=vectors.mean(axis=0).tolist(),
+            payload={
+                "identifier": identifier,
+                "identity_id": key,
+                "photo": newest.get("photo"),
+                "photo_id": newest.get("photo_id"),
+                "samples": len(points),
+            }
+        ))
+
+    if stale:
+        client.delete(collection_name=COLLECTION_NAME, points_selector=PointIdsList(points=stale), wait=True)
+    if centroids:
+        client.upsert(collection_name=CENTROID_COLLECTION, points=centroids)
+    return unreferenced_photos(client, stale_photos)
+
+def unreferenced_photos(client: QdrantClient, photo_ids: Iterable[str]) -> Set[str]:
+    # Content-addressed photos can be shared between samples and people: exact count per photo
+    return {
+        photo_id for photo_id in photo_ids
+        if not client.count(
+            collection_name=COLLECTION_NAME,
+            count_filter=Filter(must=[FieldCondition(key="photo_id", match=MatchValue(value=photo_id))]),
+            exact=True
+        ).count
+    }
+
+def delete_centroid(client: QdrantClient, identifier: str):
+    client.delete(collection_name=CENTROID_COLLECTION, points_selector=PointIdsList(points=[identity_id(identifier)]))
+
+# =========================
+# SEARCH
+# =========================
+def best_per_identity(points, top_k: int) -> list:
+    # Points arrive sorted by distance; keep each person's closest sample
+    seen = set()
+    best = []
+    for point in points:
+        key = point.payload.get("identity_id") or point.payload.get("identifier")
+        if key not in seen:
+            seen.add(key)
+            best.append(point)
+    return best[:top_k]
+
+def flat_requests(encodings: list, top_k: int, threshold: float) -> list:
+    return [
+        QueryRequest(
+            query=list(map(float, encoding)), limit=top_k, score_threshold=threshold,
+            params=search_params(), with_payload=True, with_vector=False
+        )
+        for encoding in encodings
+    ]
+
+def shortlist_requests(encodings: list, top_k: int, threshold: float) -> list:
+    # Stage 1: shortlist people by centroid distance
+    return [
+        QueryRequest(
+            query=list(map(float, encoding)), limit=max(CENTROID_SEARCH_LIMIT, top_k),
+            score_threshold=threshold + CENTROID_THRESHOLD_MARGIN,
+            with_payload=["identity_id"], with_vector=False
+        )
+        for encoding in encodings
+    ]
+
+def rerank_requests(encodings: list, shortlists, threshold: float):
+    # Stage 2: re-rank only the shortlisted people's samples
+    pending = [(index, [point.id for point in shortlist.points]) for index, shortlist in enumerate(shortlists)]
+    pending = [(index, ids) for index, ids in pending if ids]
+    requests = [
+        QueryRequest(
+            query=list(map(float, encodings[index])),
+            filter=Filter(must=[FieldCondition(key="identity_id", match=MatchAny(any=[str(i) for i in ids]))]),
+            limit=len(ids) * MAX_SAMPLES_PER_IDENTITY,
+            score_threshold=threshold,
+            params=search_params(),
+            with_payload=True,
+            with_vector=False
+        )
+        for index, ids in pending
+    ]
+    return pending, requests
+
+async def search_identities_batch(client: AsyncQdrantClient, encodings: list, top_k: int, threshold: float) -> list:
+    """k nearest people for each encoding, as lists of their closest sample points."""
+    if not encodings:
+        return []
+
+    if SEARCH_MODE != "two_stage":
+        results = await client.query_batch_points(
+            collection_name=COLLECTION_NAME, requests=flat_requests(encodings, top_k, threshold)
+        )
+        return [result.points for result in results]
+
+    shortlists = await client.query_batch_points(
+        collection_name=CENTROID_COLLECTION, requests=shortlist_requests(encodings, top_k, threshold)
+    )
+    pending, requests = rerank_requests(encodings, shortlists, threshold)
+    results = [[] for _ in encodings]
+    if not pending:
+        return results
+
+    reranked = await client.query_batch_points(collection_name=COLLECTION_NAME, requests=requests)
+    for (index, _), result in zip(pending, reranked):
+        results[index] = best_per_identity(result.points, top_k)
+    return results
@@ -1,15 +1,33 @@
 import os
+import time
 import asyncio
 import aio_pika
 import aioredis
 from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from routes.upload import router as upload_router
 from routes.recognition import router as recognition_router
 from routes.stats import router as stats_router
 from routes.users import router as users_router
 from routes.reset import router as reset_router
-from qdrant import init_qdrant_collection
+from routes.jobs import router as jobs_router
+from routes.websocket import router as websocket_router
+from routes.photos import router as photos_router
+from routes.dead_letters import router as dead_letters_router
+from routes.video import router as video_router
+from routes.health import router as health_router
+from results import ResultBroker
+from face_cache import FaceCache, follow_cache_stream
+from dedup import SingleFlight
+from metrics import build_metrics_app, metrics_middleware
+from qdrant import init_qdrant_collection, qdrant_client, get_async_qdrant_client, close_async_qdrant_client
+from publisher import ChannelPool
+from identities import init_centroid_collection
+from utils import DEAD_LETTER_QUEUE, VIDEO_QUEUE, JOB_LANES, lane_queue
+from admission import QueueDepths
+from detection import warmup
+from startup import with_backoff
 from urllib.parse import quote_plus
 
 app = FastAPI(
@@ -23,6 +41,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.middleware("http")(metrics_middleware)
+app.mount("/metrics", build_metrics_app())
 
 # =========================
 # ENV CONFIG
@@ -32,8 +52,14 @@ REDIS_PORT = os.getenv("REDIS_PORT", "6379")
 REDIS_URL = (
     f"redis://{REDIS_HOST}:{REDIS_PORT}"
 )
-QUEUE_NAME = os.getenv("QUEUE_NAME", "face_recognition_jobs")
+# One pool per API process; the result subscriber and the cache stream each hold a connection
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+# Seconds a request waits for a free connection before failing
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
+VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 128))
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
 RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", "5672")
 RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
@@ -46,41 +72,109 @@ RABBITMQ_URL = (
 # =========================
 # STARTUP
 # =========================
+async def connect_rabbitmq():
+    connection = await aio_pika.connect_robust(RABBITMQ_URL)
+    try:
+        channel = await connection.channel()
+        for lane in JOB_LANES:
+            await channel.declare_queue(lane_queue(lane), durable=True)
+        await channel.declare_queue(VIDEO_QUEUE, durable=True)
+        await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+        publisher = ChannelPool(connection)
+        await publisher.start()
+        # Own channel: a failed passive declare closes its channel, never the publishing one
+        queue_depths = QueueDepths(await connection.channel())
+    except Exception:
+        await connection.close()
+        raise
+    app.state.rabbitmq_connection = connection
+    app.state.rabbitmq_channel = channel
+    app.state.publisher = publisher
+    app.state.queue_depths = queue_depths
+
+async def connect_redis():
+    redis_pool = aioredis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT, decode_responses=True
+    )
+    redis_async = aioredis.Redis(connection_pool=redis_pool)
+    try:
+        await redis_async.ping()
+    except Exception:
+        await redis_pool.disconnect()
+        raise
+    app.state.redis_pool = redis_pool
+    app.state.redis_async = redis_async
+
+async def connect_qdrant():
+    await run_in_threadpool(init_qdrant_collection)
+    await run_in_threadpool(init_centroid_collection, qdrant_client)
+    get_async_qdrant_client()
+
+async def warm_up_models():
+    # dlib models load here, off the event loop and alongside the connections; /readyz waits for it
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(warmup)
+        app.state.models_ready = True
+        print(f"Models warmed up in {time.perf_counter() - started:.2f}s")
+    except Exception as e:
+        print(f"Model warmup failed: {e}")
+
 @app.on_event("startup")
 async def startup_event():
-    for i in range(10):
-        try:
-            connection = await aio_pika.connect_robust(RABBITMQ_URL)
-            channel = await connection.channel()
-            await channel.declare_queue(QUEUE_NAME, durable=True)
-            app.state.rabbitmq_connection = connection
-            app.state.rabbitmq_channel = channel
-            print("Connected to RabbitMQ successfully")
-            break
-        except Exception as e:
-            print(f"RabbitMQ not ready, retry {i+1}/10... Error: {e}")
-            await asyncio.sleep(3)
-    else:
-        raise RuntimeError("Cannot connect to RabbitMQ after multiple attempts")
-
-    redis_async = await aioredis.from_url(REDIS_URL, decode_responses=True)
-    app.state.redis_async = redis_async
+    app.state.models_ready = False
+    app.state.warmup_task = asyncio.create_task(warm_up_models())
 
-    init_qdrant_collection()
+    # All dependencies at once, each with its own backoff: startup takes as long as the slowest
+    await asyncio.gather(
+        with_backoff("RabbitMQ", connect_rabbitmq),
+        with_backoff("Redis", connect_redis),
+        with_backoff("Qdrant", connect_qdrant),
+    )
+
+    redis_async = app.state.redis_async
+    result_broker = ResultBroker(redis_async)
+    await result_broker.start()
+    app.state.result_broker = result_broker
+    app.state.single_flight = SingleFlight(redis_async, result_broker)
+
+    # Same recognition cache as the workers, kept in sync through the Redis stream
+    face_cache = FaceCache(dim=VECTOR_SIZE, capacity=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+    app.state.face_cache = face_cache
+    app.state.cache_sync_task = asyncio.create_task(follow_cache_stream(redis_async, face_cache))
 
 # =========================
 # SHUTDOWN
 # =========================
 @app.on_event("shutdown")
 async def shutdown_event():
+    publisher = getattr(app.state, "publisher", None)
+    if publisher:
+        await publisher.close()
+
     connection = getattr(app.state, "rabbitmq_connection", None)
     if connection and not connection.is_closed:
         await connection.close()
 
+    for task_name in ("cache_sync_task", "warmup_task"):
+        task = getattr(app.state, task_name, None)
+        if task:
+            task.cancel()
+
+    result_broker = getattr(app.state, "result_broker", None)
+    if result_broker:
+        await result_broker.stop()
+
     redis = getattr(app.state, "redis_async", None)
     if redis:
         await redis.close()
 
+    redis_pool = getattr(app.state, "redis_pool", None)
+    if redis_pool:
+        await redis_pool.disconnect()
+
+    await close_async_qdrant_client()
+
 # =========================
 # ROUTES
 # =========================
@@ -89,3 +183,9 @@ app.include_router(recognition_router, tags=["Recognition"])
 app.include_router(stats_router, tags=["Stats"])
 app.include_router(users_router, tags=["Users"])
 app.include_router(reset_router, tags=["Reset"])
+app.include_router(jobs_router, tags=["Jobs"])
+app.include_router(websocket_router, tags=["WebSocket"])
+app.include_router(photos_router, tags=["Photos"])
+app.include_router(dead_letters_router, tags=["Dead letters"])
+app.include_router(video_router, tags=["Video"])
+app.include_router(health_router, tags=["Health"])
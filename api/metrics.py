@@ -0,0 +1,80 @@
+import os
+import time
+from fastapi import Request
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, make_asgi_app, multiprocess
+)
+
+# =========================
+# METRICS
+# =========================
+# Stage latencies span sub-millisecond cache hits to multi-second CNN detection
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+STAGE_LATENCY = Histogram(
+    "face_api_stage_seconds",
+    "Latency of each stage of the recognition and upload endpoints",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+REQUEST_LATENCY = Histogram(
+    "face_api_request_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    "face_api_in_flight_requests",
+    "HTTP requests currently being served",
+    multiprocess_mode="livesum"
+)
+JOBS_PUBLISHED = Counter(
+    "face_api_jobs_published_total",
+    "Async recognition jobs published to RabbitMQ",
+    ["payload_type"]
+)
+CACHE_LOOKUPS = Counter(
+    "face_api_cache_lookups_total",
+    "Recognition cache lookups in the sync path",
+    ["result"]
+)
+DEDUP_HITS = Counter(
+    "face_api_dedup_hits_total",
+    "Uploads answered from an identical earlier or in-flight request",
+    ["endpoint", "source"]
+)
+ADMISSION_REJECTED = Counter(
+    "face_api_admission_rejected_total",
+    "Async jobs turned away with a 429 because the queues were backed up",
+    ["lane", "reason"]
+)
+
+# =========================
+# EXPOSITION
+# =========================
+def build_metrics_app():
+    # Gunicorn runs several workers: aggregate them when PROMETHEUS_MULTIPROC_DIR is set
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return make_asgi_app(registry=registry)
+    return make_asgi_app(registry=REGISTRY)
+
+async def metrics_middleware(request: Request, call_next):
+    IN_FLIGHT_REQUESTS.inc()
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        IN_FLIGHT_REQUESTS.dec()
+        # Label by route template, not raw path, to keep cardinality bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        if path != "/metrics":
+            REQUEST_LATENCY.labels(request.method, path, str(status)).observe(time.perf_counter() - started)
@@ -0,0 +1,150 @@
+"""Rebuild the faces collection under a new profile without downtime.
+
+Copies every point into a new "<name>_v<N>" collection created with the
+requested profile, then points the COLLECTION_NAME alias at it. Reads keep
+hitting the old collection until the swap:
+
+    python migrate_collection.py --profile scalar
+    python migrate_collection.py --profile product --defer-indexing
+
+Points enrolled while the copy runs are picked up by a catch-up pass before
+the old collection is dropped, and points deleted from it meanwhile (DELETE
+/users, sample trimming) are pruned from the new one before the swap. Do not
+run DELETE /reset/ during a migration: it swaps the alias itself. A plain (pre-alias) collection has to be
+deleted before the alias can take its name, so that one swap leaves a gap of
+a few milliseconds.
+"""
+import argparse
+import time
+from qdrant_client.models import OptimizersConfigDiff, PointStruct, PointIdsList
+
+from qdrant import (
+    qdrant_client, COLLECTION_NAME, COLLECTION_PROFILES,
+    alias_target, create_versioned_collection, swap_alias
+)
+
+
+def to_points(records) -> list:
+    return [PointStruct(id=record.id, vector=record.vector, payload=record.payload) for record in records]
+
+
+def copy_points(client, source: str, target: str, batch_size: int) -> int:
+    copied = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=source,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        if records:
+            client.upsert(collection_name=target, points=to_points(records), wait=True)
+            copied += len(records)
+            print(f"Copied {copied} points")
+        if offset is None:
+            return copied
+
+
+def catch_up(client, source: str, target: str, batch_size: int) -> int:
+    # Copy ids that reached the source after the first pass; ids are never reused
+    copied = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=source,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False
+        )
+        ids = [record.id for record in records]
+        present = {record.id for record in client.retrieve(target, ids=ids, with_payload=False)} if ids else set()
+        missing = [point_id for point_id in ids if point_id not in present]
+        if missing:
+            client.upsert(
+                collection_name=target,
+                points=to_points(client.retrieve(source, ids=missing, with_payload=True, with_vectors=True)),
+                wait=True
+            )
+            copied += len(missing)
+        if offset is None:
+            return copied
+
+
+def prune(client, source: str, target: str, batch_size: int) -> int:
+    # Drop target ids deleted from the source since they were copied; only valid before the
+    # swap, after it new enrollments land on the target alone
+    pruned = 0
+    offset = None
+    while True:
+        records, offset = client.scroll(
+            collection_name=target,
+            limit=batch_size,
+            offset=offset,
+            with_payload=False,
+            with_vectors=False
+        )
+        ids = [record.id for record in records]
+        present = {record.id for record in client.retrieve(source, ids=ids, with_payload=False)} if ids else set()
+        deleted = [point_id for point_id in ids if point_id not in present]
+        if deleted:
+            client.delete(collection_name=target, points_selector=PointIdsList(points=deleted), wait=True)
+            pruned += len(deleted)
+        if offset is None:
+            return pruned
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-create the faces collection under a new profile.")
+    parser.add_argument("--profile", required=True, choices=list(COLLECTION_PROFILES))
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--defer-indexing", action="store_true",
+                        help="build the HNSW graph once after the copy instead of while upserting")
+    parser.add_argument("--indexing-threshold", type=int, default=20000,
+                        help="indexing threshold (KB) restored after a deferred copy")
+    parser.add_argument("--keep-old", action="store_true", help="keep the previous collection after the swap")
+    args = parser.parse_args()
+
+    client = qdrant_client
+    source = alias_target(client)
+    legacy = source is None
+    if legacy:
+        existing = [c.name for c in client.get_collections().collections]
+        if COLLECTION_NAME not in existing:
+            raise SystemExit(f"Collection '{COLLECTION_NAME}' not found")
+        source = COLLECTION_NAME
+
+    target = create_versioned_collection(client, profile=args.profile)
+    print(f"Migrating '{source}' -> '{target}' with profile '{args.profile}'")
+
+    started = time.time()
+    if args.defer_indexing:
+        client.update_collection(target, optimizers_config=OptimizersConfigDiff(indexing_threshold=0))
+    copied = copy_points(client, source, target, args.batch_size)
+    if args.defer_indexing:
+        client.update_collection(
+            target, optimizers_config=OptimizersConfigDiff(indexing_threshold=args.indexing_threshold)
+        )
+    copied += catch_up(client, source, target, args.batch_size)
+    pruned = prune(client, source, target, args.batch_size)
+
+    if legacy:
+        client.delete_collection(COLLECTION_NAME)
+        swap_alias(client, collection_name=target)
+    else:
+        swap_alias(client, collection_name=target)
+        # Enrollments that landed on the old collection during the swap itself
+        copied += catch_up(client, source, target, args.batch_size)
+        if not args.keep_old:
+            client.delete_collection(source)
+
+    print(
+        f"Alias '{COLLECTION_NAME}' -> '{target}': {copied} points copied, {pruned} deleted meanwhile "
+        f"pruned, in {time.time() - started:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
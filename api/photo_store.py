@@ -0,0 +1,215 @@
+import io
+import os
+import hashlib
+import itertools
+from typing import Dict, Optional, Tuple
+from PIL import Image
+from fastapi.concurrency import run_in_threadpool
+
+# =========================
+# ENV CONFIG
+# =========================
+PHOTO_STORE = os.getenv("PHOTO_STORE", "local")
+FOTOS_DIR = os.path.abspath(os.getenv("FOTOS_DIR", "system/photos"))
+PHOTO_BASE_URL = os.getenv("PHOTO_BASE_URL", "/photos")
+PHOTO_JPEG_QUALITY = int(os.getenv("PHOTO_JPEG_QUALITY", 90))
+PHOTO_THUMB_SIZE = int(os.getenv("PHOTO_THUMB_SIZE", 160))
+PHOTO_DELETE_BATCH_SIZE = int(os.getenv("PHOTO_DELETE_BATCH_SIZE", 500))
+
+S3_BUCKET = os.getenv("S3_BUCKET", "faces")
+S3_PREFIX = os.getenv("S3_PREFIX", "photos/")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # MinIO or any S3-compatible stand-in
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+
+# "full" is the enrollment image at working resolution, "thumb" what results link to
+VARIANTS = ("full", "thumb")
+
+# =========================
+# VARIANTS
+# =========================
+def render_variants(pil_image: Image.Image) -> Tuple[str, Dict[str, bytes]]:
+    # CPU only, safe to run in a process pool. The id is the hash of the full JPEG,
+    # so re-uploading the same photo maps to the same files
+    full = io.BytesIO()
+    pil_image.save(full, format="JPEG", quality=PHOTO_JPEG_QUALITY)
+
+    thumb_image = pil_image.copy()
+    thumb_image.thumbnail((PHOTO_THUMB_SIZE, PHOTO_THUMB_SIZE), Image.LANCZOS)
+    thumb = io.BytesIO()
+    thumb_image.save(thumb, format="JPEG", quality=PHOTO_JPEG_QUALITY)
+
+    photo_id = hashlib.sha256(full.getvalue()).hexdigest()
+    return photo_id, {"full": full.getvalue(), "thumb": thumb.getvalue()}
+
+def file_name(photo_id: str, variant: str) -> str:
+    return f"{photo_id}_{variant}.jpg"
+
+def photo_url(photo_id: str, variant: str = "thumb") -> str:
+    return f"{PHOTO_BASE_URL}/{file_name(photo_id, variant)}"
+
+def valid_name(name: str) -> bool:
+    photo_id, _, rest = name.partition("_")
+    return len(photo_id) == 64 and all(c in "0123456789abcdef" for c in photo_id) and rest in (
+        f"{variant}.jpg" for variant in VARIANTS
+    )
+
+# =========================
+# BACKENDS
+# =========================
+class LocalPhotoStore:
+    def __init__(self, root: str = FOTOS_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def _write(self, variants: Dict[str, bytes], photo_id: str):
+        for variant, data in variants.items():
+            path = self.path(file_name(photo_id, variant))
+            if os.path.exists(path):
+                # Same content already stored: refresh it so a running purge keeps it
+                os.utime(path)
+                continue
+            # Write then rename, so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+    async def put(self, photo_id: str, variants: Dict[str, bytes]):
+        await run_in_threadpool(self._write, variants, photo_id)
+
+    async def get(self, name: str) -> Optional[bytes]:
+        def read():
+            try:
+                with open(self.path(name), "rb") as f:
+                    return f.read()
+            except FileNotFoundError:
+                return None
+        return await run_in_threadpool(read)
+
+    async def delete(self, photo_id: str):
+        def remove():
+            for variant in VARIANTS:
+                try:
+                    os.unlink(self.path(file_name(photo_id, variant)))
+                except FileNotFoundError:
+                    pass
+        await run_in_threadpool(remove)
+
+    def _delete_batch(self, entries: list, older_than: float) -> Tuple[int, int]:
+        deleted = errors = 0
+        for entry in entries:
+            try:
+                # Photos written after the cutoff belong to newer enrollments
+                if entry.is_file() and entry.stat().st_mtime <= older_than:
+                    os.unlink(entry.path)
+                    deleted += 1
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"Could not delete {entry.path}: {e}")
+                errors += 1
+        return deleted, errors
+
+    async def purge(self, older_than: float):
+        # Yields running (deleted, errors) totals, one batch at a time
+        deleted = errors = 0
+        with os.scandir(self.root) as entries:
+            while True:
+                batch = await run_in_threadpool(list, itertools.islice(entries, PHOTO_DELETE_BATCH_SIZE))
+                if not batch:
+                    break
+                batch_deleted, batch_errors = await run_in_threadpool(self._delete_batch, batch, older_than)
+                deleted += batch_deleted
+                errors += batch_errors
+                yield deleted, errors
+
+
+class S3PhotoStore:
+    def __init__(self, bucket: str = S3_BUCKET, prefix: str = S3_PREFIX):
+        import boto3
+        self.client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def key(self, name: str) -> str:
+        return f"{self.prefix}{name}"
+
+    def _exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+
+    def _write(self, variants: Dict[str, bytes], photo_id: str):
+        for variant, data in variants.items():
+            key = self.key(file_name(photo_id, variant))
+            if self._exists(key):
+                # Same content already stored: an in-place copy bumps LastModified past a running purge
+                self.client.copy_object(
+                    Bucket=self.bucket, Key=key, CopySource={"Bucket": self.bucket, "Key": key},
+                    MetadataDirective="REPLACE", ContentType="image/jpeg"
+                )
+            else:
+                self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType="image/jpeg")
+
+    async def put(self, photo_id: str, variants: Dict[str, bytes]):
+        await run_in_threadpool(self._write, variants, photo_id)
+
+    async def get(self, name: str) -> Optional[bytes]:
+        def read():
+            try:
+                return self.client.get_object(Bucket=self.bucket, Key=self.key(name))["Body"].read()
+            except self.client.exceptions.NoSuchKey:
+                return None
+        return await run_in_threadpool(read)
+
+    async def delete(self, photo_id: str):
+        await run_in_threadpool(
+            self.client.delete_objects,
+            Bucket=self.bucket,
+            Delete={"Objects": [{"Key": self.key(file_name(photo_id, variant))} for variant in VARIANTS]}
+        )
+
+    async def purge(self, older_than: float):
+        deleted = errors = 0
+        paginator = self.client.get_paginator("list_objects_v2")
+        pages = iter(paginator.paginate(Bucket=self.bucket, Prefix=self.prefix))
+        while True:
+            page = await run_in_threadpool(next, pages, None)
+            if page is None:
+                break
+            keys = [
+                {"Key": item["Key"]} for item in page.get("Contents", [])
+                if item["LastModified"].timestamp() <= older_than
+            ]
+            if keys:
+                response = await run_in_threadpool(
+                    self.client.delete_objects, Bucket=self.bucket, Delete={"Objects": keys, "Quiet": True}
+                )
+                errors += len(response.get("Errors", []))
+                deleted += len(keys) - len(response.get("Errors", []))
+            yield deleted, errors
+
+
+_photo_store = None
+
+def get_photo_store():
+    global _photo_store
+    if _photo_store is None:
+        _photo_store = S3PhotoStore() if PHOTO_STORE == "s3" else LocalPhotoStore()
+    return _photo_store
+
+async def save_photo(store, photo_id: str, variants: Dict[str, bytes]) -> dict:
+    # Payload fields stored with the point: results carry the thumbnail URL only
+    await store.put(photo_id, variants)
+    return {"photo": photo_url(photo_id), "photo_id": photo_id}
+
+async def delete_photos(store, photo_ids) -> int:
+    # Callers pass only photo_ids no sample references any more
+    for photo_id in photo_ids:
+        await store.delete(photo_id)
+    return len(photo_ids)
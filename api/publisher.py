@@ -0,0 +1,41 @@
+import os
+import itertools
+from aio_pika import Message
+
+# =========================
+# ENV CONFIG
+# =========================
+RABBITMQ_CHANNEL_POOL_SIZE = int(os.getenv("RABBITMQ_CHANNEL_POOL_SIZE", 4))
+# Seconds to wait for the broker to confirm a publish before the request fails
+RABBITMQ_CONFIRM_TIMEOUT = float(os.getenv("RABBITMQ_CONFIRM_TIMEOUT", 5))
+
+# =========================
+# CHANNEL POOL
+# =========================
+class ChannelPool:
+    """Publisher-confirm channels shared by every request of an API process.
+
+    Requests are spread round-robin and never hold a channel exclusively: the
+    publishes in flight on a channel are confirmed together by the broker's
+    multiple-acks instead of costing a round-trip each.
+    """
+
+    def __init__(self, connection, size: int = RABBITMQ_CHANNEL_POOL_SIZE):
+        self.connection = connection
+        self.size = size
+        self.channels = []
+        self.cycle = None
+
+    async def start(self):
+        self.channels = [await self.connection.channel(publisher_confirms=True) for _ in range(self.size)]
+        self.cycle = itertools.cycle(self.channels)
+
+    async def publish(self, message: Message, routing_key: str):
+        # Returns once the broker has confirmed the message
+        channel = next(self.cycle)
+        await channel.default_exchange.publish(message, routing_key=routing_key, timeout=RABBITMQ_CONFIRM_TIMEOUT)
+
+    async def close(self):
+        for channel in self.channels:
+            if not channel.is_closed:
+                await channel.close()
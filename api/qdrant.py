@@ -1,29 +1,198 @@
 import os
-from qdrant_client import QdrantClient
-from qdrant_client.models import VectorParams, Distance
+import re
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import (
+    VectorParams, Distance, HnswConfigDiff, SearchParams, QuantizationSearchParams,
+    ScalarQuantization, ScalarQuantizationConfig, ScalarType,
+    ProductQuantization, ProductQuantizationConfig, CompressionRatio,
+    CreateAliasOperation, CreateAlias, DeleteAliasOperation, DeleteAlias,
+    TextIndexParams, TextIndexType, TokenizerType, PayloadSchemaType
+)
 
 # =========================
 # ENV CONFIG
 # =========================
 QDRANT_HOST = os.getenv("QDRANT_HOST", "qdrant")
 QDRANT_PORT = int(os.getenv("QDRANT_PORT", 6333))
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+# Searches and listings go over gRPC; setup, migrations and admin paths keep the REST client
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
 VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 128))
 DISTANCE_METRIC = os.getenv("DISTANCE_METRIC", "EUCLID")
 
+# =========================
+# COLLECTION PROFILES
+# =========================
+# default: float32 vectors in RAM, Qdrant's default HNSW
+# scalar:  int8 copy in RAM (~4x smaller), originals used to rescore
+# product: PQ copy in RAM (~16x smaller), original vectors and graph on disk
+COLLECTION_PROFILES = {
+    "default": {"quantization": "none", "on_disk": False, "hnsw_m": 16, "hnsw_ef_construct": 100},
+    "scalar": {"quantization": "scalar", "on_disk": False, "hnsw_m": 16, "hnsw_ef_construct": 128},
+    "product": {"quantization": "product", "on_disk": True, "hnsw_m": 32, "hnsw_ef_construct": 256},
+}
+COLLECTION_PROFILE = os.getenv("COLLECTION_PROFILE", "default")
+
+# Per-setting overrides on top of the profile
+QUANTIZATION = os.getenv("QUANTIZATION")
+VECTORS_ON_DISK = os.getenv("VECTORS_ON_DISK")
+HNSW_M = os.getenv("HNSW_M")
+HNSW_EF_CONSTRUCT = os.getenv("HNSW_EF_CONSTRUCT")
+PQ_COMPRESSION = os.getenv("PQ_COMPRESSION", "x16")
+SCALAR_QUANTILE = float(os.getenv("SCALAR_QUANTILE", 0.99))
+
+# Search-time settings
+SEARCH_HNSW_EF = int(os.getenv("SEARCH_HNSW_EF", 0))
+QUANTIZATION_RESCORE = os.getenv("QUANTIZATION_RESCORE", "true").lower() == "true"
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", 2.0))
+
 qdrant_client = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
 
-def init_qdrant_collection():
-    collections = qdrant_client.get_collections()
-    existing = [c.name for c in collections.collections]
-    if COLLECTION_NAME not in existing:
-        qdrant_client.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=VectorParams(
-                size=VECTOR_SIZE,
-                distance=Distance[DISTANCE_METRIC]
-            )
+def resolve_profile(profile: str = None) -> dict:
+    name = profile or COLLECTION_PROFILE
+    if name not in COLLECTION_PROFILES:
+        raise ValueError(f"Unknown collection profile '{name}', expected one of {list(COLLECTION_PROFILES)}")
+
+    settings = dict(COLLECTION_PROFILES[name])
+    if profile is None:
+        if QUANTIZATION:
+            settings["quantization"] = QUANTIZATION
+        if VECTORS_ON_DISK:
+            settings["on_disk"] = VECTORS_ON_DISK.lower() == "true"
+        if HNSW_M:
+            settings["hnsw_m"] = int(HNSW_M)
+        if HNSW_EF_CONSTRUCT:
+            settings["hnsw_ef_construct"] = int(HNSW_EF_CONSTRUCT)
+    return settings
+
+def collection_params(profile: str = None) -> dict:
+    # Keyword arguments for create_collection
+    settings = resolve_profile(profile)
+
+    quantization_config = None
+    if settings["quantization"] == "scalar":
+        quantization_config = ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, quantile=SCALAR_QUANTILE, always_ram=True)
         )
+    elif settings["quantization"] == "product":
+        quantization_config = ProductQuantization(
+            product=ProductQuantizationConfig(compression=CompressionRatio(PQ_COMPRESSION), always_ram=True)
+        )
+    elif settings["quantization"] != "none":
+        raise ValueError(f"Unknown quantization '{settings['quantization']}', expected none, scalar or product")
+
+    return {
+        "vectors_config": VectorParams(
+            size=VECTOR_SIZE,
+            distance=Distance[DISTANCE_METRIC],
+            on_disk=settings["on_disk"]
+        ),
+        "hnsw_config": HnswConfigDiff(
+            m=settings["hnsw_m"],
+            ef_construct=settings["hnsw_ef_construct"],
+            on_disk=settings["on_disk"]
+        ),
+        "quantization_config": quantization_config,
+    }
+
+def search_params() -> SearchParams:
+    # Quantized collections search the compressed copy, then rescore the oversampled top-k
+    return SearchParams(
+        hnsw_ef=SEARCH_HNSW_EF or None,
+        quantization=QuantizationSearchParams(
+            rescore=QUANTIZATION_RESCORE,
+            oversampling=QUANTIZATION_OVERSAMPLING
+        )
+    )
+
+# Prefix-tokenized, lowercased identifier index for /users/?prefix=
+IDENTIFIER_INDEX = TextIndexParams(
+    type=TextIndexType.TEXT,
+    tokenizer=TokenizerType.PREFIX,
+    min_token_len=1,
+    max_token_len=64,
+    lowercase=True
+)
+
+def ensure_payload_indexes(client: QdrantClient = qdrant_client, collection_name: str = COLLECTION_NAME):
+    # Idempotent: re-creating an index with the same schema is a no-op
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="identifier",
+        field_schema=IDENTIFIER_INDEX
+    )
+    # Groups a person's samples for centroid refreshes and the second search stage
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="identity_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+    # Content-addressed photos can be shared; deletes check for other references
+    client.create_payload_index(
+        collection_name=collection_name,
+        field_name="photo_id",
+        field_schema=PayloadSchemaType.KEYWORD
+    )
+
+# =========================
+# VERSIONED COLLECTIONS
+# =========================
+# COLLECTION_NAME is an alias over a physical "<name>_v<N>" collection, so a
+# collection can be rebuilt under a new profile and swapped in atomically.
+def alias_target(client: QdrantClient = qdrant_client, alias: str = COLLECTION_NAME):
+    for description in client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+def next_collection_name(client: QdrantClient = qdrant_client, alias: str = COLLECTION_NAME) -> str:
+    pattern = re.compile(rf"^{re.escape(alias)}_v(\d+)$")
+    versions = [
+        int(match.group(1))
+        for match in (pattern.match(c.name) for c in client.get_collections().collections)
+        if match
+    ]
+    return f"{alias}_v{max(versions, default=0) + 1}"
+
+def create_versioned_collection(client: QdrantClient = qdrant_client, alias: str = COLLECTION_NAME,
+                                profile: str = None) -> str:
+    name = next_collection_name(client, alias)
+    client.create_collection(collection_name=name, **collection_params(profile))
+    ensure_payload_indexes(client, name)
+    return name
+
+def swap_alias(client: QdrantClient = qdrant_client, alias: str = COLLECTION_NAME, collection_name: str = None):
+    operations = []
+    if alias_target(client, alias):
+        operations.append(DeleteAliasOperation(delete_alias=DeleteAlias(alias_name=alias)))
+    operations.append(CreateAliasOperation(create_alias=CreateAlias(collection_name=collection_name, alias_name=alias)))
+    client.update_collection_aliases(change_aliases_operations=operations)
+
+def init_qdrant_collection():
+    existing = [c.name for c in qdrant_client.get_collections().collections]
+    # A plain collection from before aliases is kept as-is until migrated
+    if COLLECTION_NAME in existing or alias_target():
+        ensure_payload_indexes()
+        return
+    swap_alias(collection_name=create_versioned_collection())
 
 def get_qdrant_client() -> QdrantClient:
     return qdrant_client
+
+_async_qdrant_client = None
+
+def get_async_qdrant_client() -> AsyncQdrantClient:
+    # Built on first use, inside the running event loop the gRPC channel belongs to
+    global _async_qdrant_client
+    if _async_qdrant_client is None:
+        _async_qdrant_client = AsyncQdrantClient(
+            host=QDRANT_HOST, port=QDRANT_PORT, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=QDRANT_PREFER_GRPC
+        )
+    return _async_qdrant_client
+
+async def close_async_qdrant_client():
+    global _async_qdrant_client
+    if _async_qdrant_client is not None:
+        await _async_qdrant_client.close()
+        _async_qdrant_client = None
@@ -0,0 +1,74 @@
+"""Rebuild the per-person centroid collection from the stored samples.
+
+Needed once for galleries enrolled before centroids existed (their samples
+get an identity_id), and safe to re-run at any time:
+
+    python rebuild_centroids.py
+
+Each person keeps only their MAX_SAMPLES_PER_IDENTITY newest samples: older
+ones are deleted from the collection, and their photos from the photo store
+unless another sample still uses them. Raise MAX_SAMPLES_PER_IDENTITY first
+to keep a gallery's older enrollments.
+"""
+import asyncio
+import argparse
+from qdrant_client.models import SetPayloadOperation, SetPayload
+
+from qdrant import qdrant_client, COLLECTION_NAME
+from identities import (
+    CENTROID_COLLECTION, MAX_SAMPLES_PER_IDENTITY, identity_id, init_centroid_collection, refresh_centroids
+)
+from photo_store import get_photo_store, delete_photos
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backfill identity ids and rebuild centroids.")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--refresh-batch", type=int, default=256, help="identities per centroid refresh")
+    args = parser.parse_args()
+
+    client = qdrant_client
+    init_centroid_collection(client)
+
+    identifiers = set()
+    backfilled = 0
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=COLLECTION_NAME,
+            limit=args.batch_size,
+            offset=offset,
+            with_payload=["identifier", "identity_id"],
+            with_vectors=False
+        )
+        operations = []
+        for point in points:
+            identifier = (point.payload or {}).get("identifier")
+            if identifier is None:
+                continue
+            identifiers.add(identifier)
+            if point.payload.get("identity_id") is None:
+                operations.append(SetPayloadOperation(set_payload=SetPayload(
+                    payload={"identity_id": identity_id(identifier)}, points=[point.id]
+                )))
+        if operations:
+            client.batch_update_points(collection_name=COLLECTION_NAME, update_operations=operations)
+            backfilled += len(operations)
+        if offset is None:
+            break
+    print(f"{len(identifiers)} identities, {backfilled} samples backfilled")
+
+    ordered = sorted(identifiers)
+    store = get_photo_store()
+    photos_deleted = 0
+    for start in range(0, len(ordered), args.refresh_batch):
+        trimmed_photos = refresh_centroids(client, ordered[start:start + args.refresh_batch])
+        photos_deleted += asyncio.run(delete_photos(store, trimmed_photos))
+        print(f"Centroids refreshed: {min(start + args.refresh_batch, len(ordered))}/{len(ordered)}")
+    print(f"{photos_deleted} photos of samples beyond {MAX_SAMPLES_PER_IDENTITY} per person deleted")
+
+    print(f"'{CENTROID_COLLECTION}' holds {client.count(CENTROID_COLLECTION).count} centroids")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import asyncio
+from typing import Optional
+
+# =========================
+# ENV CONFIG
+# =========================
+RESULT_KEY_PREFIX = os.getenv("RESULT_KEY_PREFIX", "job_result:")
+RESULT_CHANNEL = os.getenv("RESULT_CHANNEL", "face_job_results")
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", 3600))
+
+# =========================
+# RESULT STORE
+# =========================
+async def store_pending(redis, job_id: str):
+    await redis.set(
+        f"{RESULT_KEY_PREFIX}{job_id}",
+        json.dumps({"job_id": job_id, "status": "pending", "submitted_at": time.time()}),
+        ex=RESULT_TTL_SECONDS
+    )
+
+async def get_result(redis, job_id: str) -> Optional[dict]:
+    data = await redis.get(f"{RESULT_KEY_PREFIX}{job_id}")
+    return json.loads(data) if data else None
+
+# =========================
+# PUB/SUB FAN-OUT
+# =========================
+class ResultBroker:
+    """One Redis subscription per API process, fanned out to every waiting client."""
+
+    def __init__(self, redis):
+        self.redis = redis
+        self.waiters = {}
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(RESULT_CHANNEL)
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    result = json.loads(message["data"])
+                    for future in self.waiters.pop(result.get("job_id"), ()):
+                        if not future.done():
+                            future.set_result(result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Result subscriber failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[dict]:
+        # Register before reading the store so a result published in between is not missed
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(job_id, set()).add(future)
+        try:
+            result = await get_result(self.redis, job_id)
+            if result and result.get("status") != "pending":
+                return result
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return await get_result(self.redis, job_id)
+        finally:
+            waiters = self.waiters.get(job_id)
+            if waiters is not None:
+                waiters.discard(future)
+                if not waiters:
+                    self.waiters.pop(job_id, None)
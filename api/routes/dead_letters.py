@@ -0,0 +1,120 @@
+from fastapi import APIRouter, Depends, Query
+from pydantic import BaseModel
+from typing import List, Optional
+from aio_pika import Message, DeliveryMode
+import os
+
+from dependencies import get_redis_async, get_rabbitmq_channel, get_publisher
+from results import store_pending
+from utils import DEAD_LETTER_QUEUE, DEFAULT_LANE, JOB_LANES, job_queue
+
+router = APIRouter()
+
+DEAD_LETTER_PAGE_SIZE = int(os.getenv("DEAD_LETTER_PAGE_SIZE", 50))
+DEAD_LETTER_MAX_PAGE_SIZE = int(os.getenv("DEAD_LETTER_MAX_PAGE_SIZE", 500))
+
+# Set by the worker's retry path; dropped on replay so the job gets a fresh set of retries
+RETRY_HEADERS = ("attempts", "last_error", "failed_at")
+
+class DeadLetter(BaseModel):
+    job_id: Optional[str]
+    lane: Optional[str] = None
+    payload_type: Optional[str] = None
+    attempts: int = 0
+    last_error: Optional[str] = None
+    failed_at: Optional[float] = None
+    submitted_at: Optional[float] = None
+    size: int
+
+class DeadLettersResponse(BaseModel):
+    dead_letters: List[DeadLetter]
+
+class ReplayResponse(BaseModel):
+    replayed: List[Optional[str]]
+
+def header(message, key: str, default=None):
+    value = (message.headers or {}).get(key, default)
+    return value.decode() if isinstance(value, bytes) else value
+
+def to_dead_letter(message) -> DeadLetter:
+    submitted_at = header(message, "submitted_at")
+    failed_at = header(message, "failed_at")
+    return DeadLetter(
+        job_id=header(message, "job_id") or message.message_id,
+        payload_type=header(message, "payload_type"),
+        lane=header(message, "lane"),
+        attempts=int(header(message, "attempts", 0)),
+        last_error=header(message, "last_error"),
+        failed_at=float(failed_at) if failed_at else None,
+        submitted_at=float(submitted_at) if submitted_at else None,
+        size=len(message.body)
+    )
+
+async def take(channel, limit: int) -> list:
+    # Held unacked until the caller settles them, so each get returns the next message
+    queue = await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
+    messages = []
+    while len(messages) < limit:
+        message = await queue.get(no_ack=False, fail=False)
+        if message is None:
+            break
+        messages.append(message)
+    return messages
+
+# ========================
+# Endpoint Dead letters
+# ========================
+@router.get("/dead-letters/", response_model=DeadLettersResponse)
+async def list_dead_letters(
+    limit: int = Query(DEAD_LETTER_PAGE_SIZE, ge=1, le=DEAD_LETTER_MAX_PAGE_SIZE),
+    channel=Depends(get_rabbitmq_channel)
+):
+    messages = await take(channel, limit)
+    try:
+        return DeadLettersResponse(dead_letters=[to_dead_letter(message) for message in messages])
+    finally:
+        # Inspection only: everything goes back to the queue
+        for message in messages:
+            await message.nack(requeue=True)
+
+@router.post("/dead-letters/replay", response_model=ReplayResponse)
+async def replay_dead_letters(
+    limit: int = Query(DEAD_LETTER_PAGE_SIZE, ge=1, le=DEAD_LETTER_MAX_PAGE_SIZE),
+    job_id: Optional[str] = Query(None, description="replay only this job"),
+    channel=Depends(get_rabbitmq_channel),
+    publisher=Depends(get_publisher),
+    redis=Depends(get_redis_async)
+):
+    replayed = []
+    messages = await take(channel, DEAD_LETTER_MAX_PAGE_SIZE if job_id else limit)
+    settled = set()
+    try:
+        for message in messages:
+            message_job_id = header(message, "job_id") or message.message_id
+            if (job_id and message_job_id != job_id) or len(replayed) >= limit:
+                continue
+
+            lane = header(message, "lane", DEFAULT_LANE)
+            if message_job_id:
+                # Pollers see the job as pending again instead of its old failure
+                await store_pending(redis, message_job_id)
+            await publisher.publish(
+                Message(
+                    body=message.body,
+                    headers={k: v for k, v in (message.headers or {}).items() if k not in RETRY_HEADERS},
+                    content_type=message.content_type,
+                    message_id=message.message_id,
+                    delivery_mode=DeliveryMode.PERSISTENT
+                ),
+                routing_key=job_queue(header(message, "payload_type"), lane if lane in JOB_LANES else DEFAULT_LANE)
+            )
+            await message.ack()
+            settled.add(id(message))
+            replayed.append(message_job_id)
+    finally:
+        # Anything not replayed goes back to the dead-letter queue, even on errors
+        for message in messages:
+            if id(message) not in settled:
+                await message.nack(requeue=True)
+
+    return ReplayResponse(replayed=replayed)
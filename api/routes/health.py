@@ -0,0 +1,62 @@
+from fastapi import APIRouter, Request, Response
+from pydantic import BaseModel
+from typing import Dict
+import os
+import asyncio
+
+from qdrant import get_async_qdrant_client
+
+router = APIRouter()
+
+# Each dependency check gives up after this long and counts as not ready
+READINESS_TIMEOUT_SECONDS = float(os.getenv("READINESS_TIMEOUT_SECONDS", 1))
+
+class HealthResponse(BaseModel):
+    status: str
+
+class ReadinessResponse(BaseModel):
+    status: str
+    checks: Dict[str, bool]
+
+async def check(probe) -> bool:
+    try:
+        await asyncio.wait_for(probe(), READINESS_TIMEOUT_SECONDS)
+        return True
+    except Exception:
+        return False
+
+def task_alive(task) -> bool:
+    return task is not None and not task.done()
+
+# ========================
+# Endpoint Health
+# ========================
+@router.get("/healthz", response_model=HealthResponse)
+async def healthz():
+    # Liveness: the process and its event loop answer. Dependencies are left to /readyz,
+    # so a broker outage does not get every API process restarted
+    return HealthResponse(status="ok")
+
+@router.get("/readyz", response_model=ReadinessResponse)
+async def readyz(request: Request, response: Response):
+    state = request.app.state
+    redis = getattr(state, "redis_async", None)
+    connection = getattr(state, "rabbitmq_connection", None)
+    result_broker = getattr(state, "result_broker", None)
+
+    redis_ok, qdrant_ok = await asyncio.gather(
+        check(redis.ping) if redis else asyncio.sleep(0, result=False),
+        check(get_async_qdrant_client().get_collections),
+    )
+    checks = {
+        "redis": redis_ok,
+        "qdrant": qdrant_ok,
+        "rabbitmq": connection is not None and not connection.is_closed and connection.connected.is_set(),
+        "result_subscriber": task_alive(result_broker.task if result_broker else None),
+        "cache_sync": task_alive(getattr(state, "cache_sync_task", None)),
+        "models": getattr(state, "models_ready", False),
+    }
+    ready = all(checks.values())
+    if not ready:
+        response.status_code = 503
+    return ReadinessResponse(status="ready" if ready else "not_ready", checks=checks)
@@ -0,0 +1,45 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel
+from typing import List, Optional
+from dependencies import get_redis_async, get_result_broker
+from results import get_result
+
+router = APIRouter()
+
+class JobResult(BaseModel):
+    job_id: str
+    status: str
+    identifier: Optional[str] = None
+    photo: Optional[str] = None
+    cached: Optional[bool] = None
+    faces: Optional[List[dict]] = None
+    tracks: Optional[List[dict]] = None
+    video: Optional[dict] = None
+    message: Optional[str] = None
+    submitted_at: Optional[float] = None
+    completed_at: Optional[float] = None
+    latency_ms: Optional[float] = None
+
+# ========================
+# Endpoint Jobs
+# ========================
+@router.get("/jobs/{job_id}", response_model=JobResult)
+async def get_job(
+    job_id: str,
+    wait: float = Query(0, ge=0, le=30),
+    redis=Depends(get_redis_async),
+    broker=Depends(get_result_broker)
+):
+    # wait > 0 turns the poll into a long-poll served by the shared subscriber
+    if wait:
+        result = await broker.wait(job_id, wait)
+    else:
+        result = await get_result(redis, job_id)
+
+    if result is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+
+    if result.get("submitted_at") and result.get("completed_at"):
+        result["latency_ms"] = (result["completed_at"] - result["submitted_at"]) * 1000
+
+    return JobResult(**result)
@@ -0,0 +1,35 @@
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+import os
+
+from photo_store import get_photo_store, valid_name, LocalPhotoStore
+
+router = APIRouter()
+
+# Names are content hashes, so a URL never changes content
+PHOTO_CACHE_CONTROL = os.getenv("PHOTO_CACHE_CONTROL", "public, max-age=31536000, immutable")
+
+# ========================
+# Endpoint Photos
+# ========================
+@router.get("/photos/{name}")
+async def get_photo(name: str, request: Request):
+    if not valid_name(name):
+        raise HTTPException(status_code=404, detail="Photo not found.")
+
+    etag = f'"{name}"'
+    headers = {"Cache-Control": PHOTO_CACHE_CONTROL, "ETag": etag}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+
+    store = get_photo_store()
+    if isinstance(store, LocalPhotoStore):
+        path = store.path(name)
+        if not os.path.isfile(path):
+            raise HTTPException(status_code=404, detail="Photo not found.")
+        return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+    data = await store.get(name)
+    if data is None:
+        raise HTTPException(status_code=404, detail="Photo not found.")
+    return Response(content=data, media_type="image/jpeg", headers=headers)
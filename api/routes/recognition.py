@@ -1,40 +1,86 @@
 import io
-import json
 import os
+import json
+import math
 import uuid
-import base64
-from typing import Optional
+from typing import List, Optional, Tuple
 
-from fastapi import APIRouter, File, UploadFile, Depends, HTTPException
+from fastapi import APIRouter, File, UploadFile, Depends, HTTPException, Query
 from fastapi.concurrency import run_in_threadpool
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 from PIL import Image, ImageOps
 
-import face_recognition
-from aio_pika import Message, DeliveryMode
+import numpy as np
 
-from dependencies import get_redis_async, get_rabbitmq_channel
-from qdrant import get_qdrant_client
+from dependencies import get_redis_async, get_publisher, get_face_cache, get_single_flight, get_queue_depths
+from qdrant import get_async_qdrant_client
+from identities import search_identities_batch
+from utils import publish_job, publish_job_to_rabbitmq, JOB_LANES
+from admission import admit
+from results import store_pending, get_result
+from dedup import (
+    DEDUP_ENABLED, DEDUP_PERCEPTUAL, content_hash, perceptual_hash, gallery_generation,
+    cached_response, store_response, claim_job, release_job
+)
+from metrics import STAGE_LATENCY, CACHE_LOOKUPS, DEDUP_HITS
+from face_cache import publish_cache_entry
+from detection import detect_faces, detection_settings, face_models
 
 # ========================
 # CONFIGS
 # ========================
-QUEUE_NAME = os.getenv("QUEUE_NAME", "face_recognition_jobs")
+# Lane for requests that do not pick one (see JOB_LANES)
+ASYNC_DEFAULT_LANE = os.getenv("ASYNC_DEFAULT_LANE", JOB_LANES[0])
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
-CACHE_DISTANCE_THRESHOLD = float(os.getenv("CACHE_DISTANCE_THRESHOLD", 0.45))
+# Shared with the worker so both answer repeat visitors the same way
+CACHE_DISTANCE_THRESHOLD = float(
+    os.getenv("CACHE_DISTANCE_THRESHOLD_LOCAL", os.getenv("CACHE_DISTANCE_THRESHOLD", 0.45))
+)
+CACHE_SCORE_THRESHOLD_QDRANT = float(os.getenv("CACHE_SCORE_THRESHOLD_QDRANT", 0.85))
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", 5))
 RECOGNITION_COUNTER_KEY = os.getenv("RECOGNITION_COUNTER_KEY", "recognition_counter")
 MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 1000))
 FOTOS_DIR = os.path.abspath(os.getenv("FOTOS_DIR", "system/photos/recognition"))
 
+# none: publish the upload as-is | resize: downsized JPEG | crop: JPEG of the face region
+# encoding: publish only the 128-float encoding computed here
+PREPROCESS_MODES = ("none", "resize", "crop", "encoding")
+ASYNC_PREPROCESS_MODE = os.getenv("ASYNC_PREPROCESS_MODE", "none")
+CROP_MARGIN = float(os.getenv("CROP_MARGIN", 0.5))
+JPEG_QUALITY = int(os.getenv("JPEG_QUALITY", 90))
+
 os.makedirs(FOTOS_DIR, exist_ok=True)
 router = APIRouter()
 
 # ========================
 # Pydantic Models
 # ========================
+class Candidate(BaseModel):
+    name: Optional[str] = None
+    photo: Optional[str] = None
+    distance: float
+
+class FaceBox(BaseModel):
+    top: int
+    right: int
+    bottom: int
+    left: int
+
+class FaceMatch(BaseModel):
+    box: FaceBox
+    name: Optional[str] = None
+    photo: Optional[str] = None
+    distance: Optional[float] = None
+    candidates: List[Candidate] = []
+    cached: bool = False
+
 class RecognitionResponse(BaseModel):
     name: Optional[str] = None
     photo: Optional[str] = None
+    distance: Optional[float] = None
+    candidates: Optional[List[Candidate]] = None
+    faces: Optional[List[FaceMatch]] = None
     cached: Optional[bool] = None
     message: Optional[str] = None
     job_id: Optional[str] = None
@@ -43,70 +89,120 @@ class RecognitionResponse(BaseModel):
 # ========================
 # Utils
 # ========================
-def preprocess_image(image_bytes: bytes) -> Image.Image:
+def preprocess_image(image_bytes: bytes) -> Tuple[Image.Image, float]:
+    # Returns the working-resolution image and the factor that maps it back to the original.
+    # Decodes once: no intermediate copies from exif_transpose/convert when they are no-ops
     pil_image = Image.open(io.BytesIO(image_bytes))
-    pil_image = ImageOps.exif_transpose(pil_image).convert("RGB")
+    original_size = max(pil_image.size)
+
+    if pil_image.format == "JPEG" and original_size > MAX_IMAGE_SIZE:
+        # Draft mode lets libjpeg decode at 1/2, 1/4 or 1/8 scale, never below the working size
+        ratio = MAX_IMAGE_SIZE / original_size
+        pil_image.draft("RGB", (math.ceil(pil_image.size[0] * ratio), math.ceil(pil_image.size[1] * ratio)))
+
+    ImageOps.exif_transpose(pil_image, in_place=True)
+    if pil_image.mode != "RGB":
+        pil_image = pil_image.convert("RGB")
 
     if max(pil_image.size) > MAX_IMAGE_SIZE:
-        scale = min(MAX_IMAGE_SIZE / pil_image.size[0], MAX_IMAGE_SIZE / pil_image.size[1])
+        ratio = MAX_IMAGE_SIZE / max(pil_image.size)
         pil_image = pil_image.resize(
-            (int(pil_image.size[0] * scale), int(pil_image.size[1] * scale)),
+            (int(pil_image.size[0] * ratio), int(pil_image.size[1] * ratio)),
             Image.LANCZOS
         )
-    return pil_image
+    return pil_image, max(pil_image.size) / original_size
 
-async def encode_face(pil_image: Image.Image) -> Optional[list]:
+def load_image_array(image_bytes: bytes) -> Tuple[np.ndarray, float]:
+    # The single contiguous uint8 array handed to dlib
+    pil_image, scale = preprocess_image(image_bytes)
+    return np.asarray(pil_image), scale
+
+def crop_to_faces(pil_image: Image.Image, face_locations: list) -> Image.Image:
+    # Union of all face boxes (top, right, bottom, left), padded so the worker can re-detect
+    top = min(loc[0] for loc in face_locations)
+    right = max(loc[1] for loc in face_locations)
+    bottom = max(loc[2] for loc in face_locations)
+    left = min(loc[3] for loc in face_locations)
+    margin_y = int((bottom - top) * CROP_MARGIN)
+    margin_x = int((right - left) * CROP_MARGIN)
+    return pil_image.crop((
+        max(0, left - margin_x),
+        max(0, top - margin_y),
+        min(pil_image.size[0], right + margin_x),
+        min(pil_image.size[1], bottom + margin_y)
+    ))
+
+def to_jpeg(pil_image: Image.Image) -> bytes:
     buffer = io.BytesIO()
-    pil_image.save(buffer, format="JPEG", quality=100)
-    buffer.seek(0)
+    pil_image.save(buffer, format="JPEG", quality=JPEG_QUALITY)
+    return buffer.getvalue()
 
-    image_array = face_recognition.load_image_file(buffer)
-    face_locations = await run_in_threadpool(face_recognition.face_locations, image_array)
+def detect_and_encode(image_array: np.ndarray, model: str = None, upsample: int = None,
+                      multi_face: bool = True) -> list:
+    face_locations = detect_faces(image_array, model, upsample)
     if not face_locations:
-        return None
-    encodings = await run_in_threadpool(face_recognition.face_encodings, image_array, face_locations)
-    return encodings[0] if encodings else None
+        return []
+    if not multi_face:
+        face_locations = face_locations[:1]
+    encodings = face_models().face_encodings(image_array, face_locations)
+    return list(zip(face_locations, encodings))
+
+async def encode_faces(image_array: np.ndarray, model: str = None, upsample: int = None,
+                       multi_face: bool = True) -> list:
+    # Detection and encoding in a single threadpool hop
+    with STAGE_LATENCY.labels("detect_encode").time():
+        return await run_in_threadpool(detect_and_encode, image_array, model, upsample, multi_face)
 
-async def increment_redis(redis_client, key: str):
+async def encode_face(image_array: np.ndarray, model: str = None, upsample: int = None) -> Optional[list]:
+    faces = await encode_faces(image_array, model, upsample, multi_face=False)
+    return faces[0][1] if faces else None
+
+async def increment_redis(redis_client, key: str, amount: int = 1):
     if redis_client:
         try:
-            await redis_client.incr(key)
+            await redis_client.incr(key, amount)
         except Exception as e:
             print(f"Redis increment failed: {e}")
 
-async def search_qdrant(qdrant, encoding: list):
-    def search_point():
-        best_point = None
-        best_distance = float("inf")
+async def search_qdrant(qdrant, encoding, top_k: int = SEARCH_TOP_K,
+                        threshold: float = CACHE_SCORE_THRESHOLD_QDRANT):
+    # Indexed k-NN over people: centroid shortlist, then that shortlist's samples
+    with STAGE_LATENCY.labels("vector_search").time():
+        results = await search_identities_batch(qdrant, [encoding], top_k, threshold)
+    return results[0]
 
-        
-        points, next_page = qdrant.scroll(
-            collection_name=COLLECTION_NAME,
-            limit=1000
-        )
+async def search_qdrant_batch(qdrant, encodings: list, top_k: int = SEARCH_TOP_K,
+                              threshold: float = CACHE_SCORE_THRESHOLD_QDRANT):
+    # Two round-trips for all faces in a frame, whatever their number
+    with STAGE_LATENCY.labels("vector_search_batch").time():
+        return await search_identities_batch(qdrant, encodings, top_k, threshold)
 
-        for point in points:
-            distance = point.score if hasattr(point, "score") else 0.0
-            if distance < best_distance:
-                best_distance = distance
-                best_point = point
-
-        while next_page:
-            points, next_page = qdrant.scroll(
-                collection_name=COLLECTION_NAME,
-                limit=1000,
-                offset=next_page
-            )
-            for point in points:
-                distance = point.score if hasattr(point, "score") else 0.0
-                if distance < best_distance:
-                    best_distance = distance
-                    best_point = point
+def cache_lookup(face_cache, encoding, threshold: float) -> Optional[Candidate]:
+    with STAGE_LATENCY.labels("cache_lookup").time():
+        hit = face_cache.lookup(encoding, min(CACHE_DISTANCE_THRESHOLD, threshold))
+    CACHE_LOOKUPS.labels("hit" if hit else "miss").inc()
+    if not hit:
+        return None
+    identifier, photo, distance = hit
+    return Candidate(name=identifier, photo=photo, distance=distance)
 
-        return best_point
+async def remember_match(redis_client, face_cache, candidate: Candidate, encoding):
+    # Local row now, every other API process and worker through the cache stream
+    face_cache.put(candidate.name, candidate.photo, encoding)
+    try:
+        await publish_cache_entry(redis_client, candidate.name, candidate.photo, encoding)
+    except Exception as e:
+        print(f"Cache publish failed: {e}")
 
-    result = await run_in_threadpool(search_point)
-    return result
+def to_candidates(points) -> List[Candidate]:
+    return [
+        Candidate(
+            name=point.payload.get("identifier"),
+            photo=point.payload.get("photo"),
+            distance=point.score
+        )
+        for point in points
+    ]
 
 # ========================
 # Endpoints
@@ -114,55 +210,211 @@ async def search_qdrant(qdrant, encoding: list):
 @router.post("/async-recognition", response_model=RecognitionResponse)
 async def async_recognition(
     file: UploadFile = File(...),
-    rabbitmq_channel=Depends(get_rabbitmq_channel)
+    preprocess: Optional[str] = Query(None),
+    multi_face: bool = Query(False),
+    detection_model: Optional[str] = Query(None),
+    upsample: Optional[int] = Query(None, ge=0, le=3),
+    lane: Optional[str] = Query(None, description="priority lane, e.g. interactive or batch"),
+    publisher=Depends(get_publisher),
+    redis_client=Depends(get_redis_async),
+    queue_depths=Depends(get_queue_depths)
 ):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Invalid file type.")
 
+    lane = lane or ASYNC_DEFAULT_LANE
+    if lane not in JOB_LANES:
+        raise HTTPException(status_code=400, detail=f"Invalid lane. Use one of {JOB_LANES}.")
+    # Shed before any hashing, preprocessing or Redis work
+    await admit(queue_depths, lane)
+
+    try:
+        model, upsample = detection_settings("async", detection_model, upsample)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
     image_bytes = await file.read()
     job_id = str(uuid.uuid4())
+    headers = {"multi_face": multi_face, "detection_model": model, "detection_upsample": upsample}
 
-    image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+    mode = preprocess or ASYNC_PREPROCESS_MODE
+    if mode not in PREPROCESS_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid preprocess mode. Use one of {PREPROCESS_MODES}.")
 
-    message_body = json.dumps({
-        "job_id": job_id,
-        "image_base64": image_b64
-    }).encode()
+    dedup_key = None
+    if DEDUP_ENABLED:
+        # A byte-identical upload already queued or answered is not published again
+        generation = await gallery_generation(redis_client)
+        dedup_key = await run_in_threadpool(
+            content_hash, image_bytes, "async", mode, multi_face, model, upsample, generation
+        )
+        existing = await claim_job(redis_client, dedup_key, job_id)
+        if existing:
+            result = await get_result(redis_client, existing) or {}
+            return RecognitionResponse(
+                status=result.get("status", "pending"),
+                job_id=existing,
+                message="Duplicate upload: returning the existing job."
+            )
 
-    await rabbitmq_channel.default_exchange.publish(
-        Message(
-            body=message_body,
-            delivery_mode=DeliveryMode.PERSISTENT
-        ),
-        routing_key=QUEUE_NAME
-    )
+    try:
+        # Recorded before publishing so a fast worker result is never overwritten by "pending"
+        await store_pending(redis_client, job_id)
 
-    return RecognitionResponse(status="pending", job_id=job_id)
+        if mode == "none":
+            await publish_job(
+                publisher, job_id, image_bytes, content_type=file.content_type, headers=headers, lane=lane
+            )
+            return RecognitionResponse(status="pending", job_id=job_id)
 
-@router.post("/sync-recognition", response_model=RecognitionResponse)
-async def sync_recognition(
-    file: UploadFile = File(...),
-    qdrant=Depends(get_qdrant_client),
-    redis_client=Depends(get_redis_async)
-):
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(status_code=400, detail="Invalid file type.")
+        pil_image, scale = await run_in_threadpool(preprocess_image, image_bytes)
 
-    image_bytes = await file.read()
-    pil_image = preprocess_image(image_bytes)
+        if mode == "encoding":
+            faces = await encode_faces(np.asarray(pil_image), model, upsample, multi_face)
+            if not faces:
+                raise HTTPException(status_code=400, detail="No faces found.")
+            encodings = [encoding for _, encoding in faces]
+            # Boxes ride along so multi-face results still carry them; mapped back to original pixels
+            headers["boxes"] = json.dumps([[int(round(v / scale)) for v in location] for location, _ in faces])
+            await publish_job_to_rabbitmq(publisher, job_id, encodings, headers=headers, lane=lane)
+            return RecognitionResponse(status="pending", job_id=job_id)
+
+        if mode == "crop":
+            face_locations = await run_in_threadpool(detect_faces, np.asarray(pil_image), model, upsample)
+            if not face_locations:
+                raise HTTPException(status_code=400, detail="No faces found.")
+            pil_image = crop_to_faces(pil_image, face_locations)
+
+        body = await run_in_threadpool(to_jpeg, pil_image)
+        await publish_job(publisher, job_id, body, content_type="image/jpeg", headers=headers, lane=lane)
+
+        return RecognitionResponse(status="pending", job_id=job_id)
+    except Exception:
+        if dedup_key:
+            await release_job(redis_client, dedup_key, job_id)
+        raise
+
+async def recognize_image(image_array: np.ndarray, scale: float, top_k: int, threshold: float, multi_face: bool,
+                          model: str, upsample: int, qdrant, redis_client, face_cache) -> RecognitionResponse:
+    if multi_face:
+        faces = await encode_faces(image_array, model, upsample)
+        if not faces:
+            raise HTTPException(status_code=400, detail="No faces found.")
+
+        # Cache first; only the misses go to Qdrant, still in one batched query
+        hits = [cache_lookup(face_cache, encoding, threshold) for _, encoding in faces]
+        misses = [index for index, hit in enumerate(hits) if hit is None]
+        results = await search_qdrant_batch(
+            qdrant, [faces[index][1] for index in misses], top_k, threshold
+        ) if misses else []
+
+        face_candidates = [[hit] if hit else [] for hit in hits]
+        for index, points in zip(misses, results):
+            face_candidates[index] = to_candidates(points)
+            if face_candidates[index]:
+                await remember_match(redis_client, face_cache, face_candidates[index][0], faces[index][1])
 
-    encoding = await encode_face(pil_image)
+        matches = []
+        for (location, _), hit, candidates in zip(faces, hits, face_candidates):
+            top, right, bottom, left = (int(round(v / scale)) for v in location)
+            best = candidates[0] if candidates else None
+            matches.append(FaceMatch(
+                box=FaceBox(top=top, right=right, bottom=bottom, left=left),
+                name=best.name if best else None,
+                photo=best.photo if best else None,
+                distance=best.distance if best else None,
+                candidates=candidates,
+                cached=hit is not None
+            ))
+
+        recognized = sum(1 for match in matches if match.name)
+        if recognized:
+            await increment_redis(redis_client, RECOGNITION_COUNTER_KEY, recognized)
+        return RecognitionResponse(
+            faces=matches,
+            message=f"{recognized}/{len(matches)} faces recognized.",
+            cached=bool(matches) and all(match.cached for match in matches)
+        )
+
+    encoding = await encode_face(image_array, model, upsample)
     if encoding is None:
         raise HTTPException(status_code=400, detail="No faces found.")
 
-    result = await search_qdrant(qdrant, encoding)
-    if result:
-        payload = result.payload
+    hit = cache_lookup(face_cache, encoding, threshold)
+    if hit:
         await increment_redis(redis_client, RECOGNITION_COUNTER_KEY)
         return RecognitionResponse(
-            name=payload.get("identifier"),
-            photo=payload.get("photo"),
+            name=hit.name,
+            photo=hit.photo,
+            distance=hit.distance,
+            candidates=[hit],
             cached=True
         )
 
+    points = await search_qdrant(qdrant, encoding, top_k, threshold)
+    if points:
+        candidates = to_candidates(points)
+        best = candidates[0]
+        await remember_match(redis_client, face_cache, best, encoding)
+        await increment_redis(redis_client, RECOGNITION_COUNTER_KEY)
+        return RecognitionResponse(
+            name=best.name,
+            photo=best.photo,
+            distance=best.distance,
+            candidates=candidates,
+            cached=False
+        )
+
     return RecognitionResponse(message="Unrecognized face.", cached=False)
+
+@router.post("/sync-recognition", response_model=RecognitionResponse)
+async def sync_recognition(
+    file: UploadFile = File(...),
+    top_k: int = Query(SEARCH_TOP_K, ge=1, le=100),
+    threshold: float = Query(CACHE_SCORE_THRESHOLD_QDRANT, gt=0),
+    multi_face: bool = Query(False),
+    detection_model: Optional[str] = Query(None),
+    upsample: Optional[int] = Query(None, ge=0, le=3),
+    qdrant=Depends(get_async_qdrant_client),
+    redis_client=Depends(get_redis_async),
+    face_cache=Depends(get_face_cache),
+    single_flight=Depends(get_single_flight)
+):
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(status_code=400, detail="Invalid file type.")
+
+    try:
+        model, upsample = detection_settings("sync", detection_model, upsample)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    image_bytes = await file.read()
+    # The gallery generation keeps answers given before an enrollment or delete from being reused
+    generation = await gallery_generation(redis_client) if DEDUP_ENABLED else 0
+    params = ("sync", top_k, threshold, multi_face, model, upsample, generation)
+
+    async def compute() -> dict:
+        # Decode, orient and resize off the event loop
+        with STAGE_LATENCY.labels("preprocess").time():
+            image_array, scale = await run_in_threadpool(load_image_array, image_bytes)
+
+        perceptual_key = perceptual_hash(image_array, *params) if DEDUP_ENABLED and DEDUP_PERCEPTUAL else None
+        if perceptual_key:
+            response = await cached_response(redis_client, perceptual_key)
+            if response is not None:
+                DEDUP_HITS.labels("sync", "perceptual").inc()
+                return response
+
+        response = jsonable_encoder(await recognize_image(
+            image_array, scale, top_k, threshold, multi_face, model, upsample, qdrant, redis_client, face_cache
+        ))
+        if perceptual_key:
+            await store_response(redis_client, perceptual_key, response)
+        return response
+
+    if not DEDUP_ENABLED:
+        return RecognitionResponse(**await compute())
+
+    # Byte-identical uploads share one computation and its stored response
+    key = await run_in_threadpool(content_hash, image_bytes, *params)
+    return RecognitionResponse(**await single_flight.run("sync", key, compute))
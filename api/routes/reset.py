@@ -1,69 +1,138 @@
-from fastapi import APIRouter, Depends, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from pydantic import BaseModel
+from typing import Optional
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import VectorParams, Distance
 from qdrant_client.http.exceptions import UnexpectedResponse
 from fastapi.concurrency import run_in_threadpool
 import os
+import time
+import uuid
 
-from qdrant import get_qdrant_client
+from qdrant import get_qdrant_client, alias_target, create_versioned_collection, swap_alias
+from dependencies import get_redis_async
+from face_cache import publish_cache_invalidation
+from results import RESULT_KEY_PREFIX
+from dedup import DEDUP_KEY_PREFIX
+from photo_store import get_photo_store
+from identities import reset_centroid_collection
 
 router = APIRouter()
 
 # ========================
 # Configs
 # ========================
-FOTOS_DIR = os.path.abspath(os.getenv("FOTOS_DIR", "system/photos"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
-os.makedirs(FOTOS_DIR, exist_ok=True)
+RESET_JOB_PREFIX = os.getenv("RESET_JOB_PREFIX", "reset_job:")
+RESET_JOB_TTL_SECONDS = int(os.getenv("RESET_JOB_TTL_SECONDS", 86400))
+RESET_DELETE_BATCH_SIZE = int(os.getenv("RESET_DELETE_BATCH_SIZE", 500))
+RESET_ACTIVE_KEY = os.getenv("RESET_ACTIVE_KEY", "reset_active")
 
-# ========================
-# Endpoint Reset
-# ========================
-@router.delete("/reset/")
-async def reset(qdrant: QdrantClient = Depends(get_qdrant_client)):
-
-    # Função síncrona para deletar arquivos
-    def delete_files():
-        errors = []
-        for filename in os.listdir(FOTOS_DIR):
-            file_path = os.path.join(FOTOS_DIR, filename)
-            try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
-            except Exception as e:
-                errors.append(f"{file_path}: {e}")
-        return errors
-
-    # Rodar em thread pool para não bloquear o event loop
-    errors = await run_in_threadpool(delete_files)
-
-    if errors:
-        return JSONResponse(
-            status_code=500,
-            content={"message": "Some files could not be deleted", "errors": errors}
-        )
-
-    # Resetar a coleção do Qdrant
-    try:
+
+class ResetResponse(BaseModel):
+    job_id: str
+    status: str
+
+class ResetStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    step: Optional[str] = None
+    collection: Optional[str] = None
+    photos_deleted: int = 0
+    photo_errors: int = 0
+    cache_keys_purged: int = 0
+    error: Optional[str] = None
+
+async def update_reset_status(redis, job_id: str, **fields):
+    await redis.hset(f"{RESET_JOB_PREFIX}{job_id}", mapping=fields)
+    await redis.expire(f"{RESET_JOB_PREFIX}{job_id}", RESET_JOB_TTL_SECONDS)
+
+def swap_in_fresh_collection(qdrant: QdrantClient):
+    # Searches keep resolving the alias to a complete collection throughout
+    previous = alias_target(qdrant)
+    collection_name = create_versioned_collection(qdrant)
+    if previous is None:
+        # A plain collection from before aliases must go before the alias can take its name
         try:
             qdrant.delete_collection(collection_name=COLLECTION_NAME)
         except UnexpectedResponse as e:
-            # Ignora erro 404 (coleção não existe)
             if e.status_code != 404:
                 raise
+    swap_alias(qdrant, collection_name=collection_name)
+    reset_centroid_collection(qdrant)
+    return collection_name, previous
+
+async def purge_keys(redis, pattern: str) -> int:
+    purged = 0
+    batch = []
+    async for key in redis.scan_iter(match=pattern, count=RESET_DELETE_BATCH_SIZE):
+        batch.append(key)
+        if len(batch) >= RESET_DELETE_BATCH_SIZE:
+            purged += await redis.delete(*batch)
+            batch = []
+    if batch:
+        purged += await redis.delete(*batch)
+    return purged
+
+async def run_reset(job_id: str, qdrant: QdrantClient, redis):
+    started_at = time.time()
+    try:
+        await update_reset_status(redis, job_id, status="running", step="collection")
+        collection_name, previous = await run_in_threadpool(swap_in_fresh_collection, qdrant)
+        await update_reset_status(redis, job_id, step="cache", collection=collection_name)
+
+        # Every API and worker face cache, plus stored dedup answers for the old gallery
+        await publish_cache_invalidation(redis)
+        purged = await purge_keys(redis, f"{RESULT_KEY_PREFIX}dedup-*")
+        purged += await purge_keys(redis, f"{DEDUP_KEY_PREFIX}*")
+        # Per-entry keys written by workers from before the cache stream
+        purged += await purge_keys(redis, "face_cache:*")
+        await update_reset_status(redis, job_id, step="photos", cache_keys_purged=purged)
+
+        if previous:
+            await run_in_threadpool(qdrant.delete_collection, collection_name=previous)
 
-        qdrant.create_collection(
-            collection_name=COLLECTION_NAME,
-            vectors_config=VectorParams(
-                size=128,
-                distance=Distance.EUCLID
-            )
-        )
+        # Photos stored after the reset started belong to the new collection and are kept
+        async for deleted, errors in get_photo_store().purge(started_at):
+            await update_reset_status(redis, job_id, photos_deleted=deleted, photo_errors=errors)
+
+        await update_reset_status(redis, job_id, status="completed", step="done")
     except Exception as e:
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error resetting Qdrant collection: {e}"
-        )
+        print(f"Reset {job_id} failed: {e}")
+        await update_reset_status(redis, job_id, status="failed", error=str(e))
+    finally:
+        await redis.delete(RESET_ACTIVE_KEY)
+
+# ========================
+# Endpoint Reset
+# ========================
+@router.delete("/reset/", response_model=ResetResponse, status_code=202)
+async def reset(
+    background_tasks: BackgroundTasks,
+    qdrant: QdrantClient = Depends(get_qdrant_client),
+    redis=Depends(get_redis_async)
+):
+    job_id = str(uuid.uuid4())
+    if not await redis.set(RESET_ACTIVE_KEY, job_id, nx=True, ex=RESET_JOB_TTL_SECONDS):
+        running = await redis.get(RESET_ACTIVE_KEY)
+        raise HTTPException(status_code=409, detail=f"Reset {running} is already running.")
+
+    await update_reset_status(redis, job_id, status="queued")
+    background_tasks.add_task(run_reset, job_id, qdrant, redis)
+    return ResetResponse(job_id=job_id, status="queued")
+
+@router.get("/reset/{job_id}", response_model=ResetStatusResponse)
+async def reset_status(job_id: str, redis=Depends(get_redis_async)):
+    status = await redis.hgetall(f"{RESET_JOB_PREFIX}{job_id}")
+    if not status:
+        raise HTTPException(status_code=404, detail="Reset job not found or expired.")
 
-    return {"message": "Reset completed successfully."}
+    return ResetStatusResponse(
+        job_id=job_id,
+        status=status.get("status", "unknown"),
+        step=status.get("step"),
+        collection=status.get("collection"),
+        photos_deleted=int(status.get("photos_deleted", 0)),
+        photo_errors=int(status.get("photo_errors", 0)),
+        cache_keys_purged=int(status.get("cache_keys_purged", 0)),
+        error=status.get("error")
+    )
@@ -1,27 +1,50 @@
-from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends
+from fastapi import APIRouter, UploadFile, File, Form, HTTPException, Depends, BackgroundTasks, Query
 from pydantic import BaseModel
+from typing import List, Optional
 from PIL import Image, ImageOps
 from fastapi.concurrency import run_in_threadpool
+from concurrent.futures import ProcessPoolExecutor
 import os
 import io
+import json
+import shutil
+import asyncio
+import tarfile
+import tempfile
+import zipfile
 import numpy as np
 import uuid
-import face_recognition
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http.models import PointStruct
-from qdrant import get_qdrant_client
+from qdrant import get_qdrant_client, get_async_qdrant_client
+from dependencies import get_redis_async
+from metrics import STAGE_LATENCY
+from face_cache import publish_cache_invalidation
+from dedup import bump_gallery_generation
+from photo_store import get_photo_store, render_variants, save_photo, photo_url, delete_photos
+from identities import sample_payload, refresh_centroids
+from detection import detect_faces, detection_settings, face_models
 
 router = APIRouter()
 
-FOTOS_DIR = os.path.abspath(os.getenv("FOTOS_DIR", "system/photos"))
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
-os.makedirs(FOTOS_DIR, exist_ok=True)
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 1000))
+
+BULK_PROCESSES = int(os.getenv("BULK_PROCESSES", os.cpu_count() or 1))
+BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", BULK_PROCESSES * 4))
+BULK_UPSERT_BATCH_SIZE = int(os.getenv("BULK_UPSERT_BATCH_SIZE", 256))
+BULK_JOB_PREFIX = os.getenv("BULK_JOB_PREFIX", "bulk_job:")
+BULK_JOB_TTL_SECONDS = int(os.getenv("BULK_JOB_TTL_SECONDS", 86400))
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+SPOOL_CHUNK_SIZE = 1024 * 1024
+BULK_MANIFEST = "manifest.json"
 
 
 class UploadResponse(BaseModel):
     message: str
     identifier: str
     photo_path: str
+    thumbnail_url: Optional[str] = None
 
 # ========================
 # Endpoint Upload
@@ -29,32 +52,34 @@ class UploadResponse(BaseModel):
 @router.post("/upload", response_model=UploadResponse)
 async def upload_face(
     qdrant: QdrantClient = Depends(get_qdrant_client),
+    async_qdrant: AsyncQdrantClient = Depends(get_async_qdrant_client),
+    redis=Depends(get_redis_async),
     identifier: str = Form(...),
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    detection_model: Optional[str] = Query(None),
+    upsample: Optional[int] = Query(None, ge=0, le=3)
 ):
     if not file.content_type.startswith("image/"):
         raise HTTPException(status_code=400, detail="Invalid file type.")
 
-    image_bytes = await file.read()
-    pil_image = Image.open(io.BytesIO(image_bytes))
-    pil_image = ImageOps.exif_transpose(pil_image).convert("RGB")
-
-    max_size = 1000
-    original_width, original_height = pil_image.size
-    if max(original_width, original_height) > max_size:
-        scale = min(max_size / original_width, max_size / original_height)
-        new_size = (int(original_width * scale), int(original_height * scale))
-        pil_image = pil_image.resize(new_size, Image.LANCZOS)
+    try:
+        model, upsample = detection_settings("upload", detection_model, upsample)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-    save_path = os.path.join(FOTOS_DIR, f"{identifier}.jpg")
-    pil_image.save(save_path, format="JPEG", quality=100)
+    image_bytes = await file.read()
+    with STAGE_LATENCY.labels("upload_preprocess").time():
+        pil_image = await run_in_threadpool(load_enrollment_image, image_bytes)
 
     def get_encoding():
         image_np = np.array(pil_image)
-        encodings = face_recognition.face_encodings(image_np)
-        return encodings
+        face_locations = detect_faces(image_np, model, upsample)
+        if not face_locations:
+            return []
+        return face_models().face_encodings(image_np, face_locations)
 
-    face_encodings_list = await run_in_threadpool(get_encoding)
+    with STAGE_LATENCY.labels("upload_encode").time():
+        face_encodings_list = await run_in_threadpool(get_encoding)
 
     if not face_encodings_list:
         raise HTTPException(status_code=400, detail="No faces found in the image.")
@@ -64,22 +89,294 @@ async def upload_face(
 
     encoding = face_encodings_list[0]
 
+    # Content-addressed variants, written only once a face was found
+    store = get_photo_store()
+    with STAGE_LATENCY.labels("upload_save_photo").time():
+        photo_id, variants = await run_in_threadpool(render_variants, pil_image)
+        photo_fields = await save_photo(store, photo_id, variants)
+
     try:
-        qdrant.upsert(
-            collection_name=COLLECTION_NAME,
-            points=[
-                PointStruct(
-                    id=str(uuid.uuid4()),
-                    vector=encoding.tolist(),
-                    payload={"identifier": identifier, "photo": save_path}
-                )
-            ]
-        )
+        # Never on the event loop: the sample goes over the async client, the centroid
+        # refresh (blocking REST client) to the threadpool
+        with STAGE_LATENCY.labels("upload_upsert").time():
+            await async_qdrant.upsert(
+                collection_name=COLLECTION_NAME,
+                points=[
+                    PointStruct(
+                        id=str(uuid.uuid4()),
+                        vector=encoding.tolist(),
+                        payload=sample_payload(identifier, **photo_fields)
+                    )
+                ],
+                # The centroid refresh below reads the sample back
+                wait=True
+            )
+        with STAGE_LATENCY.labels("upload_centroid").time():
+            trimmed_photos = await run_in_threadpool(refresh_centroids, qdrant, [identifier])
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to insert into Qdrant: {e}")
 
+    # Photos of samples dropped past MAX_SAMPLES_PER_IDENTITY
+    await delete_photos(store, trimmed_photos)
+
+    # A re-enrolled identity must not keep answering from a stale cached encoding/photo,
+    # nor a stored dedup answer from before this sample
+    await publish_cache_invalidation(redis, identifier)
+    await bump_gallery_generation(redis)
+
     return UploadResponse(
         message=f"{identifier} registered successfully!",
         identifier=identifier,
-        photo_path=save_path
+        photo_path=photo_url(photo_id, "full"),
+        thumbnail_url=photo_fields["photo"]
+    )
+
+# ========================
+# Bulk Enrollment
+# ========================
+class BulkUploadResponse(BaseModel):
+    job_id: str
+    status: str
+
+class BulkFailure(BaseModel):
+    identifier: str
+    error: str
+
+class BulkStatusResponse(BaseModel):
+    job_id: str
+    status: str
+    processed: int = 0
+    enrolled: int = 0
+    failed: int = 0
+    failures: List[BulkFailure] = []
+
+_process_pool = None
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=BULK_PROCESSES)
+    return _process_pool
+
+def load_enrollment_image(image_bytes: bytes) -> Image.Image:
+    pil_image = Image.open(io.BytesIO(image_bytes))
+    pil_image = ImageOps.exif_transpose(pil_image).convert("RGB")
+
+    if max(pil_image.size) > MAX_IMAGE_SIZE:
+        scale = min(MAX_IMAGE_SIZE / pil_image.size[0], MAX_IMAGE_SIZE / pil_image.size[1])
+        new_size = (int(pil_image.size[0] * scale), int(pil_image.size[1] * scale))
+        pil_image = pil_image.resize(new_size, Image.LANCZOS)
+    return pil_image
+
+def encode_for_enrollment(identifier: str, image_bytes: bytes, model: str, upsample: int):
+    # Runs in the process pool: decode, resize, encode and render the photo variants
+    try:
+        pil_image = load_enrollment_image(image_bytes)
+
+        image_np = np.asarray(pil_image)
+        face_locations = detect_faces(image_np, model, upsample)
+        encodings = face_models().face_encodings(image_np, face_locations) if face_locations else []
+        if not encodings:
+            return identifier, None, None, "No faces found in the image."
+
+        return identifier, encodings[0].tolist(), render_variants(pil_image), None
+    except Exception as e:
+        return identifier, None, None, str(e)
+
+def iter_entries(kind: str, path: str):
+    # Yields (identifier, image bytes) one entry at a time; nothing else is held in memory
+    if kind == "zip":
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and info.filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry_identifier(info.filename), archive.read(info)
+    elif kind == "tar":
+        with tarfile.open(path, "r|*") as archive:
+            for member in archive:
+                if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry_identifier(member.name), archive.extractfile(member).read()
+    else:
+        # Multipart batches are spooled as numbered files, identifiers in the manifest beside them,
+        # so several photos of one person never overwrite each other
+        with open(os.path.join(path, BULK_MANIFEST)) as f:
+            manifest = json.load(f)
+        for name, identifier in manifest:
+            with open(os.path.join(path, name), "rb") as f:
+                yield identifier, f.read()
+
+def entry_identifier(name: str) -> str:
+    return os.path.splitext(os.path.basename(name))[0]
+
+def valid_identifier(identifier: str) -> bool:
+    return bool(identifier) and identifier not in (".", "..") and not any(
+        sep in identifier for sep in ("/", "\\", os.sep)
+    )
+
+async def update_bulk_status(redis, job_id: str, **fields):
+    await redis.hset(f"{BULK_JOB_PREFIX}{job_id}", mapping=fields)
+    await redis.expire(f"{BULK_JOB_PREFIX}{job_id}", BULK_JOB_TTL_SECONDS)
+
+async def run_bulk_enrollment(job_id: str, kind: str, path: str, model: str, upsample: int,
+                              qdrant: QdrantClient, redis):
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    store = get_photo_store()
+    entries = iter_entries(kind, path)
+    in_flight = set()
+    points = []
+    counts = {"processed": 0, "enrolled": 0, "failed": 0}
+
+    async def flush():
+        if points:
+            batch = points[:]
+            points.clear()
+            with STAGE_LATENCY.labels("bulk_upsert").time():
+                await run_in_threadpool(qdrant.upsert, collection_name=COLLECTION_NAME, points=batch)
+            with STAGE_LATENCY.labels("bulk_centroids").time():
+                trimmed_photos = await run_in_threadpool(
+                    refresh_centroids, qdrant, {point.payload["identifier"] for point in batch}
+                )
+            await delete_photos(store, trimmed_photos)
+            await asyncio.gather(*(publish_cache_invalidation(redis, point.payload["identifier"]) for point in batch))
+            await bump_gallery_generation(redis)
+
+    async def collect(done):
+        for future in done:
+            identifier, encoding, photo, error = future.result()
+            counts["processed"] += 1
+            if error:
+                counts["failed"] += 1
+                await redis.rpush(
+                    f"{BULK_JOB_PREFIX}{job_id}:failures",
+                    json.dumps({"identifier": identifier, "error": error})
+                )
+                continue
+            counts["enrolled"] += 1
+            photo_fields = await save_photo(store, *photo)
+            points.append(PointStruct(
+                id=str(uuid.uuid4()),
+                vector=encoding,
+                payload=sample_payload(identifier, **photo_fields)
+            ))
+        if len(points) >= BULK_UPSERT_BATCH_SIZE:
+            await flush()
+        await update_bulk_status(redis, job_id, **counts)
+
+    try:
+        await update_bulk_status(redis, job_id, status="running", **counts)
+        while True:
+            entry = await run_in_threadpool(next, entries, None)
+            if entry is None:
+                break
+            identifier, image_bytes = entry
+            in_flight.add(loop.run_in_executor(pool, encode_for_enrollment, identifier, image_bytes, model, upsample))
+            # Bounded window: never more than BULK_MAX_IN_FLIGHT images decoded or queued at once
+            if len(in_flight) >= BULK_MAX_IN_FLIGHT:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                await collect(done)
+
+        if in_flight:
+            done, _ = await asyncio.wait(in_flight)
+            await collect(done)
+        await flush()
+        await update_bulk_status(redis, job_id, status="completed", **counts)
+    except Exception as e:
+        print(f"Bulk enrollment {job_id} failed: {e}")
+        await update_bulk_status(redis, job_id, status="failed", error=str(e), **counts)
+    finally:
+        entries.close()
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.unlink(path)
+
+async def spool_to_disk(file: UploadFile, path: str):
+    with open(path, "wb") as out:
+        while chunk := await file.read(SPOOL_CHUNK_SIZE):
+            await run_in_threadpool(out.write, chunk)
+
+@router.post("/upload/bulk", response_model=BulkUploadResponse, status_code=202)
+async def bulk_upload(
+    background_tasks: BackgroundTasks,
+    archive: Optional[UploadFile] = File(None),
+    files: Optional[List[UploadFile]] = File(None),
+    identifiers: Optional[List[str]] = Form(None),
+    detection_model: Optional[str] = Query(None),
+    upsample: Optional[int] = Query(None, ge=0, le=3),
+    qdrant: QdrantClient = Depends(get_qdrant_client),
+    redis=Depends(get_redis_async)
+):
+    # Either a zip/tar archive of <identifier>.<ext> entries, or a multipart batch of images
+    # (identifiers default to each file's name without extension)
+    try:
+        model, upsample = detection_settings("bulk", detection_model, upsample)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    job_id = str(uuid.uuid4())
+
+    if archive is not None:
+        name = (archive.filename or "").lower()
+        if name.endswith(".zip"):
+            kind = "zip"
+        elif name.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+            kind = "tar"
+        else:
+            raise HTTPException(status_code=400, detail="Archive must be .zip or .tar(.gz/.bz2/.xz).")
+        fd, path = tempfile.mkstemp(prefix="bulk-", suffix=f".{kind}")
+        os.close(fd)
+        try:
+            await spool_to_disk(archive, path)
+        except Exception:
+            os.unlink(path)
+            raise
+    elif files:
+        if identifiers and len(identifiers) != len(files):
+            raise HTTPException(status_code=400, detail="identifiers must match files one-to-one.")
+        names = identifiers or [entry_identifier(file.filename or "") for file in files]
+        # Validated before anything is written, so a rejected batch leaves nothing behind
+        for index, identifier in enumerate(names):
+            if not valid_identifier(identifier):
+                raise HTTPException(status_code=400, detail=f"Invalid identifier for file {index}.")
+        kind = "dir"
+        path = tempfile.mkdtemp(prefix="bulk-")
+        try:
+            manifest = []
+            for index, (file, identifier) in enumerate(zip(files, names)):
+                name = f"{index:06d}"
+                await spool_to_disk(file, os.path.join(path, name))
+                manifest.append((name, identifier))
+            with open(os.path.join(path, BULK_MANIFEST), "w") as f:
+                json.dump(manifest, f)
+        except Exception:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+    else:
+        raise HTTPException(status_code=400, detail="Send an archive or a batch of files.")
+
+    await update_bulk_status(redis, job_id, status="queued", processed=0, enrolled=0, failed=0)
+    background_tasks.add_task(run_bulk_enrollment, job_id, kind, path, model, upsample, qdrant, redis)
+    return BulkUploadResponse(job_id=job_id, status="queued")
+
+@router.get("/upload/bulk/{job_id}", response_model=BulkStatusResponse)
+async def bulk_upload_status(
+    job_id: str,
+    failures_limit: int = Query(100, ge=0, le=10000),
+    redis=Depends(get_redis_async)
+):
+    status = await redis.hgetall(f"{BULK_JOB_PREFIX}{job_id}")
+    if not status:
+        raise HTTPException(status_code=404, detail="Bulk job not found or expired.")
+
+    failures = []
+    if failures_limit:
+        failures = await redis.lrange(f"{BULK_JOB_PREFIX}{job_id}:failures", 0, failures_limit - 1)
+
+    return BulkStatusResponse(
+        job_id=job_id,
+        status=status.get("status", "unknown"),
+        processed=int(status.get("processed", 0)),
+        enrolled=int(status.get("enrolled", 0)),
+        failed=int(status.get("failed", 0)),
+        failures=[BulkFailure(**json.loads(failure)) for failure in failures]
     )
@@ -1,14 +1,28 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
 from pydantic import BaseModel
 from typing import List, Optional
-from qdrant_client import QdrantClient
-from qdrant import get_qdrant_client
+from qdrant_client import QdrantClient, AsyncQdrantClient
+from qdrant_client.models import (
+    Filter, FieldCondition, MatchText, MatchValue, PointIdsList, IsEmptyCondition, PayloadField
+)
+from qdrant import get_qdrant_client, get_async_qdrant_client
+from dependencies import get_redis_async
+from face_cache import publish_cache_invalidation
+from photo_store import get_photo_store, delete_photos
+from identities import delete_centroid, identity_id, unreferenced_photos
+from dedup import bump_gallery_generation
 from fastapi.concurrency import run_in_threadpool
 import os
+import json
+import uuid
 
 router = APIRouter()
 
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
+USERS_PAGE_SIZE = int(os.getenv("USERS_PAGE_SIZE", 100))
+USERS_MAX_PAGE_SIZE = int(os.getenv("USERS_MAX_PAGE_SIZE", 1000))
 
 class UserPayload(BaseModel):
     id: str
@@ -17,38 +31,176 @@ class UserPayload(BaseModel):
 
 class UsersResponse(BaseModel):
     users: List[UserPayload]
+    next_cursor: Optional[str] = None
 
-@router.get("/users/", response_model=UsersResponse)
-async def get_users(qdrant: QdrantClient = Depends(get_qdrant_client)):
-    def fetch_users():
-        users = []
+class DeleteUserResponse(BaseModel):
+    identifier: str
+    points_deleted: int
+    photos_deleted: int
+
+def parse_cursor(cursor: Optional[str]):
+    # Scroll offsets are point ids: UUID strings from /upload, integers otherwise
+    if cursor is None:
+        return None
+    if cursor.isdigit():
+        return int(cursor)
+    try:
+        return str(uuid.UUID(cursor))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+def prefix_filter(prefix: Optional[str]) -> Optional[Filter]:
+    if not prefix:
+        return None
+    return Filter(must=[FieldCondition(key="identifier", match=MatchText(text=prefix))])
 
-        points, next_page = qdrant.scroll(
+def is_match(point, prefix: Optional[str]) -> bool:
+    # The index matches any word of the identifier; keep only true prefixes
+    identifier = point.payload.get("identifier") if point.payload else None
+    return not prefix or (identifier or "").lower().startswith(prefix.lower())
+
+def to_user(point) -> UserPayload:
+    return UserPayload(
+        id=str(point.id),
+        identifier=point.payload.get("identifier") if point.payload else None,
+        photo=point.payload.get("photo") if point.payload else None
+    )
+
+async def scroll_page(qdrant: AsyncQdrantClient, limit: int, offset, prefix: Optional[str]):
+    # Keeps scrolling until limit true matches or the end, so a page is never short while
+    # a cursor remains; the cursor then resumes at the first match not returned
+    users = []
+    while True:
+        points, next_page = await qdrant.scroll(
             collection_name=COLLECTION_NAME,
-            limit=1000
+            scroll_filter=prefix_filter(prefix),
+            limit=limit,
+            offset=offset,
+            with_payload=["identifier", "photo"],
+            with_vectors=False
         )
-
         for point in points:
-            users.append(UserPayload(
-                id=str(point.id),
-                identifier=point.payload.get("identifier") if point.payload else None,
-                photo=point.payload.get("photo") if point.payload else None
-            ))
-
-        while next_page:
-            points, next_page = qdrant.scroll(
+            if not is_match(point, prefix):
+                continue
+            if len(users) == limit:
+                return users, point.id
+            users.append(to_user(point))
+        if next_page is None or len(users) == limit:
+            return users, next_page
+        offset = next_page
+
+# ========================
+# Endpoint Users
+# ========================
+@router.get("/users/", response_model=UsersResponse)
+async def get_users(
+    limit: int = Query(USERS_PAGE_SIZE, ge=1, le=USERS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+    prefix: Optional[str] = Query(None, description="identifier prefix, case-insensitive"),
+    stream: bool = Query(False, description="stream every matching user as NDJSON"),
+    qdrant: AsyncQdrantClient = Depends(get_async_qdrant_client)
+):
+    offset = parse_cursor(cursor)
+
+    if stream:
+        async def rows():
+            page_offset = offset
+            while True:
+                users, page_offset = await scroll_page(qdrant, limit, page_offset, prefix)
+                for user in users:
+                    yield json.dumps(jsonable_encoder(user)) + "\n"
+                if page_offset is None:
+                    break
+
+        return StreamingResponse(rows(), media_type="application/x-ndjson")
+
+    users, next_page = await scroll_page(qdrant, limit, offset, prefix)
+
+    return UsersResponse(users=users, next_cursor=str(next_page) if next_page is not None else None)
+
+# Samples enrolled before identity ids exist until rebuild_centroids.py backfills them;
+# none are added any more, so once they are gone the text-index fallback is skipped for good
+_legacy_samples = True
+
+def has_legacy_samples(qdrant: QdrantClient) -> bool:
+    global _legacy_samples
+    if _legacy_samples:
+        _legacy_samples = qdrant.count(
+            collection_name=COLLECTION_NAME,
+            count_filter=Filter(must=[IsEmptyCondition(is_empty=PayloadField(key="identity_id"))]),
+            exact=True
+        ).count > 0
+    return _legacy_samples
+
+def identity_filters(qdrant: QdrantClient, identifier: str) -> List[Filter]:
+    # The identity_id keyword index finds exactly this person's samples
+    filters = [Filter(must=[FieldCondition(key="identity_id", match=MatchValue(value=identity_id(identifier)))])]
+    if has_legacy_samples(qdrant):
+        filters.append(Filter(must=[
+            FieldCondition(key="identifier", match=MatchText(text=identifier)),
+            IsEmptyCondition(is_empty=PayloadField(key="identity_id"))
+        ]))
+    return filters
+
+def delete_identity(qdrant: QdrantClient, identifier: str):
+    point_ids = []
+    photo_ids = set()
+    legacy_photos = set()
+    for scroll_filter in identity_filters(qdrant, identifier):
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
                 collection_name=COLLECTION_NAME,
-                limit=1000,
-                offset=next_page
+                scroll_filter=scroll_filter,
+                limit=USERS_MAX_PAGE_SIZE,
+                offset=offset,
+                with_payload=["identifier", "photo", "photo_id"],
+                with_vectors=False
             )
             for point in points:
-                users.append(UserPayload(
-                    id=str(point.id),
-                    identifier=point.payload.get("identifier") if point.payload else None,
-                    photo=point.payload.get("photo") if point.payload else None
-                ))
+                # The legacy text filter also matches other identifiers sharing a word
+                if not point.payload or point.payload.get("identifier") != identifier:
+                    continue
+                point_ids.append(point.id)
+                if point.payload.get("photo_id"):
+                    photo_ids.add(point.payload["photo_id"])
+                elif point.payload.get("photo"):
+                    # Enrolled before the photo store: a plain file path
+                    legacy_photos.add(point.payload["photo"])
+            if offset is None:
+                break
+
+    if point_ids:
+        qdrant.delete(collection_name=COLLECTION_NAME, points_selector=PointIdsList(points=point_ids), wait=True)
+        delete_centroid(qdrant, identifier)
+
+    # Content-addressed photos may still belong to another identity
+    photo_ids = unreferenced_photos(qdrant, photo_ids)
+
+    legacy_deleted = 0
+    for photo in legacy_photos:
+        try:
+            os.unlink(photo)
+            legacy_deleted += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            print(f"Could not delete photo {photo}: {e}")
+    return len(point_ids), photo_ids, legacy_deleted
+
+@router.delete("/users/{identifier}", response_model=DeleteUserResponse)
+async def delete_user(
+    identifier: str,
+    qdrant: QdrantClient = Depends(get_qdrant_client),
+    redis=Depends(get_redis_async)
+):
+    points_deleted, photo_ids, legacy_deleted = await run_in_threadpool(delete_identity, qdrant, identifier)
+    if not points_deleted:
+        raise HTTPException(status_code=404, detail="User not found.")
 
-        return users
+    photos_deleted = await delete_photos(get_photo_store(), photo_ids) + legacy_deleted
 
-    users = await run_in_threadpool(fetch_users)
-    return UsersResponse(users=users)
+    # Drops the identity from every API and worker face cache, and every stored dedup answer
+    await publish_cache_invalidation(redis, identifier)
+    await bump_gallery_generation(redis)
+    return DeleteUserResponse(identifier=identifier, points_deleted=points_deleted, photos_deleted=photos_deleted)
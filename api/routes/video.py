@@ -0,0 +1,93 @@
+from fastapi import APIRouter, File, UploadFile, Depends, HTTPException, Query
+from pydantic import BaseModel
+from typing import List, Optional
+import os
+import json
+import uuid
+
+from dependencies import get_redis_async, get_publisher
+from detection import detection_settings
+from results import store_pending
+from utils import publish_job
+
+router = APIRouter()
+
+# ========================
+# CONFIGS
+# ========================
+# Videos travel through RabbitMQ whole, so keep them well under its message size limit
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_BYTES", 50 * 1024 * 1024))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", 3000))
+READ_CHUNK_SIZE = 1024 * 1024
+
+class VideoJobResponse(BaseModel):
+    job_id: str
+    status: str
+
+def too_large() -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Upload larger than {VIDEO_MAX_BYTES} bytes.")
+
+async def read_limited(uploads: List[UploadFile]) -> List[bytes]:
+    # Stops at the first chunk past VIDEO_MAX_BYTES (summed over all uploads) instead of
+    # buffering the whole request; declared sizes are rejected before reading anything
+    if sum(upload.size or 0 for upload in uploads) > VIDEO_MAX_BYTES:
+        raise too_large()
+    parts = []
+    total = 0
+    for upload in uploads:
+        chunks = []
+        while chunk := await upload.read(READ_CHUNK_SIZE):
+            total += len(chunk)
+            if total > VIDEO_MAX_BYTES:
+                raise too_large()
+            chunks.append(chunk)
+        parts.append(b"".join(chunks))
+    return parts
+
+# ========================
+# Endpoint Video
+# ========================
+@router.post("/video-recognition", response_model=VideoJobResponse)
+async def video_recognition(
+    file: Optional[UploadFile] = File(None, description="video file"),
+    frames: Optional[List[UploadFile]] = File(None, description="or a sequence of frames, in order"),
+    detection_model: Optional[str] = Query(None),
+    upsample: Optional[int] = Query(None, ge=0, le=3),
+    publisher=Depends(get_publisher),
+    redis_client=Depends(get_redis_async)
+):
+    # Tracked in a WORKER_MODE=video worker; the result (one identity per track) is read
+    # from GET /jobs/{job_id} or WS /ws/{job_id}
+    if (file is None) == (not frames):
+        raise HTTPException(status_code=400, detail="Send either a video file or a sequence of frames.")
+
+    try:
+        model, upsample = detection_settings("video", detection_model, upsample)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    headers = {"detection_model": model, "detection_upsample": upsample}
+    if file is not None:
+        if not file.content_type.startswith("video/"):
+            raise HTTPException(status_code=400, detail="Invalid file type.")
+        body, = await read_limited([file])
+        payload_type = "video"
+        content_type = file.content_type
+    else:
+        if len(frames) > VIDEO_MAX_FRAMES:
+            raise HTTPException(status_code=400, detail=f"At most {VIDEO_MAX_FRAMES} frames per request.")
+        if any(not frame.content_type.startswith("image/") for frame in frames):
+            raise HTTPException(status_code=400, detail="Invalid file type.")
+        # Concatenated as-is; the worker splits them back with the sizes header
+        parts = await read_limited(frames)
+        body = b"".join(parts)
+        headers["frame_sizes"] = json.dumps([len(part) for part in parts])
+        payload_type = "frames"
+        content_type = "application/octet-stream"
+
+    job_id = str(uuid.uuid4())
+    await store_pending(redis_client, job_id)
+    await publish_job(
+        publisher, job_id, body, payload_type=payload_type, content_type=content_type, headers=headers
+    )
+    return VideoJobResponse(job_id=job_id, status="pending")
@@ -1,23 +1,23 @@
 from fastapi import APIRouter, WebSocket, WebSocketDisconnect
-import aioredis
+import os
 
 router = APIRouter()
 
+WEBSOCKET_TIMEOUT_SECONDS = float(os.getenv("WEBSOCKET_TIMEOUT_SECONDS", 60))
+
 
 @router.websocket("/ws/{job_id}")
 async def websocket_endpoint(websocket: WebSocket, job_id: str):
     await websocket.accept()
-    pubsub = redis_async.pubsub()
-    await pubsub.subscribe(f"face_job_done:{job_id}")
+    broker = websocket.app.state.result_broker
 
     try:
-        async for message in pubsub.listen():
-            if message['type'] == 'message':
-                data = message['data']
-                await websocket.send_text(data)
+        result = await broker.wait(job_id, WEBSOCKET_TIMEOUT_SECONDS)
+        if result is None:
+            await websocket.send_json({"job_id": job_id, "status": "not_found"})
+        else:
+            await websocket.send_json(result)
     except WebSocketDisconnect:
-        pass
-    finally:
-        await pubsub.unsubscribe(f"face_job_done:{job_id}")
-        await pubsub.close()
-        await websocket.close()
+        return
+
+    await websocket.close()
@@ -0,0 +1,33 @@
+import os
+import time
+import random
+import asyncio
+
+# =========================
+# ENV CONFIG
+# =========================
+# Each dependency is retried with jittered exponential backoff until this deadline
+STARTUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_TIMEOUT_SECONDS", 60))
+STARTUP_BACKOFF_INITIAL = float(os.getenv("STARTUP_BACKOFF_INITIAL", 0.1))
+STARTUP_BACKOFF_MAX = float(os.getenv("STARTUP_BACKOFF_MAX", 3))
+
+# =========================
+# BACKOFF
+# =========================
+async def with_backoff(name: str, connect, timeout: float = STARTUP_TIMEOUT_SECONDS):
+    # Short first retries catch a dependency that is a moment away; the cap keeps a slow one from hammering
+    deadline = time.monotonic() + timeout
+    delay = STARTUP_BACKOFF_INITIAL
+    attempt = 1
+    while True:
+        try:
+            result = await connect()
+            print(f"Connected to {name} (attempt {attempt})")
+            return result
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                raise RuntimeError(f"Cannot connect to {name} after {attempt} attempts: {e}") from e
+            print(f"{name} not ready, retry {attempt} in {delay:.1f}s... Error: {e}")
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, STARTUP_BACKOFF_MAX)
+            attempt += 1
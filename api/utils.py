@@ -1,32 +1,68 @@
-import io
-import json
-import pika
-from urllib.parse import quote_plus
+import os
+import time
+import numpy as np
+from aio_pika import Message, DeliveryMode
+from metrics import JOBS_PUBLISHED
 
 # =========================
 # ENV CONFIG
 # =========================
 QUEUE_NAME = os.getenv("QUEUE_NAME", "face_recognition_jobs")
-RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "rabbitmq")
-RABBITMQ_PORT = os.getenv("RABBITMQ_PORT", "5672")
-RABBITMQ_USER = os.getenv("RABBITMQ_USER", "guest")
-RABBITMQ_PASSWORD = quote_plus(os.getenv("RABBITMQ_PASSWORD", "guest"))
-RABBITMQ_VHOST = os.getenv("RABBITMQ_VHOST", "/")
-RABBITMQ_URL = (
-    f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASSWORD}"
-    f"@{RABBITMQ_HOST}:{RABBITMQ_PORT}/{quote_plus(RABBITMQ_VHOST)}"
-)
+# Filled by the worker once a job has used up its retries
+DEAD_LETTER_QUEUE = os.getenv("DEAD_LETTER_QUEUE", f"{QUEUE_NAME}.dead")
+# Priority lanes as "name:weight", highest priority first; workers split their prefetch by weight
+LANE_WEIGHTS = {
+    lane: int(weight) for lane, weight in (
+        item.split(":") for item in os.getenv("JOB_LANES", "interactive:3,batch:1").split(",")
+    )
+}
+JOB_LANES = list(LANE_WEIGHTS)
+DEFAULT_LANE = JOB_LANES[0]
 
-def publish_job_to_rabbitmq(channel, job_id: str, encoding: list[float], queue_name: str = QUEUE_NAME):
-    message = json.dumps({
-        "job_id": job_id,
-        "encoding": encoding
-    })
-    channel.basic_publish(
-        exchange='',
-        routing_key=queue_name,
-        body=message,
-        properties=pika.BasicProperties(
-            delivery_mode=2,
-        )
-    )
\ No newline at end of file
+# Videos and frame sequences go to workers started with WORKER_MODE=video
+VIDEO_QUEUE = os.getenv("VIDEO_QUEUE", f"{QUEUE_NAME}.video")
+VIDEO_PAYLOAD_TYPES = ("video", "frames")
+
+def lane_queue(lane: str) -> str:
+    # The top lane keeps the original queue, so jobs queued before lanes existed still run
+    return QUEUE_NAME if lane == DEFAULT_LANE else f"{QUEUE_NAME}.{lane}"
+
+def job_queue(payload_type: str, lane: str) -> str:
+    return VIDEO_QUEUE if payload_type in VIDEO_PAYLOAD_TYPES else lane_queue(lane)
+
+# Encodings travel as little-endian float64, the dtype face_recognition returns
+ENCODING_DTYPE = "<f8"
+
+async def publish_job(publisher, job_id: str, body: bytes, payload_type: str = "image",
+                      content_type: str = None, headers: dict = None, lane: str = DEFAULT_LANE):
+    await publisher.publish(
+        Message(
+            body=body,
+            headers={
+                **(headers or {}),
+                "job_id": job_id,
+                "payload_type": payload_type,
+                "lane": lane,
+                "submitted_at": time.time()
+            },
+            content_type=content_type,
+            message_id=job_id,
+            delivery_mode=DeliveryMode.PERSISTENT
+        ),
+        routing_key=job_queue(payload_type, lane)
+    )
+    JOBS_PUBLISHED.labels(payload_type).inc()
+
+async def publish_job_to_rabbitmq(publisher, job_id: str, encoding, headers: dict = None,
+                                  lane: str = DEFAULT_LANE):
+    # One vector, or several stacked row-wise for multi-face jobs
+    body = np.asarray(encoding, dtype=ENCODING_DTYPE).tobytes()
+    await publish_job(
+        publisher,
+        job_id,
+        body,
+        payload_type="encoding",
+        content_type="application/octet-stream",
+        headers=headers,
+        lane=lane
+    )
@@ -0,0 +1,465 @@
+"""Offline benchmark for the recognition hot paths.
+
+Drives the code that actually ships, so a change to either hot path shows up
+here:
+
+- worker: worker.process_batch on micro-batches of image jobs (encode_batch /
+  extract_faces in the real process pool) and of encoding jobs (local cache,
+  then search_identities);
+- API: preprocess_image, detect_faces and recognize_image from
+  api/routes/recognition.py, and the two-stage search_identities_batch.
+
+Only the I/O boundaries are replaced: an in-memory AsyncQdrantClient (or
+--qdrant-url), fakeredis, and a channel that records what would have been
+published to RabbitMQ. Galleries are synthetic: random 128-d people with a few
+samples each, stored with the same payload and centroids as real enrollments.
+
+    python bench/bench_pipeline.py --gallery-sizes 1000,10000,100000 --jobs 200
+
+The worker half needs the worker's dependencies (dlib, face_recognition,
+aioredis); without them only the API half runs. Synthetic images contain no
+faces, so detect runs but encode and recognize only do with --images-dir.
+"""
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import importlib
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from PIL import Image
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import VectorParams, Distance, PointStruct, PayloadSchemaType
+import fakeredis.aioredis
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+VECTOR_SIZE = 128
+UPSERT_BATCH_SIZE = 5000
+
+
+# ==========================
+# IMPORTS
+# ==========================
+def import_side(directory: str, names: list) -> list:
+    # api/ and worker/ both have detection, face_cache and metrics modules: each side is
+    # imported with only its own directory on the path, then its top-level modules are
+    # dropped from sys.modules so the other side resolves its own. "worker" itself stays
+    # registered, the process pool pickles extract_faces by reference to it
+    directory = os.path.abspath(directory)
+    before = set(sys.modules)
+    sys.path.insert(0, directory)
+    try:
+        modules = [importlib.import_module(name) for name in names]
+    finally:
+        sys.path.remove(directory)
+        for name in set(sys.modules) - before - {"worker"}:
+            path = getattr(sys.modules[name], "__file__", None) or ""
+            if os.path.abspath(path).startswith(directory):
+                del sys.modules[name]
+    return modules
+
+
+def load_modules(args):
+    # Both sides read their settings at import time
+    os.environ.setdefault("COLLECTION_NAME", "bench_faces")
+    os.environ.setdefault("FOTOS_DIR", os.path.join(tempfile.gettempdir(), "bench_photos"))
+    os.environ["SEARCH_MODE"] = args.search_mode
+
+    worker = None
+    try:
+        (worker,) = import_side(os.path.join(ROOT, "worker"), ["worker"])
+    except ImportError as e:
+        print(f"worker dependencies not installed ({e}): worker path skipped")
+
+    identities, api_face_cache, api_metrics, recognition = import_side(
+        os.path.join(ROOT, "api"), ["identities", "face_cache", "metrics", "routes.recognition"]
+    )
+    return worker, identities, api_face_cache, api_metrics, recognition
+
+
+# ==========================
+# FAKE I/O
+# ==========================
+class FakeMessage:
+    """The parts of aio_pika's IncomingMessage the worker reads."""
+
+    def __init__(self, body: bytes, headers: dict, content_type: str = None):
+        self.body = body
+        self.headers = headers
+        self.content_type = content_type
+        self.message_id = headers["job_id"]
+        self.settled = None
+
+    async def ack(self):
+        self.settled = "ack"
+
+    async def nack(self, requeue: bool = True):
+        self.settled = "nack"
+
+
+class FakeExchange:
+    def __init__(self):
+        self.published = 0
+
+    async def publish(self, message, routing_key: str, **kwargs):
+        self.published += 1
+
+
+class FakeChannel:
+    """Stands in for the worker's RabbitMQ channel: publishes are counted, not sent."""
+
+    def __init__(self):
+        self.default_exchange = FakeExchange()
+
+
+# ==========================
+# SYNTHETIC DATA
+# ==========================
+def unit_vectors(rng, count: int) -> np.ndarray:
+    # face_recognition encodings are roughly unit-norm with small per-dimension values
+    vectors = rng.normal(0.0, 1.0, size=(count, VECTOR_SIZE))
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def near(rng, vector: np.ndarray, distance: float) -> np.ndarray:
+    direction = rng.normal(size=VECTOR_SIZE)
+    return vector + direction / np.linalg.norm(direction) * distance
+
+
+def synthetic_jpeg(rng, width: int, height: int) -> bytes:
+    # Smooth gradients plus noise: compresses like a photo rather than pure noise
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 // width, y * 255 // height, (x + y) * 255 // (width + height)], axis=-1)
+    noise = rng.integers(0, 32, size=(height, width, 3))
+    image = Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+def load_images(args, rng) -> list:
+    if args.images_dir:
+        paths = sorted(
+            os.path.join(args.images_dir, name) for name in os.listdir(args.images_dir)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        images = []
+        for path in paths[:args.images] if args.images else paths:
+            with open(path, "rb") as f:
+                images.append(f.read())
+        return images
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    return [synthetic_jpeg(rng, width, height) for _ in range(args.images or 4)]
+
+
+async def build_gallery(qdrant: AsyncQdrantClient, identities, rng, people: int, samples: int) -> np.ndarray:
+    # Same layout as enrollment: samples with identity_id in the sample collection,
+    # one mean vector per person in the centroid collection
+    for name in (identities.COLLECTION_NAME, identities.CENTROID_COLLECTION):
+        if await qdrant.collection_exists(name):
+            await qdrant.delete_collection(name)
+        await qdrant.create_collection(
+            collection_name=name, vectors_config=VectorParams(size=VECTOR_SIZE, distance=Distance.EUCLID)
+        )
+        await qdrant.create_payload_index(name, "identity_id", PayloadSchemaType.KEYWORD)
+
+    people_vectors = unit_vectors(rng, people)
+    for start in range(0, people, UPSERT_BATCH_SIZE // samples):
+        chunk = range(start, min(people, start + UPSERT_BATCH_SIZE // samples))
+        sample_points, centroid_points = [], []
+        for person in chunk:
+            identifier = f"person-{person}"
+            vectors = [near(rng, people_vectors[person], 0.2) for _ in range(samples)]
+            for vector in vectors:
+                sample_points.append(PointStruct(
+                    id=str(uuid.uuid4()),
+                    vector=vector.tolist(),
+                    payload=identities.sample_payload(identifier, photo=f"{identifier}.jpg")
+                ))
+            centroid_points.append(PointStruct(
+                id=identities.identity_id(identifier),
+                vector=np.mean(vectors, axis=0).tolist(),
+                payload={"identifier": identifier, "identity_id": identities.identity_id(identifier),
+                         "photo": f"{identifier}.jpg", "samples": samples}
+            ))
+        await qdrant.upsert(identities.COLLECTION_NAME, points=sample_points, wait=True)
+        await qdrant.upsert(identities.CENTROID_COLLECTION, points=centroid_points, wait=True)
+    return people_vectors
+
+
+def probes(rng, people_vectors: np.ndarray, count: int) -> list:
+    # Half the probes are repeat visitors close to a gallery person, half are strangers
+    return [
+        near(rng, people_vectors[rng.integers(len(people_vectors))], 0.1) if index % 2 else unit_vectors(rng, 1)[0]
+        for index in range(count)
+    ]
+
+
+# ==========================
+# MEASUREMENT
+# ==========================
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {}
+    values = np.asarray(samples) * 1000
+    return {
+        "count": len(samples),
+        "p50_ms": round(float(np.percentile(values, 50)), 4),
+        "p95_ms": round(float(np.percentile(values, 95)), 4),
+        "p99_ms": round(float(np.percentile(values, 99)), 4),
+        "mean_ms": round(float(values.mean()), 4),
+    }
+
+
+def histogram_totals(histogram) -> dict:
+    # (sum, count) per stage label of a prometheus Histogram
+    totals = {}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            stage = sample.labels.get("stage")
+            if sample.name.endswith("_sum"):
+                totals.setdefault(stage, [0.0, 0])[0] = sample.value
+            elif sample.name.endswith("_count"):
+                totals.setdefault(stage, [0.0, 0])[1] = int(sample.value)
+    return totals
+
+
+def histogram_delta(before: dict, after: dict) -> dict:
+    # Stage timings recorded by the code under test itself: mean only, the buckets are too coarse
+    stages = {}
+    for stage, (total, count) in after.items():
+        previous_total, previous_count = before.get(stage, (0.0, 0))
+        if count > previous_count:
+            stages[stage] = {
+                "count": count - previous_count,
+                "mean_ms": round((total - previous_total) / (count - previous_count) * 1000, 4),
+            }
+    return stages
+
+
+# ==========================
+# WORKER PATH
+# ==========================
+def worker_message(job_id: str, body: bytes, payload_type: str) -> FakeMessage:
+    return FakeMessage(body, {
+        "job_id": job_id,
+        "payload_type": payload_type,
+        "lane": "interactive",
+        "submitted_at": time.time(),
+    }, "application/octet-stream" if payload_type == "encoding" else "image/jpeg")
+
+
+async def run_worker(args, worker, qdrant, redis, images: list, probe_vectors: list, process_pool) -> dict:
+    face_cache = worker.FaceCache(dim=VECTOR_SIZE, capacity=args.cache_size, ttl_seconds=3600)
+    channel = FakeChannel()
+    report = {}
+    for payload_type in ("image", "encoding"):
+        messages = [
+            worker_message(
+                f"{payload_type}-{index}",
+                images[index % len(images)] if payload_type == "image"
+                else np.asarray(probe_vectors[index], dtype=worker.ENCODING_DTYPE).tobytes(),
+                payload_type
+            )
+            for index in range(args.jobs)
+        ]
+
+        before = histogram_totals(worker.STAGE_LATENCY)
+        batch_latency = []
+        started = time.perf_counter()
+        for start in range(0, len(messages), args.batch_size):
+            batch = messages[start:start + args.batch_size]
+            t0 = time.perf_counter()
+            await worker.process_batch(batch, redis, qdrant, channel, face_cache, process_pool)
+            batch_latency.append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - started
+
+        report[f"{payload_type}_jobs"] = {
+            "jobs_per_second": round(len(messages) / elapsed, 2),
+            "batch": percentiles(batch_latency),
+            "stages": histogram_delta(before, histogram_totals(worker.STAGE_LATENCY)),
+            "unsettled": sum(1 for message in messages if message.settled != "ack"),
+        }
+    report["published"] = channel.default_exchange.published
+    return report
+
+
+# ==========================
+# API PATH
+# ==========================
+async def run_api(args, identities, api_face_cache, api_metrics, recognition, qdrant, redis,
+                  images: list, probe_vectors: list, use_dlib: bool) -> dict:
+    face_cache = api_face_cache.FaceCache(dim=VECTOR_SIZE, capacity=args.cache_size, ttl_seconds=3600)
+    model, upsample = recognition.detection_settings("sync")
+    timings = {stage: [] for stage in ("preprocess", "detect", "recognize", "cache_lookup", "vector_search")}
+    no_face = 0
+
+    before = histogram_totals(api_metrics.STAGE_LATENCY)
+    started = time.perf_counter()
+    for job in range(args.jobs):
+        t0 = time.perf_counter()
+        pil_image, scale = recognition.preprocess_image(images[job % len(images)])
+        image_array = np.asarray(pil_image)
+        timings["preprocess"].append(time.perf_counter() - t0)
+
+        if use_dlib:
+            t0 = time.perf_counter()
+            recognition.detect_faces(image_array, model, upsample)
+            timings["detect"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            try:
+                await recognition.recognize_image(
+                    image_array, scale, args.top_k, recognition.CACHE_SCORE_THRESHOLD_QDRANT, False,
+                    model, upsample, qdrant, redis, face_cache
+                )
+                timings["recognize"].append(time.perf_counter() - t0)
+            except recognition.HTTPException:
+                no_face += 1
+
+        # The search half of a sync request, for every probe whatever the images hold
+        probe = probe_vectors[job]
+        t0 = time.perf_counter()
+        hit = recognition.cache_lookup(face_cache, probe, recognition.CACHE_SCORE_THRESHOLD_QDRANT)
+        timings["cache_lookup"].append(time.perf_counter() - t0)
+        if hit is None:
+            t0 = time.perf_counter()
+            results = await identities.search_identities_batch(
+                qdrant, [probe], args.top_k, recognition.CACHE_SCORE_THRESHOLD_QDRANT
+            )
+            timings["vector_search"].append(time.perf_counter() - t0)
+            candidates = recognition.to_candidates(results[0])
+            if candidates:
+                await recognition.remember_match(redis, face_cache, candidates[0], probe)
+    elapsed = time.perf_counter() - started
+
+    return {
+        "jobs_per_second": round(args.jobs / elapsed, 2),
+        "stages": {stage: percentiles(samples) for stage, samples in timings.items() if samples},
+        "recorded_stages": histogram_delta(before, histogram_totals(api_metrics.STAGE_LATENCY)),
+        "no_face": no_face,
+    }
+
+
+# ==========================
+# RUN
+# ==========================
+async def run_gallery(args, modules, rng, qdrant, images: list, gallery_size: int, process_pool) -> dict:
+    worker, identities, api_face_cache, api_metrics, recognition = modules
+    started = time.perf_counter()
+    people_vectors = await build_gallery(qdrant, identities, rng, gallery_size, args.samples_per_person)
+    build_seconds = time.perf_counter() - started
+    probe_vectors = probes(rng, people_vectors, args.jobs)
+
+    redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+    report = {
+        "gallery_size": gallery_size,
+        "samples_per_person": args.samples_per_person,
+        "search_mode": args.search_mode,
+        "jobs": args.jobs,
+        "build_seconds": round(build_seconds, 3),
+    }
+    try:
+        report["api"] = await run_api(
+            args, identities, api_face_cache, api_metrics, recognition, qdrant, redis,
+            images, probe_vectors, not args.skip_dlib
+        )
+        if worker is not None:
+            report["worker"] = await run_worker(args, worker, qdrant, redis, images, probe_vectors, process_pool)
+    finally:
+        await redis.aclose()
+    return report
+
+
+def print_stages(title: str, stages: dict):
+    print(f"  {title}")
+    print(f"    {'stage':<22}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'mean ms':>10}")
+    for stage, stats in stages.items():
+        cells = "".join(
+            f"{stats[key]:>10.3f}" if key in stats else f"{'-':>10}" for key in ("p50_ms", "p95_ms", "p99_ms")
+        )
+        print(f"    {stage:<22}{stats['count']:>7}{cells}{stats['mean_ms']:>10.3f}")
+
+
+def print_report(report: dict):
+    print(f"\n== gallery={report['gallery_size']:,} people x {report['samples_per_person']} samples "
+          f"search={report['search_mode']} jobs={report['jobs']} build={report['build_seconds']}s")
+    api = report["api"]
+    no_face = f", no face in {api['no_face']} images" if api["no_face"] else ""
+    print(f"API: {api['jobs_per_second']} jobs/s{no_face}")
+    print_stages("measured", api["stages"])
+    if api["recorded_stages"]:
+        print_stages("recorded by the API (face_api_stage_seconds)", api["recorded_stages"])
+    if "worker" in report:
+        for kind in ("image_jobs", "encoding_jobs"):
+            run = report["worker"][kind]
+            print(f"Worker, {kind.replace('_', ' ')}: {run['jobs_per_second']} jobs/s, "
+                  f"{run['unsettled']} not acked")
+            print_stages("recorded by the worker (face_worker_stage_seconds)", {"batch": run["batch"], **run["stages"]})
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark the face recognition pipeline offline.")
+    parser.add_argument("--gallery-sizes", default="1000,10000,100000",
+                        help="comma-separated number of people, up to 1000000")
+    parser.add_argument("--samples-per-person", type=int, default=3)
+    parser.add_argument("--search-mode", default="two_stage", choices=("two_stage", "flat"))
+    parser.add_argument("--jobs", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=16, help="worker micro-batch size")
+    parser.add_argument("--images-dir", default=None, help="real photos to use instead of synthetic ones")
+    parser.add_argument("--image-size", default="3000x4000", help="synthetic upload size WxH (phone photo)")
+    parser.add_argument("--images", type=int, default=None, help="distinct images to cycle through")
+    parser.add_argument("--cache-size", type=int, default=10000)
+    parser.add_argument("--top-k", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--qdrant-url", default=None, help="benchmark a real Qdrant instead of :memory:")
+    parser.add_argument("--skip-dlib", action="store_true", help="skip detection and recognition in the API path")
+    parser.add_argument("--json", dest="json_path", default=None, help="also write the report to this file")
+    args = parser.parse_args()
+
+    modules = load_modules(args)
+    worker, recognition = modules[0], modules[-1]
+    if not args.skip_dlib:
+        try:
+            recognition.face_models()
+        except ImportError:
+            print("face_recognition not installed: API detection and recognition skipped")
+            args.skip_dlib = True
+
+    rng = np.random.default_rng(args.seed)
+    images = load_images(args, rng)
+    qdrant = AsyncQdrantClient(url=args.qdrant_url) if args.qdrant_url else AsyncQdrantClient(":memory:")
+
+    process_pool = None
+    if worker is not None:
+        # Forked after the worker module (and its dlib models) is loaded, as in the worker
+        process_pool = ProcessPoolExecutor(
+            max_workers=worker.WORKER_PROCESSES, mp_context=multiprocessing.get_context("fork")
+        )
+        await worker.warm_up_pool(process_pool)
+
+    reports = []
+    try:
+        for gallery_size in (int(v) for v in args.gallery_sizes.split(",")):
+            report = await run_gallery(args, modules, rng, qdrant, images, gallery_size, process_pool)
+            print_report(report)
+            reports.append(report)
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+        await qdrant.close()
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"seed": args.seed, "image_size": args.image_size, "reports": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
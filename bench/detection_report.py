@@ -0,0 +1,143 @@
+"""Speed/accuracy report for face detection settings.
+
+Runs every combination of model, upsample count and detection size over a
+directory of real photos and compares each against the baseline (HOG, one
+upsample, detection at the full working resolution):
+
+    python bench/detection_report.py --images-dir photos/ --models hog,cnn --detect-sizes 0,320,480,640
+
+Recall is the share of baseline faces found again (box IoU >= --iou); the
+encoding drift column is the mean Euclidean distance between the encoding of
+each re-found face and its baseline encoding, on the same scale as the
+recognition thresholds.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+from PIL import Image, ImageOps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "worker"))
+import face_recognition  # noqa: E402
+from detection import detect_faces  # noqa: E402
+
+# ==========================
+# CONFIG
+# ==========================
+MAX_IMAGE_SIZE = 1000
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+BASELINE = ("hog", 1, 0)
+
+
+def load_image(path: str) -> np.ndarray:
+    pil_image = ImageOps.exif_transpose(Image.open(path)).convert("RGB")
+    if max(pil_image.size) > MAX_IMAGE_SIZE:
+        scale = MAX_IMAGE_SIZE / max(pil_image.size)
+        pil_image = pil_image.resize(
+            (int(pil_image.size[0] * scale), int(pil_image.size[1] * scale)),
+            Image.LANCZOS
+        )
+    return np.asarray(pil_image)
+
+
+def iou(a, b) -> float:
+    top, right, bottom, left = max(a[0], b[0]), min(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    area_a = (a[1] - a[3]) * (a[2] - a[0])
+    area_b = (b[1] - b[3]) * (b[2] - b[0])
+    return inter / float(area_a + area_b - inter) if inter else 0.0
+
+
+def run_setting(images: list, model: str, upsample: int, detect_size: int) -> list:
+    runs = []
+    for image in images:
+        started = time.perf_counter()
+        locations = detect_faces(image, model, upsample, detect_size)
+        detected = time.perf_counter()
+        encodings = face_recognition.face_encodings(image, locations) if locations else []
+        encoded = time.perf_counter()
+        runs.append({
+            "locations": locations,
+            "encodings": encodings,
+            "detect_s": detected - started,
+            "encode_s": encoded - detected,
+        })
+    return runs
+
+
+def compare(baseline: list, runs: list, iou_threshold: float) -> dict:
+    expected = found = extra = 0
+    drifts = []
+    for base, run in zip(baseline, runs):
+        expected += len(base["locations"])
+        matched = set()
+        for base_box, base_encoding in zip(base["locations"], base["encodings"]):
+            candidates = [
+                (iou(base_box, box), index) for index, box in enumerate(run["locations"]) if index not in matched
+            ]
+            best = max(candidates, default=(0.0, None))
+            if best[0] >= iou_threshold:
+                matched.add(best[1])
+                found += 1
+                drifts.append(float(np.linalg.norm(base_encoding - run["encodings"][best[1]])))
+        extra += len(run["locations"]) - len(matched)
+
+    detect_ms = np.asarray([run["detect_s"] for run in runs]) * 1000
+    encode_ms = np.asarray([run["encode_s"] for run in runs]) * 1000
+    return {
+        "detect_p50_ms": round(float(np.percentile(detect_ms, 50)), 2),
+        "detect_p95_ms": round(float(np.percentile(detect_ms, 95)), 2),
+        "encode_p50_ms": round(float(np.percentile(encode_ms, 50)), 2),
+        "recall": round(found / expected, 4) if expected else None,
+        "extra_faces": extra,
+        "encoding_drift": round(float(np.mean(drifts)), 4) if drifts else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare face detection settings for speed and recall.")
+    parser.add_argument("--images-dir", required=True)
+    parser.add_argument("--models", default="hog")
+    parser.add_argument("--upsample", default="0,1")
+    parser.add_argument("--detect-sizes", default="0,320,480,640", help="0 = full working resolution")
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    paths = sorted(
+        os.path.join(args.images_dir, name) for name in os.listdir(args.images_dir)
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    images = [load_image(path) for path in paths]
+    print(f"{len(images)} images loaded from {args.images_dir}")
+
+    baseline = run_setting(images, *BASELINE)
+    settings = itertools.product(
+        args.models.split(","),
+        (int(v) for v in args.upsample.split(",")),
+        (int(v) for v in args.detect_sizes.split(",")),
+    )
+
+    rows = []
+    print(f"{'model':<6}{'up':>4}{'size':>6}{'det p50':>10}{'det p95':>10}{'enc p50':>10}"
+          f"{'recall':>9}{'extra':>7}{'drift':>8}")
+    for model, upsample, detect_size in settings:
+        runs = baseline if (model, upsample, detect_size) == BASELINE else run_setting(
+            images, model, upsample, detect_size
+        )
+        row = {"model": model, "upsample": upsample, "detect_size": detect_size, **compare(baseline, runs, args.iou)}
+        rows.append(row)
+        print(f"{model:<6}{upsample:>4}{detect_size or 'full':>6}{row['detect_p50_ms']:>10.1f}"
+              f"{row['detect_p95_ms']:>10.1f}{row['encode_p50_ms']:>10.1f}{row['recall'] or 0:>9.3f}"
+              f"{row['extra_faces']:>7}{row['encoding_drift'] or 0:>8.4f}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"images": len(images), "baseline": BASELINE, "settings": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
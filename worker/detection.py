@@ -0,0 +1,51 @@
+import os
+import numpy as np
+from PIL import Image
+import face_recognition
+
+# ==========================
+# ENV CONFIG
+# ==========================
+DETECTION_MODELS = ("hog", "cnn")
+DETECTION_MODEL = os.getenv("DETECTION_MODEL", "hog")
+DETECTION_UPSAMPLE = int(os.getenv("DETECTION_UPSAMPLE", 1))
+# Longest side of the copy detection runs on; 0 detects at the working resolution
+DETECTION_MAX_SIZE = int(os.getenv("DETECTION_MAX_SIZE", 480))
+
+def detection_settings(endpoint: str, model: str = None, upsample: int = None):
+    # Explicit values win, then per-endpoint env (DETECTION_MODEL_SYNC, DETECTION_UPSAMPLE_UPLOAD, ...),
+    # then the global defaults
+    suffix = endpoint.upper()
+    model = model or os.getenv(f"DETECTION_MODEL_{suffix}", DETECTION_MODEL)
+    if upsample is None:
+        upsample = int(os.getenv(f"DETECTION_UPSAMPLE_{suffix}", DETECTION_UPSAMPLE))
+    if model not in DETECTION_MODELS:
+        raise ValueError(f"Invalid detection model. Use one of {DETECTION_MODELS}.")
+    return model, upsample
+
+def detect_faces(image: np.ndarray, model: str = None, upsample: int = None, max_size: int = None) -> list:
+    # Detects on a downscaled copy and maps the boxes back, so landmarks and
+    # encodings are still computed on the full-resolution image
+    model = model or DETECTION_MODEL
+    upsample = DETECTION_UPSAMPLE if upsample is None else upsample
+    max_size = DETECTION_MAX_SIZE if max_size is None else max_size
+
+    height, width = image.shape[:2]
+    if not max_size or max(height, width) <= max_size:
+        return face_recognition.face_locations(image, number_of_times_to_upsample=upsample, model=model)
+
+    scale = max_size / max(height, width)
+    small = np.asarray(Image.fromarray(image).resize(
+        (max(1, int(width * scale)), max(1, int(height * scale))),
+        Image.BILINEAR
+    ))
+    locations = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model=model)
+    return [
+        (
+            max(0, int(top / scale)),
+            min(width, int(right / scale)),
+            min(height, int(bottom / scale)),
+            max(0, int(left / scale))
+        )
+        for top, right, bottom, left in locations
+    ]
@@ -0,0 +1,68 @@
+import os
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+# ==========================
+# ENV CONFIG
+# ==========================
+METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 9100))
+
+# Stage latencies span sub-millisecond cache hits to multi-second CNN detection
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0
+)
+
+# ==========================
+# METRICS
+# ==========================
+STAGE_LATENCY = Histogram(
+    "face_worker_stage_seconds",
+    "Latency of each process_message stage",
+    ["stage"],
+    buckets=LATENCY_BUCKETS
+)
+QUEUE_LAG = Histogram(
+    "face_worker_queue_lag_seconds",
+    "Time between the API publishing a job and the worker consuming it",
+    ["lane"],
+    buckets=LATENCY_BUCKETS
+)
+BATCH_SIZE = Histogram(
+    "face_worker_batch_size",
+    "Messages per micro-batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+CACHE_LOOKUPS = Counter(
+    "face_worker_cache_lookups_total",
+    "Local face cache lookups",
+    ["result"]
+)
+JOBS = Counter(
+    "face_worker_jobs_total",
+    "Finished jobs by outcome",
+    ["status"]
+)
+RETRIES = Counter(
+    "face_worker_retries_total",
+    "Jobs re-queued after a failure"
+)
+IN_FLIGHT_JOBS = Gauge(
+    "face_worker_in_flight_jobs",
+    "Jobs received and not yet acked"
+)
+CACHE_ENTRIES = Gauge(
+    "face_worker_cache_entries",
+    "Encodings held in the local face cache"
+)
+VIDEO_FRAMES = Counter(
+    "face_worker_video_frames_total",
+    "Sampled video frames, keyframes detected and faces encoded",
+    ["kind"]
+)
+WORKER_READY = Gauge(
+    "face_worker_ready",
+    "1 once the worker is connected, warmed up and consuming"
+)
+
+def start_metrics_server():
+    start_http_server(METRICS_PORT)
@@ -0,0 +1,225 @@
+import os
+import json
+import subprocess
+import tempfile
+import numpy as np
+from PIL import Image
+
+# ==========================
+# ENV CONFIG
+# ==========================
+# Frames per second sampled from a video; everything below works on sampled frames only
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", 5))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", 3000))
+# Full detection runs on every Nth sampled frame; faces are followed in between
+VIDEO_KEYFRAME_INTERVAL = int(os.getenv("VIDEO_KEYFRAME_INTERVAL", 5))
+# Longest side of the grayscale copy used to follow faces between keyframes
+TRACK_FRAME_SIZE = int(os.getenv("TRACK_FRAME_SIZE", 320))
+# Below this template match score a track has drifted: detect again and re-encode it
+TRACK_MIN_CONFIDENCE = float(os.getenv("TRACK_MIN_CONFIDENCE", 0.6))
+TRACK_IOU_THRESHOLD = float(os.getenv("TRACK_IOU_THRESHOLD", 0.3))
+# Keyframes a track may go undetected before it is closed
+TRACK_MAX_MISSES = int(os.getenv("TRACK_MAX_MISSES", 2))
+# Encodings kept per track for the identity vote
+TRACK_MAX_SAMPLES = int(os.getenv("TRACK_MAX_SAMPLES", 3))
+
+# ==========================
+# FRAMES
+# ==========================
+def probe_size(path: str):
+    output = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=width,height",
+         "-of", "json", path],
+        capture_output=True, check=True
+    ).stdout
+    stream = json.loads(output)["streams"][0]
+    return int(stream["width"]), int(stream["height"])
+
+def video_frames(video_bytes: bytes, max_size: int):
+    # Yields (timestamp, RGB array, scale) for VIDEO_SAMPLE_FPS frames; ffmpeg does the
+    # sampling and resizing, so only working-resolution frames ever reach Python
+    with tempfile.NamedTemporaryFile(suffix=".video") as source:
+        source.write(video_bytes)
+        source.flush()
+        width, height = probe_size(source.name)
+        scale = min(1.0, max_size / max(width, height))
+        # Even dimensions keep every pixel format happy
+        out_width, out_height = max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+        frame_bytes = out_width * out_height * 3
+
+        process = subprocess.Popen(
+            ["ffmpeg", "-v", "error", "-i", source.name,
+             "-vf", f"fps={VIDEO_SAMPLE_FPS},scale={out_width}:{out_height}",
+             "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+            stdout=subprocess.PIPE
+        )
+        try:
+            for index in range(VIDEO_MAX_FRAMES):
+                data = process.stdout.read(frame_bytes)
+                if len(data) < frame_bytes:
+                    break
+                frame = np.frombuffer(data, dtype=np.uint8).reshape(out_height, out_width, 3)
+                yield index / VIDEO_SAMPLE_FPS, frame, out_width / width
+        finally:
+            process.kill()
+            process.wait()
+
+def image_frames(body: bytes, frame_sizes: list, load_image):
+    # A frame sequence: concatenated image files, timestamps are frame numbers
+    offset = 0
+    for index, size in enumerate(frame_sizes[:VIDEO_MAX_FRAMES]):
+        image, scale = load_image(body[offset:offset + size])
+        offset += size
+        yield float(index), image, scale
+
+# ==========================
+# TRACKING
+# ==========================
+def iou(a, b) -> float:
+    # Boxes are (top, right, bottom, left)
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    inter = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - inter
+    return inter / union if union > 0 else 0.0
+
+def to_gray(image: np.ndarray):
+    # Returns the small float grayscale frame and the factor from image to it
+    pil_image = Image.fromarray(image).convert("L")
+    scale = min(1.0, TRACK_FRAME_SIZE / max(pil_image.size))
+    if scale < 1.0:
+        pil_image = pil_image.resize(
+            (max(1, int(pil_image.size[0] * scale)), max(1, int(pil_image.size[1] * scale))), Image.BILINEAR
+        )
+    return np.asarray(pil_image, dtype=np.float32), scale
+
+
+class Track:
+    def __init__(self, track_id: int, box, timestamp: float):
+        self.track_id = track_id
+        self.box = box
+        self.first_seen = self.last_seen = timestamp
+        self.frames = 0
+        self.counted_at = None
+        self.misses = 0
+        self.confidence = 1.0
+        self.drifted = False
+        self.template = None
+        self.position = None
+        self.samples = []
+
+    def seen(self, timestamp: float):
+        # A keyframe is both followed and detected; count it once
+        self.last_seen = timestamp
+        if self.counted_at != timestamp:
+            self.counted_at = timestamp
+            self.frames += 1
+
+    def set_template(self, gray: np.ndarray, gray_scale: float):
+        top, right, bottom, left = (int(round(v * gray_scale)) for v in self.box)
+        top, left = max(0, top), max(0, left)
+        bottom, right = min(gray.shape[0], bottom), min(gray.shape[1], right)
+        if bottom - top < 4 or right - left < 4:
+            self.template = None
+            return
+        template = gray[top:bottom, left:right]
+        self.template = template - template.mean()
+        self.position = (top, left)
+
+    def follow(self, gray: np.ndarray, gray_scale: float):
+        # Normalized cross-correlation of the last detected face patch over a small search
+        # window around its previous position: cheap, and the score tells when to re-detect
+        if self.template is None:
+            self.confidence = 0.0
+            return
+        height, width = self.template.shape
+        radius = max(4, max(height, width) // 2)
+        top, left = self.position
+        y0, x0 = max(0, top - radius), max(0, left - radius)
+        window = gray[y0:min(gray.shape[0], top + height + radius), x0:min(gray.shape[1], left + width + radius)]
+        if window.shape[0] < height or window.shape[1] < width:
+            self.confidence = 0.0
+            return
+
+        patches = np.lib.stride_tricks.sliding_window_view(window, (height, width))
+        centered = patches - patches.mean(axis=(2, 3), keepdims=True)
+        numerator = np.einsum("ijkl,kl->ij", centered, self.template)
+        denominator = np.sqrt((centered ** 2).sum(axis=(2, 3)) * (self.template ** 2).sum()) + 1e-6
+        scores = numerator / denominator
+        dy, dx = np.unravel_index(np.argmax(scores), scores.shape)
+        self.confidence = float(scores[dy, dx])
+
+        new_top, new_left = y0 + dy, x0 + dx
+        shift_y, shift_x = (new_top - top) / gray_scale, (new_left - left) / gray_scale
+        self.position = (new_top, new_left)
+        self.box = (
+            int(self.box[0] + shift_y), int(self.box[1] + shift_x),
+            int(self.box[2] + shift_y), int(self.box[3] + shift_x)
+        )
+        if self.confidence < TRACK_MIN_CONFIDENCE:
+            self.drifted = True
+
+
+class FaceTracker:
+    """Box-IoU association on keyframes, template following in between."""
+
+    def __init__(self):
+        self.active = []
+        self.closed = []
+        self.next_id = 1
+
+    def follow(self, gray: np.ndarray, gray_scale: float, timestamp: float) -> bool:
+        # True when a track lost confidence and the frame should be detected right away
+        for track in self.active:
+            track.follow(gray, gray_scale)
+            if not track.drifted:
+                track.seen(timestamp)
+        return any(track.drifted for track in self.active)
+
+    def update(self, boxes: list, gray: np.ndarray, gray_scale: float, timestamp: float) -> list:
+        # Matches detections to tracks; returns the tracks that need a (re-)encoding
+        pairs = sorted(
+            ((iou(track.box, box), t, d) for t, track in enumerate(self.active) for d, box in enumerate(boxes)),
+            reverse=True
+        )
+        matched_tracks, matched_boxes = set(), set()
+        to_encode = []
+        for overlap, t, d in pairs:
+            if overlap < TRACK_IOU_THRESHOLD:
+                break
+            if t in matched_tracks or d in matched_boxes:
+                continue
+            matched_tracks.add(t)
+            matched_boxes.add(d)
+            track = self.active[t]
+            track.box = boxes[d]
+            if track.drifted and len(track.samples) < TRACK_MAX_SAMPLES:
+                to_encode.append(track)
+            track.drifted = False
+            track.misses = 0
+
+        survivors = []
+        for t, track in enumerate(self.active):
+            if t not in matched_tracks:
+                track.misses += 1
+                if track.misses > TRACK_MAX_MISSES:
+                    self.closed.append(track)
+                    continue
+            survivors.append(track)
+        self.active = survivors
+
+        for d, box in enumerate(boxes):
+            if d not in matched_boxes:
+                track = Track(self.next_id, box, timestamp)
+                self.next_id += 1
+                self.active.append(track)
+                to_encode.append(track)
+
+        for track in self.active:
+            if track.misses == 0:
+                track.set_template(gray, gray_scale)
+                track.seen(timestamp)
+        return to_encode
+
+    def tracks(self) -> list:
+        return [track for track in self.closed + self.active if track.samples]
@@ -1,14 +1,30 @@
 from PIL import Image, ImageOps
 import asyncio
+import functools
 import json
+import random
+import time
+from collections import deque
 import numpy as np
 from aio_pika import connect_robust, IncomingMessage, Message, DeliveryMode
 import aioredis
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    QueryRequest, SearchParams, QuantizationSearchParams, Filter, FieldCondition, MatchAny
+)
 import os
+import dlib
 import face_recognition
 import base64
 from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from face_cache import FaceCache, publish_cache_entry, follow_cache_stream
+from detection import detect_faces, detection_settings, DETECTION_MODEL
+from tracking import FaceTracker, VIDEO_KEYFRAME_INTERVAL, video_frames, image_frames, to_gray
+from metrics import (
+    STAGE_LATENCY, QUEUE_LAG, BATCH_SIZE, CACHE_LOOKUPS, JOBS, RETRIES,
+    IN_FLIGHT_JOBS, CACHE_ENTRIES, VIDEO_FRAMES, WORKER_READY, start_metrics_server
+)
 
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'rabbitmq')
 RABBITMQ_USER = os.getenv('RABBITMQ_DEFAULT_USER', 'guest')
@@ -17,144 +33,636 @@ RABBITMQ_PORT = os.getenv('RABBITMQ_PORT', '5672')
 
 RABBITMQ_URL = f"amqp://{RABBITMQ_USER}:{RABBITMQ_PASS}@{RABBITMQ_HOST}:{RABBITMQ_PORT}/"
 REDIS_URL = f"redis://{os.getenv('REDIS_HOST', 'redis')}:{os.getenv('REDIS_PORT', '6379')}"
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
 
 QDRANT_HOST = os.getenv('QDRANT_HOST', 'qdrant')
 QDRANT_PORT = int(os.getenv('QDRANT_PORT', 6333))
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "true").lower() == "true"
 COLLECTION_NAME = os.getenv("COLLECTION_NAME", "faces")
 
 CACHE_DISTANCE_THRESHOLD_LOCAL = float(os.getenv("CACHE_DISTANCE_THRESHOLD_LOCAL", 0.45))
 CACHE_SCORE_THRESHOLD_QDRANT = float(os.getenv("CACHE_SCORE_THRESHOLD_QDRANT", 0.85))
 RECOGNITION_COUNTER_KEY = os.getenv("RECOGNITION_COUNTER_KEY", "recognition_counter")
-CACHE_TTL_SECONDS = 3600
-
+CACHE_TTL_SECONDS = int(os.getenv("CACHE_TTL_SECONDS", 3600))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", 10000))
+VECTOR_SIZE = int(os.getenv("VECTOR_SIZE", 128))
+
+# Two-stage search over people (see api/identities.py)
+SEARCH_MODE = os.getenv("SEARCH_MODE", "two_stage")
+CENTROID_COLLECTION = os.getenv("CENTROID_COLLECTION", f"{COLLECTION_NAME}_centroids")
+CENTROID_SEARCH_LIMIT = int(os.getenv("CENTROID_SEARCH_LIMIT", 5))
+CENTROID_THRESHOLD_MARGIN = float(os.getenv("CENTROID_THRESHOLD_MARGIN", 0.1))
+
+# Search-time settings for the collection profile (see api/qdrant.py)
+SEARCH_HNSW_EF = int(os.getenv("SEARCH_HNSW_EF", 0))
+QUANTIZATION_RESCORE = os.getenv("QUANTIZATION_RESCORE", "true").lower() == "true"
+QUANTIZATION_OVERSAMPLING = float(os.getenv("QUANTIZATION_OVERSAMPLING", 2.0))
+SEARCH_PARAMS = SearchParams(
+    hnsw_ef=SEARCH_HNSW_EF or None,
+    quantization=QuantizationSearchParams(rescore=QUANTIZATION_RESCORE, oversampling=QUANTIZATION_OVERSAMPLING)
+)
+
+MAX_IMAGE_SIZE = int(os.getenv("MAX_IMAGE_SIZE", 1000))
+
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", os.cpu_count() or 1))
+WORKER_BATCH_SIZE = int(os.getenv("WORKER_BATCH_SIZE", 16))
+WORKER_BATCH_WAIT_MS = int(os.getenv("WORKER_BATCH_WAIT_MS", 20))
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 2))
+WORKER_PREFETCH = int(os.getenv("WORKER_PREFETCH", WORKER_BATCH_SIZE * WORKER_CONCURRENCY * 2))
+# Each dependency is retried with jittered exponential backoff until this deadline
+STARTUP_TIMEOUT_SECONDS = float(os.getenv("STARTUP_TIMEOUT_SECONDS", 60))
+STARTUP_BACKOFF_INITIAL = float(os.getenv("STARTUP_BACKOFF_INITIAL", 0.1))
+STARTUP_BACKOFF_MAX = float(os.getenv("STARTUP_BACKOFF_MAX", 3))
+WARMUP_IMAGE_SIZE = int(os.getenv("WARMUP_IMAGE_SIZE", 160))
+
+# image: micro-batched photo jobs from the lane queues | video: one video or frame sequence at a time
+WORKER_MODE = os.getenv("WORKER_MODE", "image")
+
+JOBS_QUEUE = os.getenv("QUEUE_NAME", "face_recognition_jobs")
 MAX_RETRIES = int(os.getenv('MAX_RETRIES', 3))
-RETRY_PREFIX = "retry:"
+# Exponential backoff: attempt n waits RETRY_BASE_DELAY_MS * 2^(n-1), capped at RETRY_MAX_DELAY_MS
+RETRY_BASE_DELAY_MS = int(os.getenv("RETRY_BASE_DELAY_MS", 1000))
+RETRY_MAX_DELAY_MS = int(os.getenv("RETRY_MAX_DELAY_MS", 60000))
+# Jobs that used up their retries wait here until replayed (POST /dead-letters/replay)
+DEAD_LETTER_QUEUE = os.getenv("DEAD_LETTER_QUEUE", f"{JOBS_QUEUE}.dead")
+VIDEO_QUEUE = os.getenv("VIDEO_QUEUE", f"{JOBS_QUEUE}.video")
+VIDEO_PAYLOAD_TYPES = ("video", "frames")
+# Priority lanes as "name:weight", highest priority first (same setting as the API)
+LANE_WEIGHTS = {
+    lane: int(weight) for lane, weight in (
+        item.split(":") for item in os.getenv("JOB_LANES", "interactive:3,batch:1").split(",")
+    )
+}
+JOB_LANES = list(LANE_WEIGHTS)
+DEFAULT_LANE = JOB_LANES[0]
+
+RESULT_KEY_PREFIX = os.getenv("RESULT_KEY_PREFIX", "job_result:")
+RESULT_CHANNEL = os.getenv("RESULT_CHANNEL", "face_job_results")
+RESULT_TTL_SECONDS = int(os.getenv("RESULT_TTL_SECONDS", 3600))
+
+# Encoding jobs published by the API carry little-endian float64 bytes
+ENCODING_DTYPE = "<f8"
 
 # ==========================
-# PROCESS MESSAGE
+# CPU STAGE (runs in the process pool)
 # ==========================
-async def process_message(message: IncomingMessage, redis, qdrant, channel):
-    async with message.process():
+def decode_image(image_bytes: bytes):
+    pil_image = Image.open(BytesIO(image_bytes))
+    return ImageOps.exif_transpose(pil_image).convert("RGB")
+
+def resize_image(pil_image):
+    # Returns the working-resolution array and the factor that maps it back to the original
+    scale = 1.0
+    if max(pil_image.size) > MAX_IMAGE_SIZE:
+        scale = min(MAX_IMAGE_SIZE / pil_image.size[0], MAX_IMAGE_SIZE / pil_image.size[1])
+        pil_image = pil_image.resize(
+            (int(pil_image.size[0] * scale), int(pil_image.size[1] * scale)),
+            Image.LANCZOS
+        )
+
+    return np.array(pil_image), scale
+
+def batch_face_encodings(images: list, locations: list):
+    # One dlib descriptor call for every face in the batch instead of one per image
+    batch_landmarks = []
+    for image, face_locations in zip(images, locations):
+        detections = dlib.full_object_detections()
+        for shape in face_recognition.api._raw_face_landmarks(image, face_locations, model="small"):
+            detections.append(shape)
+        batch_landmarks.append(detections)
+
+    descriptors = face_recognition.api.face_encoder.compute_face_descriptor(images, batch_landmarks, 1)
+    return [[list(face) for face in faces] for faces in descriptors]
+
+def extract_faces(items: list):
+    # items are (image_bytes, multi_face, detection_model, upsample) tuples. Returns one (faces, error) pair per image,
+    # faces being [(box, encoding), ...] with boxes in original-image pixels, plus the
+    # per-stage timings (metrics live in the parent process)
+    results = [([], None)] * len(items)
+    timings = {"decode": [], "resize": [], "detect": [], "encode": []}
+    images, locations, scales, slots = [], [], [], []
+
+    for index, (image_bytes, multi_face, model, upsample) in enumerate(items):
         try:
-            data = json.loads(message.body.decode())
-            job_id = data.get("job_id")
-            image_b64 = data.get("image_base64")
-
-            if not job_id or not image_b64:
-                print("Invalid message format")
-                return
-
-            print(f"Processing job {job_id}")
-
-            image_bytes = base64.b64decode(image_b64)
-
-            pil_image = Image.open(BytesIO(image_bytes))
-            pil_image = ImageOps.exif_transpose(pil_image).convert("RGB")
-
-            max_size = 1000
-            if max(pil_image.size) > max_size:
-                scale = min(max_size / pil_image.size[0], max_size / pil_image.size[1])
-                pil_image = pil_image.resize(
-                    (int(pil_image.size[0] * scale), int(pil_image.size[1] * scale)),
-                    Image.LANCZOS
-                )
-
-            image = np.array(pil_image)
-            face_locations = face_recognition.face_locations(image)
+            started = time.perf_counter()
+            pil_image = decode_image(image_bytes)
+            decoded = time.perf_counter()
+            image, scale = resize_image(pil_image)
+            resized = time.perf_counter()
+            face_locations = detect_faces(image, model, upsample)
+            detected = time.perf_counter()
+        except Exception as e:
+            results[index] = ([], str(e))
+            continue
+
+        timings["decode"].append(decoded - started)
+        timings["resize"].append(resized - decoded)
+        timings["detect"].append(detected - resized)
+
+        if face_locations:
+            images.append(image)
+            locations.append(face_locations if multi_face else face_locations[:1])
+            scales.append(scale)
+            slots.append(index)
+
+    if images:
+        started = time.perf_counter()
+        encodings = batch_face_encodings(images, locations)
+        timings["encode"].extend([(time.perf_counter() - started) / len(images)] * len(images))
+        for slot, face_locations, scale, face_encodings in zip(slots, locations, scales, encodings):
+            boxes = [tuple(int(round(v / scale)) for v in location) for location in face_locations]
+            results[slot] = (list(zip(boxes, face_encodings)), None)
+
+    return results, timings
+
+def track_faces(body: bytes, payload_type: str, frame_sizes: list, model: str, upsample: int):
+    # Whole video in one pool call: detect on keyframes (or when a track drifts), follow faces
+    # in between, and encode only new or drifted tracks. Returns the tracks, boxes in original
+    # pixels, and frame counters
+    if payload_type == "video":
+        frames = video_frames(body, MAX_IMAGE_SIZE)
+    else:
+        frames = image_frames(body, frame_sizes, lambda data: resize_image(decode_image(data)))
+
+    tracker = FaceTracker()
+    stats = {"frames": 0, "keyframes": 0, "encodes": 0}
+    scale = 1.0
+    for index, (timestamp, image, scale) in enumerate(frames):
+        stats["frames"] += 1
+        gray, gray_scale = to_gray(image)
+        drifted = tracker.follow(gray, gray_scale, timestamp)
+        if index % VIDEO_KEYFRAME_INTERVAL and not drifted:
+            continue
+
+        stats["keyframes"] += 1
+        to_encode = tracker.update(detect_faces(image, model, upsample), gray, gray_scale, timestamp)
+        if to_encode:
+            encodings = batch_face_encodings([image], [[track.box for track in to_encode]])[0]
+            for track, encoding in zip(to_encode, encodings):
+                track.samples.append(encoding)
+            stats["encodes"] += len(to_encode)
+
+    tracks = [
+        {
+            "track_id": track.track_id,
+            "first_seen": track.first_seen,
+            "last_seen": track.last_seen,
+            "frames": track.frames,
+            "box": [int(round(v / scale)) for v in track.box],
+            "samples": track.samples,
+        }
+        for track in tracker.tracks()
+    ]
+    return tracks, stats
+
+async def encode_batch(process_pool: ProcessPoolExecutor, items: list):
+    # Split the batch into one chunk per pool process so a batch still uses every core
+    loop = asyncio.get_running_loop()
+    chunk_size = max(1, -(-len(items) // WORKER_PROCESSES))
+    chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+    chunk_outputs = await asyncio.gather(*[
+        loop.run_in_executor(process_pool, extract_faces, chunk) for chunk in chunks
+    ])
+
+    results = []
+    for chunk_results, timings in chunk_outputs:
+        results.extend(chunk_results)
+        for stage, samples in timings.items():
+            for sample in samples:
+                STAGE_LATENCY.labels(stage).observe(sample)
+    return results
 
-            if not face_locations:
-                print(f"No faces found for job {job_id}")
-                return
+# ==========================
+# PROCESS BATCH
+# ==========================
+def get_header(message: IncomingMessage, key: str, default=None):
+    value = (message.headers or {}).get(key, default)
+    return value.decode() if isinstance(value, bytes) else value
+
+def parse_job(message: IncomingMessage):
+    # Returns (job_id, payload_type, body); payload_type is "image" or "encoding"
+    job_id = get_header(message, "job_id")
+    if job_id:
+        # Binary format: raw bytes as the body, used as-is
+        return job_id, get_header(message, "payload_type", "image"), message.body
+
+    # Legacy format: {"job_id": ..., "image_base64": ...}, accepted during rollout
+    data = json.loads(message.body)
+    job_id = data.get("job_id")
+    image_b64 = data.get("image_base64")
+    if not job_id or not image_b64:
+        return None, None, None
+    return job_id, "image", base64.b64decode(image_b64)
+
+async def fail_job(message: IncomingMessage, redis, channel, reason: str):
+    try:
+        await handle_retry(message, redis, channel, reason)
+    finally:
+        await message.ack()
+
+async def search_identities(qdrant: AsyncQdrantClient, encodings: list) -> list:
+    # Closest sample per encoding (or None): centroid shortlist first, then its samples
+    if SEARCH_MODE != "two_stage":
+        results = await qdrant.query_batch_points(
+            collection_name=COLLECTION_NAME,
+            requests=[
+                QueryRequest(query=encoding.tolist(), limit=1, params=SEARCH_PARAMS, with_payload=True)
+                for encoding in encodings
+            ]
+        )
+        return [result.points[0] if result.points else None for result in results]
+
+    shortlists = await qdrant.query_batch_points(
+        collection_name=CENTROID_COLLECTION,
+        requests=[
+            QueryRequest(
+                query=encoding.tolist(),
+                limit=CENTROID_SEARCH_LIMIT,
+                score_threshold=CACHE_SCORE_THRESHOLD_QDRANT + CENTROID_THRESHOLD_MARGIN,
+                with_payload=False
+            )
+            for encoding in encodings
+        ]
+    )
+    pending = [(index, [str(point.id) for point in shortlist.points]) for index, shortlist in enumerate(shortlists)]
+    pending = [(index, ids) for index, ids in pending if ids]
+    best = [None] * len(encodings)
+    if not pending:
+        return best
+
+    results = await qdrant.query_batch_points(
+        collection_name=COLLECTION_NAME,
+        requests=[
+            QueryRequest(
+                query=encodings[index].tolist(),
+                filter=Filter(must=[FieldCondition(key="identity_id", match=MatchAny(any=ids))]),
+                limit=1,
+                params=SEARCH_PARAMS,
+                with_payload=True
+            )
+            for index, ids in pending
+        ]
+    )
+    for (index, _), result in zip(pending, results):
+        best[index] = result.points[0] if result.points else None
+    return best
+
+async def process_batch(messages: list, redis, qdrant, channel, face_cache: FaceCache,
+                        process_pool: ProcessPoolExecutor):
+    BATCH_SIZE.observe(len(messages))
+    jobs = []
+    for message in messages:
+        try:
+            job_id, payload_type, body = parse_job(message)
+            # Detection settings chosen by the API endpoint, falling back to this worker's env
+            model, upsample = detection_settings(
+                "worker", get_header(message, "detection_model"), get_header(message, "detection_upsample")
+            )
+            if payload_type == "encoding":
+                # Encoded by the API: one or more concatenated vectors, boxes in a header
+                vectors = np.frombuffer(body, dtype=ENCODING_DTYPE).reshape(-1, VECTOR_SIZE)
+                boxes = json.loads(get_header(message, "boxes", "[]")) or [None] * len(vectors)
+        except Exception as e:
+            await fail_job(message, redis, channel, str(e))
+            continue
+
+        if not job_id:
+            print("Invalid message format")
+            await message.ack()
+            continue
+
+        print(f"Processing job {job_id} ({payload_type})")
+        submitted_at = get_header(message, "submitted_at")
+        if submitted_at:
+            QUEUE_LAG.labels(message_lane(message)).observe(max(0.0, time.time() - float(submitted_at)))
+        job = {
+            "message": message,
+            "job_id": job_id,
+            "payload_type": payload_type,
+            "body": body,
+            "multi_face": get_header(message, "multi_face") in (True, 1, "1", "true"),
+            "detection_model": model,
+            "detection_upsample": int(upsample),
+            "submitted_at": submitted_at,
+        }
+        if payload_type == "encoding":
+            job["result"] = (list(zip(boxes, vectors)), None)
+        jobs.append(job)
+
+    if not jobs:
+        return
 
-            unknown_encoding = face_recognition.face_encodings(image, face_locations)[0]
-            unknown_encoding = np.array(unknown_encoding)
+    image_jobs = [job for job in jobs if job["payload_type"] != "encoding"]
+    if image_jobs:
+        try:
+            results = await encode_batch(process_pool, [
+                (job["body"], job["multi_face"], job["detection_model"], job["detection_upsample"])
+                for job in image_jobs
+            ])
+        except Exception as e:
+            for job in image_jobs:
+                await fail_job(job["message"], redis, channel, str(e))
+            jobs = [job for job in jobs if job["payload_type"] == "encoding"]
+            results = []
+        for job, result in zip(image_jobs, results):
+            job["result"] = result
+
+    ready, misses = [], []
+    for job in jobs:
+        faces, error = job["result"]
+        message, job_id = job["message"], job["job_id"]
+        if error:
+            await fail_job(message, redis, channel, error)
+            continue
+
+        if not faces:
+            print(f"No faces found for job {job_id}")
+            JOBS.labels("no_face").inc()
+            try:
+                await store_result(redis, {
+                    "job_id": job_id,
+                    "status": "no_face",
+                    "submitted_at": job["submitted_at"],
+                    "completed_at": time.time(),
+                })
+            finally:
+                await message.ack()
+            continue
+
+        job["faces"] = []
+        for box, encoding in faces:
+            face = {"box": box, "encoding": np.asarray(encoding, dtype=np.float64), "match": None}
+            with STAGE_LATENCY.labels("cache_lookup").time():
+                cached = face_cache.lookup(face["encoding"], CACHE_DISTANCE_THRESHOLD_LOCAL)
+            if cached:
+                CACHE_LOOKUPS.labels("hit").inc()
+                identifier, photo, distance = cached
+                face["match"] = (identifier, photo, distance, True)
+            else:
+                CACHE_LOOKUPS.labels("miss").inc()
+                misses.append(face)
+            job["faces"].append(face)
+        ready.append(job)
+
+    if misses:
+        # Two Qdrant round-trips (centroids, then samples) for every uncached face in the batch
+        print(f"Searching {len(misses)} vectors in Qdrant")
 
+        try:
+            with STAGE_LATENCY.labels("vector_search").time():
+                best_points = await search_identities(qdrant, [face["encoding"] for face in misses])
         except Exception as e:
-            await handle_retry(message, redis, channel, str(e))
+            for job in ready:
+                await fail_job(job["message"], redis, channel, str(e))
             return
 
+        for face, point in zip(misses, best_points):
+            if point and point.score <= CACHE_SCORE_THRESHOLD_QDRANT:
+                face["match"] = (point.payload["identifier"], point.payload["photo"], point.score, False)
+
+    for job in ready:
+        message, job_id = job["message"], job["job_id"]
+        started = time.perf_counter()
         try:
-            async for key in redis.scan_iter(match="face_cache:*"):
-                cached_json = await redis.get(key)
-                if not cached_json:
+            for face in job["faces"]:
+                if not face["match"]:
                     continue
+                identifier, photo, distance, cached = face["match"]
+                print(f"Face recognized for job {job_id}: {identifier} (distance={distance:.4f}, cached={cached})")
+                await redis.incr(RECOGNITION_COUNTER_KEY)
+                if not cached:
+                    face_cache.put(identifier, photo, face["encoding"])
+                    await publish_cache_entry(redis, identifier, photo, face["encoding"])
+
+            if job["multi_face"]:
+                await publish_faces(channel, redis, job_id, job["faces"], job["submitted_at"])
+                JOBS.labels("multi_face").inc()
+            elif job["faces"][0]["match"]:
+                identifier, photo, _, cached = job["faces"][0]["match"]
+                await publish_success(channel, redis, job_id, identifier, photo, cached, job["submitted_at"])
+                JOBS.labels("recognized").inc()
+            else:
+                print(f"No match found for job {job_id}")
+                await publish_success(channel, redis, job_id, "Unknown", "", False, job["submitted_at"])
+                JOBS.labels("unknown").inc()
+
+            await message.ack()
+            STAGE_LATENCY.labels("publish").observe(time.perf_counter() - started)
+        except Exception as e:
+            await fail_job(message, redis, channel, str(e))
+
+async def process_video(message: IncomingMessage, redis, qdrant, channel, face_cache: FaceCache,
+                        process_pool: ProcessPoolExecutor):
+    job_id = get_header(message, "job_id")
+    if not job_id:
+        print("Invalid message format")
+        await message.ack()
+        return
 
-                cached_data = json.loads(cached_json)
-                cached_encoding = np.array(cached_data["encoding"])
-                distance = np.linalg.norm(unknown_encoding - cached_encoding)
-
-                if distance <= CACHE_DISTANCE_THRESHOLD_LOCAL:
-                    print(f"Cache hit for job {job_id}")
-                    await redis.incr(RECOGNITION_COUNTER_KEY)
-                    await publish_success(channel, job_id, cached_data["identifier"], cached_data["photo"], True)
-                    return
-
-            print(f"Searching vector in Qdrant for job {job_id}")
+    payload_type = get_header(message, "payload_type")
+    submitted_at = get_header(message, "submitted_at")
+    print(f"Processing job {job_id} ({payload_type})")
+    if submitted_at:
+        QUEUE_LAG.labels("video").observe(max(0.0, time.time() - float(submitted_at)))
 
-            def qdrant_search():
-                return qdrant.query_points(
-                collection_name=COLLECTION_NAME,
-                query=unknown_encoding.tolist(),
-                limit=1,
-                with_payload=True,
+    try:
+        model, upsample = detection_settings(
+            "video", get_header(message, "detection_model"), get_header(message, "detection_upsample")
+        )
+        with STAGE_LATENCY.labels("track").time():
+            tracks, stats = await asyncio.get_running_loop().run_in_executor(
+                process_pool, track_faces, message.body, payload_type,
+                json.loads(get_header(message, "frame_sizes", "[]")), model, int(upsample)
             )
-
-            search_result = await asyncio.to_thread(qdrant_search)
-
-            if search_result and search_result.points:
-                point = search_result.points[0]
-                score = point.score
-
-                if score <= CACHE_SCORE_THRESHOLD_QDRANT:
-                    payload = point.payload
-                    print(f"Face recognized for job {job_id} (distance={distance:.4f})")
-
-                    await redis.incr(RECOGNITION_COUNTER_KEY)
-                    await redis.set(
-                        f"face_cache:{payload['identifier']}",
-                        json.dumps({
-                            "encoding": unknown_encoding.tolist(),
-                            "identifier": payload["identifier"],
-                            "photo": payload["photo"]
-                        }),
-                        ex=CACHE_TTL_SECONDS
-                    )
-
-                    await publish_success(channel, job_id, payload["identifier"], payload["photo"], False)
-                    return
-
-            print(f"No match found for job {job_id}")
-            await publish_success(channel, job_id, "Unknown", "", False)
-
-        except Exception as e:
-            await handle_retry(message, redis, channel, str(e))
+        for kind, count in stats.items():
+            VIDEO_FRAMES.labels(kind).inc(count)
+
+        # Every sample of every track: cache first, then one batched search for the misses
+        samples = [
+            {"track": track, "encoding": np.asarray(encoding, dtype=np.float64), "match": None}
+            for track in tracks for encoding in track["samples"]
+        ]
+        misses = []
+        for sample in samples:
+            cached = face_cache.lookup(sample["encoding"], CACHE_DISTANCE_THRESHOLD_LOCAL)
+            CACHE_LOOKUPS.labels("hit" if cached else "miss").inc()
+            if cached:
+                sample["match"] = (*cached, True)
+            else:
+                misses.append(sample)
+        if misses:
+            with STAGE_LATENCY.labels("vector_search").time():
+                best_points = await search_identities(qdrant, [s["encoding"] for s in misses])
+            for sample, point in zip(misses, best_points):
+                if point and point.score <= CACHE_SCORE_THRESHOLD_QDRANT:
+                    sample["match"] = (point.payload["identifier"], point.payload["photo"], point.score, False)
+                    face_cache.put(point.payload["identifier"], point.payload["photo"], sample["encoding"])
+                    await publish_cache_entry(redis, point.payload["identifier"], point.payload["photo"], sample["encoding"])
+
+        # One identity per track: most votes among its samples, closest distance breaks ties
+        results = []
+        for track in tracks:
+            votes = {}
+            for sample in samples:
+                if sample["track"] is track and sample["match"]:
+                    identifier, photo, distance, cached = sample["match"]
+                    count, best = votes.get(identifier, (0, None))
+                    if best is None or distance < best[1]:
+                        best = (photo, distance, cached)
+                    votes[identifier] = (count + 1, best)
+            winner = min(votes.items(), key=lambda item: (-item[1][0], item[1][1][1]), default=None)
+            results.append({
+                "track_id": track["track_id"],
+                "identifier": winner[0] if winner else "Unknown",
+                "photo": winner[1][1][0] if winner else "",
+                "distance": winner[1][1][1] if winner else None,
+                "cached": winner[1][1][2] if winner else False,
+                "first_seen": track["first_seen"],
+                "last_seen": track["last_seen"],
+                "frames": track["frames"],
+                "box": track["box"],
+                "samples": len(track["samples"]),
+            })
+            if winner:
+                await redis.incr(RECOGNITION_COUNTER_KEY)
+
+        await store_result(redis, {
+            "job_id": job_id,
+            "status": "done",
+            "tracks": results,
+            "video": stats,
+            "submitted_at": submitted_at,
+            "completed_at": time.time(),
+        })
+        JOBS.labels("video").inc()
+        await message.ack()
+    except Exception as e:
+        await fail_job(message, redis, channel, str(e))
 
 # ==========================
 # RETRY
 # ==========================
-async def handle_retry(message, redis, channel, reason):
-    body = json.loads(message.body.decode())
-    job_id = body.get("job_id", "unknown")
-
-    retry_key = f"{RETRY_PREFIX}{job_id}"
-    retries = await redis.incr(retry_key)
-    await redis.expire(retry_key, 3600)
-
-    print(f"Retry {retries}/{MAX_RETRIES} for job {job_id} | Reason: {reason}")
+def lane_queue(lane: str) -> str:
+    return JOBS_QUEUE if lane == DEFAULT_LANE else f"{JOBS_QUEUE}.{lane}"
+
+def message_lane(message: IncomingMessage) -> str:
+    lane = get_header(message, "lane", DEFAULT_LANE)
+    return lane if lane in LANE_WEIGHTS else DEFAULT_LANE
+
+def retry_delay_ms(attempt: int) -> int:
+    return min(RETRY_BASE_DELAY_MS * 2 ** (attempt - 1), RETRY_MAX_DELAY_MS)
+
+def source_queue(message: IncomingMessage) -> str:
+    if get_header(message, "payload_type") in VIDEO_PAYLOAD_TYPES:
+        return VIDEO_QUEUE
+    return lane_queue(message_lane(message))
+
+def delay_queue_name(queue: str, delay_ms: int) -> str:
+    return f"{queue}.retry.{delay_ms}"
+
+async def declare_retry_queues(channel, queues: list):
+    # One queue per source queue and backoff step: a queue-wide TTL expires messages in order,
+    # so a long delay never holds up a short one. Expired messages dead-letter back to the source
+    for queue in queues:
+        for delay_ms in sorted({retry_delay_ms(attempt) for attempt in range(1, MAX_RETRIES)}):
+            await channel.declare_queue(
+                delay_queue_name(queue, delay_ms),
+                durable=True,
+                arguments={
+                    "x-message-ttl": delay_ms,
+                    "x-dead-letter-exchange": "",
+                    "x-dead-letter-routing-key": queue,
+                }
+            )
+    await channel.declare_queue(DEAD_LETTER_QUEUE, durable=True)
 
-    if retries >= MAX_RETRIES:
-        print(f"Job {job_id} failed")
+async def handle_retry(message, redis, channel, reason):
+    job_id = get_header(message, "job_id")
+    if not job_id:
+        try:
+            job_id = json.loads(message.body).get("job_id", "unknown")
+        except Exception:
+            job_id = "unknown"
+
+    # The attempt count travels with the message, so any worker can pick up the retry
+    attempt = int(get_header(message, "attempts", 0)) + 1
+    headers = {**(message.headers or {}), "attempts": attempt, "last_error": reason[:1000]}
+
+    print(f"Retry {attempt}/{MAX_RETRIES} for job {job_id} | Reason: {reason}")
+
+    if attempt >= MAX_RETRIES:
+        print(f"Job {job_id} failed, moved to {DEAD_LETTER_QUEUE}")
+        JOBS.labels("failed").inc()
+        await channel.default_exchange.publish(
+            Message(
+                body=message.body,
+                headers={**headers, "failed_at": time.time()},
+                content_type=message.content_type,
+                message_id=message.message_id,
+                delivery_mode=DeliveryMode.PERSISTENT
+            ),
+            routing_key=DEAD_LETTER_QUEUE
+        )
+        await store_result(redis, {
+            "job_id": job_id,
+            "status": "failed",
+            "message": reason,
+            "submitted_at": get_header(message, "submitted_at"),
+            "completed_at": time.time(),
+        })
         return
 
+    RETRIES.inc()
     await channel.default_exchange.publish(
-        Message(body=message.body, delivery_mode=DeliveryMode.PERSISTENT),
-        routing_key="face_recognition_jobs"
+        Message(
+            body=message.body,
+            headers=headers,
+            content_type=message.content_type,
+            message_id=message.message_id,
+            delivery_mode=DeliveryMode.PERSISTENT
+        ),
+        routing_key=delay_queue_name(source_queue(message), retry_delay_ms(attempt))
     )
 
 # ==========================
-# PUBLISH SUCCESS
+# PUBLISH RESULTS
 # ==========================
-async def publish_success(channel, job_id, identifier, photo, cached):
+async def store_result(redis, result: dict):
+    # Result store polled by GET /jobs/{job_id}; the pub/sub message feeds the API's WebSocket fan-out
+    data = json.dumps(result)
+    await redis.set(f"{RESULT_KEY_PREFIX}{result['job_id']}", data, ex=RESULT_TTL_SECONDS)
+    await redis.publish(RESULT_CHANNEL, data)
+
+async def publish_faces(channel, redis, job_id, faces, submitted_at=None):
+    payload = {
+        "job_id": job_id,
+        "faces": [
+            {
+                "box": list(face["box"]) if face["box"] else None,
+                "identifier": face["match"][0] if face["match"] else "Unknown",
+                "photo": face["match"][1] if face["match"] else "",
+                "distance": face["match"][2] if face["match"] else None,
+                "cached": face["match"][3] if face["match"] else False,
+            }
+            for face in faces
+        ]
+    }
+
+    await store_result(redis, {
+        **payload,
+        "status": "done",
+        "submitted_at": submitted_at,
+        "completed_at": time.time(),
+    })
+
+    await channel.default_exchange.publish(
+        Message(body=json.dumps(payload).encode(), delivery_mode=DeliveryMode.PERSISTENT),
+        routing_key="face_recognition_success"
+    )
+
+async def publish_success(channel, redis, job_id, identifier, photo, cached, submitted_at=None):
     payload = {
         "job_id": job_id,
         "identifier": identifier,
@@ -162,44 +670,227 @@ async def publish_success(channel, job_id, identifier, photo, cached):
         "cached": cached
     }
 
+    await store_result(redis, {
+        **payload,
+        "status": "done",
+        "submitted_at": submitted_at,
+        "completed_at": time.time(),
+    })
+
     await channel.default_exchange.publish(
         Message(body=json.dumps(payload).encode(), delivery_mode=DeliveryMode.PERSISTENT),
         routing_key="face_recognition_success"
     )
 
+# ==========================
+# PRIORITY LANES
+# ==========================
+def lane_prefetch() -> dict:
+    total = sum(LANE_WEIGHTS.values())
+    return {lane: max(1, WORKER_PREFETCH * weight // total) for lane, weight in LANE_WEIGHTS.items()}
+
+async def enqueue(pending: asyncio.Queue, lane: str, message: IncomingMessage):
+    await pending.put((lane, message))
+
+def take_weighted(buffers: dict, size: int) -> list:
+    # Each waiting lane gets at least its weighted share of the batch, highest lane first;
+    # leftover slots go to whatever is still buffered, so no capacity sits idle
+    waiting = [lane for lane in JOB_LANES if buffers[lane]]
+    total = sum(LANE_WEIGHTS[lane] for lane in waiting)
+    batch = []
+    for lane in waiting:
+        share = max(1, size * LANE_WEIGHTS[lane] // total)
+        while buffers[lane] and share and len(batch) < size:
+            batch.append(buffers[lane].popleft())
+            share -= 1
+    for lane in waiting:
+        while buffers[lane] and len(batch) < size:
+            batch.append(buffers[lane].popleft())
+    return batch
+
+
+# ==========================
+# STARTUP
+# ==========================
+async def with_backoff(name: str, connect):
+    # Jittered exponential backoff until STARTUP_TIMEOUT_SECONDS
+    deadline = time.monotonic() + STARTUP_TIMEOUT_SECONDS
+    delay = STARTUP_BACKOFF_INITIAL
+    attempt = 1
+    while True:
+        try:
+            result = await connect()
+            print(f"Connected to {name} (attempt {attempt})")
+            return result
+        except Exception as e:
+            if time.monotonic() + delay > deadline:
+                raise RuntimeError(f"Cannot connect to {name} after {attempt} attempts: {e}") from e
+            print(f"{name} not ready, retry {attempt} in {delay:.1f}s... Error: {e}")
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, STARTUP_BACKOFF_MAX)
+            attempt += 1
+
+async def connect_rabbitmq():
+    return await connect_robust(RABBITMQ_URL)
+
+async def connect_redis():
+    # Shared by every in-flight batch; the cache stream follower holds one connection
+    pool = aioredis.BlockingConnectionPool.from_url(
+        REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, timeout=REDIS_POOL_TIMEOUT, decode_responses=True
+    )
+    redis = aioredis.Redis(connection_pool=pool)
+    try:
+        await redis.ping()
+    except Exception:
+        await pool.disconnect()
+        raise
+    return redis
+
+async def connect_qdrant():
+    qdrant = AsyncQdrantClient(
+        host=QDRANT_HOST, port=QDRANT_PORT, grpc_port=QDRANT_GRPC_PORT, prefer_grpc=QDRANT_PREFER_GRPC
+    )
+    try:
+        await qdrant.get_collections()
+    except Exception:
+        await qdrant.close()
+        raise
+    return qdrant
+
+def warmup_process():
+    # One dummy detection and encoding: the dlib models are already loaded (imported before
+    # the fork, shared copy-on-write), this pays the remaining first-call costs
+    image = np.zeros((WARMUP_IMAGE_SIZE, WARMUP_IMAGE_SIZE, 3), dtype=np.uint8)
+    detect_faces(image, DETECTION_MODEL, 0)
+    margin = WARMUP_IMAGE_SIZE // 4
+    batch_face_encodings([image], [[(margin, WARMUP_IMAGE_SIZE - margin, WARMUP_IMAGE_SIZE - margin, margin)]])
+
+def report_task_exit(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        print(f"Background task failed: {task.exception()!r}", flush=True)
+
+async def warm_up_pool(process_pool: ProcessPoolExecutor):
+    # One call per pool process so every process is forked and warm before the first job
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    await asyncio.gather(*[
+        loop.run_in_executor(process_pool, warmup_process) for _ in range(WORKER_PROCESSES)
+    ])
+    print(f"Process pool warmed up in {time.perf_counter() - started:.2f}s")
+
 
 async def main():
     print("Worker started")
+    start_metrics_server()
 
     try:
-        print(f"Connecting to RabbitMQ at {RABBITMQ_URL} ...")
-        connection = await connect_robust(RABBITMQ_URL)
-        print("Connected to RabbitMQ")
+        print(f"Connecting to RabbitMQ, Redis and Qdrant ({QDRANT_HOST}:{QDRANT_PORT}) ...")
+        # The pool starts (and warms) while the connections are being made
+        process_pool = ProcessPoolExecutor(max_workers=WORKER_PROCESSES)
+        warmup_task = asyncio.create_task(warm_up_pool(process_pool))
+        connection, redis, qdrant = await asyncio.gather(
+            with_backoff("RabbitMQ", connect_rabbitmq),
+            with_backoff("Redis", connect_redis),
+            with_backoff("Qdrant", connect_qdrant),
+        )
 
         channel = await connection.channel()
-        await channel.set_qos(prefetch_count=1)
         print("Channel created")
 
-        queue = await channel.declare_queue("face_recognition_jobs", durable=True)
         await channel.declare_queue("face_recognition_success", durable=True)
+        await declare_retry_queues(channel, [VIDEO_QUEUE] if WORKER_MODE == "video" else [
+            lane_queue(lane) for lane in JOB_LANES
+        ])
         print("Queues declared")
 
-        print(f"Connecting to Redis at {REDIS_URL} ...")
-        redis = await aioredis.from_url(REDIS_URL, decode_responses=True)
-        print("Connected to Redis")
-
-        print(f"Connecting to Qdrant at {QDRANT_HOST}:{QDRANT_PORT} ...")
-        qdrant = QdrantClient(host=QDRANT_HOST, port=QDRANT_PORT)
-        print("Connected to Qdrant")
+        face_cache = FaceCache(dim=VECTOR_SIZE, capacity=CACHE_MAX_ENTRIES, ttl_seconds=CACHE_TTL_SECONDS)
+        cache_sync_task = asyncio.create_task(follow_cache_stream(redis, face_cache))
+        # Logged as soon as it dies instead of failing silently; cancelled and awaited on shutdown
+        cache_sync_task.add_done_callback(report_task_exit)
+        print("Face cache sync started")
 
-        print("Waiting for mensages ...")
-        async with queue.iterator() as queue_iter:
-            async for message in queue_iter:
+        try:
+            await warmup_task
+            print(f"Process pool started with {WORKER_PROCESSES} processes")
+
+            if WORKER_MODE == "video":
+                # Each video is a long job of its own: prefetch bounds how many run at once
+                video_channel = await connection.channel()
+                await video_channel.set_qos(prefetch_count=WORKER_CONCURRENCY)
+                video_queue = await video_channel.declare_queue(VIDEO_QUEUE, durable=True)
+
+                async def handle_video(message: IncomingMessage):
+                    IN_FLIGHT_JOBS.inc()
+                    try:
+                        await process_video(message, redis, qdrant, channel, face_cache, process_pool)
+                    finally:
+                        IN_FLIGHT_JOBS.dec()
+                        CACHE_ENTRIES.set(len(face_cache))
+
+                await video_queue.consume(handle_video)
+                WORKER_READY.set(1)
+                print(f"Waiting for videos (concurrency={WORKER_CONCURRENCY}) ...")
+                await asyncio.Future()
+
+            # Bounds in-flight batches; the CPU stage is further bounded by the pool size
+            in_flight = asyncio.Semaphore(WORKER_CONCURRENCY)
+            tasks = set()
+            pending = asyncio.Queue()
+
+            async def handle(batch):
                 try:
-                    print("MESSAGE RECEIVED", message.message_id, flush=True)
-                    await process_message(message, redis, qdrant, channel)
+                    await process_batch(batch, redis, qdrant, channel, face_cache, process_pool)
                 except Exception as e:
                     print("ERROR ON LOOP:", e, flush=True)
+                finally:
+                    in_flight.release()
+                    IN_FLIGHT_JOBS.dec(len(batch))
+                    CACHE_ENTRIES.set(len(face_cache))
+
+            # One channel per lane, each with its share of the prefetch, so a flood of
+            # batch jobs cannot take every delivery slot from interactive ones
+            prefetch = lane_prefetch()
+            for lane in JOB_LANES:
+                lane_channel = await connection.channel()
+                await lane_channel.set_qos(prefetch_count=prefetch[lane])
+                queue = await lane_channel.declare_queue(lane_queue(lane), durable=True)
+                await queue.consume(functools.partial(enqueue, pending, lane))
+
+            WORKER_READY.set(1)
+            print(
+                f"Waiting for mensages (batch={WORKER_BATCH_SIZE}, wait={WORKER_BATCH_WAIT_MS}ms, "
+                f"concurrency={WORKER_CONCURRENCY}, prefetch={prefetch}) ..."
+            )
+            buffers = {lane: deque() for lane in JOB_LANES}
+            while True:
+                # Collect up to WORKER_BATCH_SIZE messages, waiting at most WORKER_BATCH_WAIT_MS after the first
+                if not any(buffers.values()):
+                    lane, message = await pending.get()
+                    buffers[lane].append(message)
+                deadline = asyncio.get_running_loop().time() + WORKER_BATCH_WAIT_MS / 1000
+                while sum(map(len, buffers.values())) < WORKER_BATCH_SIZE:
+                    timeout = deadline - asyncio.get_running_loop().time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        lane, message = await asyncio.wait_for(pending.get(), timeout)
+                        buffers[lane].append(message)
+                    except asyncio.TimeoutError:
+                        break
+                while not pending.empty():
+                    lane, message = pending.get_nowait()
+                    buffers[lane].append(message)
+                batch = take_weighted(buffers, WORKER_BATCH_SIZE)
+
+                print(f"BATCH RECEIVED ({len(batch)} messages)", flush=True)
+                IN_FLIGHT_JOBS.inc(len(batch))
+                await in_flight.acquire()
+                task = asyncio.create_task(handle(batch))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            cache_sync_task.cancel()
+            await asyncio.gather(cache_sync_task, return_exceptions=True)
 
     except Exception as e:
         print(f"Startup failed: {e}")